@@ -43,6 +43,11 @@ Provides functionality for the reads system, such as:
 - Marking happiness entries as read or unread
 - Get all the unread happiness entries for a user
 
+### Sync
+Provides delta sync for clients that keep a local copy of the data, such as:
+- Fetching the happiness entries, comments, and reads that changed since the last sync
+- Fetching the IDs of everything that was deleted since the last sync
+
 ### Journal
 Provides functionality for private happiness entries, such as:
 - Requesting a user's decryption key
@@ -9,6 +9,7 @@ from flask_sqlalchemy import SQLAlchemy
 from werkzeug.middleware.proxy_fix import ProxyFix
 
 import api.util.email_methods as email_methods
+from api.authentication import token_cache
 from config import Config
 from jobs import scheduler
 
@@ -35,9 +36,27 @@ def create_app(config=Config):
     ma.init_app(app)
     apifairy.init_app(app)
     email_methods.init_app(app)
+    token_cache.init_app(app)
     cors.init_app(app)
     scheduler.init_app(app)
 
+    from api.util.explain import explain_queries
+    app.cli.add_command(explain_queries)
+    from api.util.group_happiness_cache import group_cache_stats
+    app.cli.add_command(group_cache_stats)
+    from api.util.rollups import rebuild_rollups
+    app.cli.add_command(rebuild_rollups)
+    from api.util.wrapped import ingest_wrapped
+    app.cli.add_command(ingest_wrapped)
+    from api.util.happiness_import import import_happiness_command
+    app.cli.add_command(import_happiness_command)
+    from api.util.kdf import kdf_stats
+    app.cli.add_command(kdf_stats)
+    from api.util.email_outbox import drain_outbox
+    app.cli.add_command(drain_outbox)
+    from api.util.email_executor import email_stats
+    app.cli.add_command(email_stats)
+
     from api.routes.user import user
     app.register_blueprint(user, url_prefix='/api/user')
     from api.routes.token import token
@@ -50,6 +69,8 @@ def create_app(config=Config):
     app.register_blueprint(journal, url_prefix='/api/journal')
     from api.routes.reads import reads
     app.register_blueprint(reads, url_prefix='/api/reads')
+    from api.routes.sync import sync
+    app.register_blueprint(sync, url_prefix='/api/sync')
     from api.routes.mcp_oauth import mcp_oauth
     app.register_blueprint(mcp_oauth, url_prefix='/api/mcp/oauth')
     from api.routes.discord_link import discord_link
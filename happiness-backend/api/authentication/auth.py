@@ -1,8 +1,10 @@
 import hashlib
+from datetime import datetime
 
 from flask_httpauth import HTTPBasicAuth, HTTPTokenAuth
 
-from api.dao.users_dao import get_user_by_username, get_token, get_user_by_id, get_user_by_email
+from api.authentication import token_cache
+from api.dao.users_dao import get_user_by_id, get_users_by_email_or_username, get_token_user
 from api.models.models import User
 from api.util.errors import error_response
 
@@ -17,15 +19,11 @@ def token_current_user() -> User:
 
 @basic_auth.verify_password
 def verify_password(email_or_username: str, password: str):
-    # First, assume user is logging in with their email.
-    # If that fails, assume user is logging in with their username.
+    # Users can log in with their email or username, which are looked up together.
+    # Email matches are checked first; the password is normally only hashed once.
     if email_or_username and password:
-        user = get_user_by_email(email_or_username)
-        if user and user.verify_password(password):
-            return user
-        else:
-            user = get_user_by_username(email_or_username)
-            if user and user.verify_password(password):
+        for user in get_users_by_email_or_username(email_or_username):
+            if user.verify_password(password):
                 return user
 
 
@@ -38,9 +36,17 @@ def basic_auth_error(status):
 def verify_token(session_token: str):
     if session_token:
         # hash session token (since only hashed tokens are stored)
-        token = get_token(hashlib.sha256(session_token.encode()).hexdigest())
-        if token and token.verify():
-            return get_user_by_id(token.user_id)
+        hashed_token = hashlib.sha256(session_token.encode()).hexdigest()
+
+        # recently verified tokens only need the user to be loaded
+        user_id = token_cache.get_user_id(hashed_token)
+        if user_id is not None:
+            return get_user_by_id(user_id)
+
+        user, expiration = get_token_user(hashed_token)
+        if user and expiration > datetime.utcnow():
+            token_cache.put(hashed_token, user.id, expiration)
+            return user
 
 
 @token_auth.error_handler
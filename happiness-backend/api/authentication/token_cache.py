@@ -0,0 +1,72 @@
+"""
+Process-local cache of verified session tokens.
+
+Maps a hashed session token to the (user ID, expiration) of the token for TOKEN_CACHE_TTL seconds,
+so that authenticating a request does not have to look the token up in the database every time.
+Each worker process has its own cache, so a token revoked through another worker may still be
+accepted here for up to TOKEN_CACHE_TTL seconds.
+"""
+import threading
+from datetime import datetime
+from typing import Optional
+
+from cachetools import TTLCache
+
+TOKEN_CACHE_SIZE = 4096
+
+_ttl = 0
+_cache = TTLCache(maxsize=TOKEN_CACHE_SIZE, ttl=1)
+_lock = threading.Lock()
+
+
+def init_app(app):
+    """
+    Sets up the cache with the app's TOKEN_CACHE_TTL (0 to disable). The TTL is kept here rather than
+    read from current_app, as tokens are also verified outside of the app context (by the MCP server).
+    """
+    global _ttl, _cache
+    with _lock:
+        _ttl = app.config.get("TOKEN_CACHE_TTL", 0)
+        _cache = TTLCache(maxsize=TOKEN_CACHE_SIZE, ttl=_ttl or 1)
+
+
+def get_user_id(hashed_token: str) -> Optional[int]:
+    """Returns the user ID of a cached, unexpired token, or None if it is not cached."""
+    if not _ttl:
+        return None
+    with _lock:
+        cached = _cache.get(hashed_token)
+    if cached is None:
+        return None
+    user_id, expiration = cached
+    if expiration <= datetime.utcnow():
+        invalidate(hashed_token)
+        return None
+    return user_id
+
+
+def put(hashed_token: str, user_id: int, expiration: datetime):
+    """Caches a verified token."""
+    if not _ttl:
+        return
+    with _lock:
+        _cache[hashed_token] = (user_id, expiration)
+
+
+def invalidate(hashed_token: str):
+    """Removes a token from the cache (e.g. when it is revoked)."""
+    with _lock:
+        _cache.pop(hashed_token, None)
+
+
+def invalidate_user(user_id: int):
+    """Removes all of a user's tokens from the cache (e.g. when the user is deleted)."""
+    with _lock:
+        for hashed_token in [k for k, (uid, _) in _cache.items() if uid == user_id]:
+            _cache.pop(hashed_token, None)
+
+
+def clear():
+    """Removes all tokens from the cache."""
+    with _lock:
+        _cache.clear()
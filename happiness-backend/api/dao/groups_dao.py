@@ -1,7 +1,13 @@
-from sqlalchemy import select
+import json
+
+import redis
+from flask import current_app, g
+from sqlalchemy import select, event
+from sqlalchemy.orm import Session, aliased
 
 from api.app import db
-from api.models.models import Group
+from api.models.models import Group, group_users
+from api.util import unread_index
 
 
 def get_group_by_id(group_id: int) -> Group:
@@ -9,3 +15,99 @@ def get_group_by_id(group_id: int) -> Group:
     Returns a Group object by ID.
     """
     return db.session.execute(select(Group).where(Group.id == group_id)).scalar()
+
+
+def co_members_query(user_id: int, among: set[int] = None):
+    """
+    Query for the IDs of users who are in at least one of the given user's groups
+    (optionally only considering the users in among).
+    """
+    mine, theirs = aliased(group_users), aliased(group_users)
+    query = (
+        select(theirs.c.user_id).distinct()
+        .join(mine, mine.c.group_id == theirs.c.group_id)
+        .where(mine.c.user_id == user_id)
+    )
+    if among is not None:
+        query = query.where(theirs.c.user_id.in_(among))
+    return query
+
+
+def _co_member_cache_key(user_id: int) -> str:
+    return f"co_members:{user_id}"
+
+
+def _load_co_member_ids(user_id: int) -> set[int]:
+    """Loads a user's co-member IDs from Redis (if enabled), falling back to the database."""
+    ttl = current_app.config.get("CO_MEMBER_CACHE_TTL", 0)
+    if ttl:
+        try:
+            cached = current_app.redis.get(_co_member_cache_key(user_id))
+            if cached is not None:
+                return set(json.loads(cached))
+        except redis.RedisError:
+            ttl = 0
+
+    co_member_ids = set(db.session.execute(co_members_query(user_id)).scalars())
+
+    if ttl:
+        try:
+            current_app.redis.set(_co_member_cache_key(user_id), json.dumps(list(co_member_ids)),
+                                  ex=ttl)
+        except redis.RedisError:
+            pass
+    return co_member_ids
+
+
+def get_co_member_ids(user_id: int) -> set[int]:
+    """
+    Returns the IDs of all users who share a happiness group with the given user
+    (including the user themselves if they are in any group).
+    Loaded once per request, and cached in Redis for CO_MEMBER_CACHE_TTL seconds if configured.
+    """
+    request_cache = g.setdefault("co_member_ids", {})
+    if user_id not in request_cache:
+        request_cache[user_id] = _load_co_member_ids(user_id)
+    return request_cache[user_id]
+
+
+def get_mutual_group_user_ids(user_id: int, user_ids: list[int]) -> set[int]:
+    """
+    Returns the subset of user_ids who share a happiness group with the given user, using a
+    single query (or none if the user's co-members have already been loaded for this request).
+    """
+    request_cache = g.get("co_member_ids", {})
+    if user_id in request_cache:
+        return request_cache[user_id].intersection(user_ids)
+    if not user_ids:
+        return set()
+    return set(db.session.execute(co_members_query(user_id, among=set(user_ids))).scalars())
+
+
+def invalidate_co_member_ids(user_ids):
+    """
+    Marks the co-member sets of the given users as changed (call whenever group membership
+    changes). The request cache is updated immediately and the Redis cache once the
+    change is committed, so other workers cannot re-cache the old membership in between.
+    """
+    request_cache = g.get("co_member_ids", {})
+    for user_id in user_ids:
+        request_cache.pop(user_id, None)
+    db.session.info.setdefault("co_member_ids_changed", set()).update(user_ids)
+    # unread entries come from co-members too
+    unread_index.invalidate(user_ids)
+
+
+@event.listens_for(Session, "after_commit")
+def _clear_changed_co_member_ids(session):
+    changed = session.info.pop("co_member_ids_changed", None)
+    if changed and current_app.config.get("CO_MEMBER_CACHE_TTL", 0):
+        try:
+            current_app.redis.delete(*[_co_member_cache_key(user_id) for user_id in changed])
+        except redis.RedisError:
+            pass
+
+
+@event.listens_for(Session, "after_rollback")
+def _discard_changed_co_member_ids(session):
+    session.info.pop("co_member_ids_changed", None)
@@ -1,12 +1,16 @@
-from datetime import datetime, timedelta
+from datetime import date, datetime, time, timedelta
 
-from sqlalchemy import select, desc, Select, func
-from sqlalchemy.orm import Session
+from sqlalchemy import select, desc, Select, func, or_, and_
+from sqlalchemy.orm import Session, joinedload
 
 from api.app import db
-from api.models.models import Happiness, Comment, User
+from api.models.models import Happiness, Comment, User, readers_happiness
 from api.authentication.auth import token_current_user
+from api.dao.groups_dao import co_members_query, get_co_member_ids
+from api.util.cursor import encode_cursor, decode_cursor
+from api.util import unread_index
 from api.util.errors import failure_response
+from api.util.upsert import upsert, bulk_upsert
 
 
 def get_happiness_by_id(happiness_id: int) -> Happiness:
@@ -29,6 +33,33 @@ def get_happiness_by_date(user_id: int, date: datetime) -> Happiness:
     ).scalar()
 
 
+def upsert_happiness(user_id: int, timestamp: datetime, value: float, comment: str) -> tuple[Happiness, bool]:
+    """
+    Creates a Happiness entry for the given day, or overwrites the value and comment of the entry
+    the user already has for that day, in a single statement.
+    Returns the Happiness object and whether it was newly created.
+    """
+    return upsert(
+        Happiness,
+        dict(user_id=user_id, timestamp=timestamp, value=value, comment=comment),
+        index_elements=[Happiness.user_id, Happiness.timestamp],
+        update_columns=["value", "comment"]
+    )
+
+
+def bulk_upsert_happiness(entries: list[dict]):
+    """
+    Creates or overwrites many Happiness entries (dicts with user_id, timestamp, value, and comment)
+    at once. Entries must be for distinct (user, day) pairs.
+    """
+    bulk_upsert(
+        Happiness,
+        entries,
+        index_elements=[Happiness.user_id, Happiness.timestamp],
+        update_columns=["value", "comment"]
+    )
+
+
 def get_happiness_by_id_or_date(args: dict) -> Happiness:
     id, date = args.get("id"), args.get("date")
     if id is not None:
@@ -56,11 +87,36 @@ def get_happiness_by_date_range(
     Returns all Happiness objects (sorted from oldest to newest) between 2 Datetime objects (inclusive)
     given a list of User IDs.
     """
+    return list(session.execute(
+        _date_range_query(user_ids, start, end).order_by(Happiness.timestamp.asc())
+    ).scalars())
+
+
+def _date_range_query(user_ids: list[int], start: datetime, end: datetime) -> Select[tuple[Happiness]]:
     db_start = datetime.strftime(start, "%Y-%m-%d 00:00:00.000000")
     db_end = datetime.strftime(end, "%Y-%m-%d 00:00:00.000000")
-    return list(session.execute(select(Happiness).where(
+    return select(Happiness).where(
         Happiness.user_id.in_(user_ids), Happiness.timestamp.between(db_start, db_end)
-    ).order_by(Happiness.timestamp.asc())).scalars())
+    )
+
+
+def get_entry_dates(ranges: list[tuple[list[int], date, date]]) -> dict[int, set[date]]:
+    """
+    Returns the dates of each user's entries given a list of (User IDs, start date, end date) ranges
+    (inclusive), in a single query for all the ranges.
+    """
+    conditions = [
+        and_(Happiness.user_id.in_(user_ids),
+             Happiness.timestamp.between(datetime.combine(start, time()), datetime.combine(end, time())))
+        for user_ids, start, end in ranges if user_ids
+    ]
+    dates = {}
+    if not conditions:
+        return dates
+    for user_id, timestamp in db.session.execute(
+            select(Happiness.user_id, Happiness.timestamp).where(or_(*conditions))):
+        dates.setdefault(user_id, set()).add(timestamp.date())
+    return dates
 
 
 def get_happiness_by_count(user_ids: list[int], page: int, n: int) -> list[Happiness]:
@@ -69,22 +125,112 @@ def get_happiness_by_count(user_ids: list[int], page: int, n: int) -> list[Happi
     Page variable can be changed to show the next n objects for pagination.
     """
     return list(db.paginate(
-        select=(
-            select(Happiness).where(Happiness.user_id.in_(user_ids))
-            .order_by(Happiness.timestamp.desc(), Happiness.user_id.asc())
-        ),
+        select=_feed_query(select(Happiness).where(Happiness.user_id.in_(user_ids))),
         per_page=n,
         page=page,
-        error_out=False
+        error_out=False,
+        count=False
     ))
 
 
+def get_happiness_by_cursor(user_ids: list[int], n: int, cursor: str = None) -> tuple[list[Happiness], str]:
+    """
+    Returns n Happiness objects (sorted from newest to oldest) given a list of User IDs, starting
+    after the entry the cursor points to (or from the newest entry if no cursor is given).
+    Unlike page based pagination, the cost of fetching a page does not grow with its depth.
+    Returns the entries and a cursor for the next n entries (None if there are no more).
+    """
+    query = select(Happiness).where(Happiness.user_id.in_(user_ids))
+    return _paginate_feed_by_cursor(query, n, cursor)
+
+
+def get_read_happiness_by_count(user_id: int, page: int, n: int) -> list[Happiness]:
+    """
+    Returns a paginated list of Happiness objects (sorted from newest to oldest) that the given user has read.
+    """
+    return list(db.paginate(
+        select=_feed_query(_read_happiness_query(user_id)),
+        per_page=n,
+        page=page,
+        error_out=False,
+        count=False
+    ))
+
+
+def get_read_happiness_by_cursor(user_id: int, n: int, cursor: str = None) -> tuple[list[Happiness], str]:
+    """
+    Returns n Happiness objects (sorted from newest to oldest) that the given user has read,
+    starting after the entry the cursor points to. See get_happiness_by_cursor.
+    """
+    return _paginate_feed_by_cursor(_read_happiness_query(user_id), n, cursor)
+
+
+def _read_happiness_query(user_id: int) -> Select[tuple[Happiness]]:
+    return select(Happiness).join(
+        readers_happiness, readers_happiness.c.happiness_id == Happiness.id
+    ).where(readers_happiness.c.reader_id == user_id)
+
+
+def _feed_query(query: Select[tuple[Happiness]]) -> Select[tuple[Happiness]]:
+    """Sorts a query for Happiness objects in feed order (newest first, then by user)."""
+    return query.order_by(Happiness.timestamp.desc(), Happiness.user_id.asc())
+
+
+def _paginate_feed_by_cursor(query: Select[tuple[Happiness]], n: int,
+                             cursor: str) -> tuple[list[Happiness], str]:
+    """
+    Keyset pagination in feed order: (timestamp, user_id) is unique, so the cursor is the
+    (timestamp, user_id) of the last entry on the previous page.
+    """
+    if cursor is not None:
+        timestamp, user_id = decode_cursor(cursor)
+        query = query.where(or_(
+            Happiness.timestamp < timestamp,
+            and_(Happiness.timestamp == timestamp, Happiness.user_id > user_id)
+        ))
+
+    if n < 1:
+        return [], None
+    # fetch one extra entry to know whether there is a next page
+    entries = list(db.session.execute(_feed_query(query).limit(n + 1)).scalars())
+    if len(entries) <= n:
+        return entries, None
+    entries = entries[:n]
+    return entries, encode_cursor(entries[-1].timestamp, entries[-1].user_id)
+
+
 def get_happiness_by_unread(user_id: int, user_ids: list[int]) -> list[Happiness]:
     """
     Returns a list of all Happiness objects (sorted from newest to oldest) from all the users
     in the user_ids list in the last week for which the given user has not read.
     """
-    return list(db.session.execute(select(Happiness).where(
+    return list(db.session.execute(
+        _indexed_unread_query(user_id, user_ids).order_by(Happiness.timestamp.desc(), Happiness.user_id.asc())
+    ).scalars())
+
+
+def _indexed_unread_query(user_id: int, user_ids: list[int]) -> Select[tuple[Happiness]]:
+    """
+    Query for the user's unread entries using their unread index (see unread_index), building the
+    index from the database if needed. Falls back to the full unread query if the index is disabled.
+    """
+    if not unread_index.enabled():
+        return _unread_query(user_id, user_ids)
+    happiness_ids = unread_index.get_unread_ids(user_id)
+    if happiness_ids is None:
+        # the index always covers all of the user's co-members
+        generation = unread_index.generation(user_id)
+        friend_ids = get_co_member_ids(user_id) - {user_id}
+        entries = db.session.execute(
+            _unread_query(user_id, friend_ids).with_only_columns(Happiness.id, Happiness.timestamp)
+        ).all()
+        unread_index.build(user_id, entries, generation)
+        happiness_ids = [happiness_id for happiness_id, _ in entries]
+    return select(Happiness).where(Happiness.id.in_(happiness_ids), Happiness.user_id.in_(user_ids))
+
+
+def _unread_query(user_id: int, user_ids: list[int]) -> Select[tuple[Happiness]]:
+    return select(Happiness).where(
         # Happiness falls in the last week
         Happiness.timestamp.between(
             str(datetime.utcnow() - timedelta(weeks=1)), str(datetime.utcnow())
@@ -94,7 +240,49 @@ def get_happiness_by_unread(user_id: int, user_ids: list[int]) -> list[Happiness
         # We want Happiness objects that where the user's id doesn't exist in its readers
         # https://docs.sqlalchemy.org/en/20/orm/queryguide/select.html#exists-forms-has-any
         ~Happiness.readers.any(User.id == user_id)
-    ).order_by(Happiness.timestamp.desc(), Happiness.user_id.asc())).scalars())
+    )
+
+
+def get_date_range_version(user_ids: list[int], start: datetime, end: datetime) -> tuple:
+    """
+    Returns the version of the Happiness objects returned by get_happiness_by_date_range.
+    See _happiness_version.
+    """
+    return _happiness_version(_date_range_query(user_ids, start, end))
+
+
+def get_feed_version(user_ids: list[int]) -> tuple:
+    """
+    Returns the version of the Happiness objects of the given users (which all the pages
+    returned by get_happiness_by_count and get_happiness_by_cursor are taken from).
+    """
+    return _happiness_version(select(Happiness).where(Happiness.user_id.in_(user_ids)))
+
+
+def get_read_happiness_version(user_id: int) -> tuple:
+    """
+    Returns the version of the Happiness objects that the given user has read.
+    """
+    return _happiness_version(_read_happiness_query(user_id))
+
+
+def get_unread_version(user_id: int, user_ids: list[int]) -> tuple:
+    """
+    Returns the version of the Happiness objects returned by get_happiness_by_unread.
+    """
+    return _happiness_version(_indexed_unread_query(user_id, user_ids))
+
+
+def _happiness_version(query: Select[tuple[Happiness]]) -> tuple:
+    """
+    Aggregates the Happiness objects a query selects into a version that changes whenever an entry
+    is added to, removed from, or edited in its results, without loading the entries themselves.
+    (Entries only get new IDs, so the count and sum of IDs change whenever the set of entries does.)
+    """
+    entries = query.subquery()
+    return tuple(db.session.execute(select(
+        func.count(), func.sum(entries.c.id), func.max(entries.c.id), func.max(entries.c.updated_at)
+    ).select_from(entries)).one())
 
 
 def get_happiness_by_filter(
@@ -177,8 +365,43 @@ def get_comment_by_id(comment_id: int) -> Comment:
     return db.session.execute(select(Comment).where(Comment.id == comment_id)).scalar()
 
 
-def get_num_of_entries(user_id: int, low: int, high: int) -> int:
-    query = select(func.count(Happiness.id))
-    query = query.where(Happiness.user_id == user_id)
-    query = query.where(Happiness.value >= low, Happiness.value <= high)
-    return db.session.scalar(query)
+def get_visible_comments(
+    happiness_id: int,
+    viewer_id: int,
+    page: int = None,
+    per_page: int = None,
+    cursor: str = None,
+) -> tuple[list[Comment], str]:
+    """
+    Returns the discussion comments (sorted from oldest to newest) on a Happiness entry that were
+    written by users who share a group with the viewer, with their authors, in a single query.
+    If per_page is given, only that many comments are returned, starting after the given cursor
+    (or at the given page if there is no cursor).
+    Returns the comments and a cursor for the next comments (None if there are no more).
+    """
+    query = (
+        select(Comment)
+        .where(Comment.happiness_id == happiness_id,
+               Comment.user_id.in_(co_members_query(viewer_id)))
+        .options(joinedload(Comment.author))
+        .order_by(Comment.timestamp.asc(), Comment.id.asc())
+    )
+    if per_page is None:
+        return list(db.session.execute(query).scalars()), None
+
+    if cursor is not None:
+        timestamp, comment_id = decode_cursor(cursor)
+        query = query.where(or_(Comment.timestamp > timestamp,
+                                and_(Comment.timestamp == timestamp, Comment.id > comment_id)))
+    elif page is not None:
+        query = query.offset((max(page, 1) - 1) * per_page)
+
+    if per_page < 1:
+        return [], None
+    # fetch one extra comment to know whether there is a next page
+    comments = list(db.session.execute(query.limit(per_page + 1)).scalars())
+    if len(comments) <= per_page:
+        return comments, None
+    comments = comments[:per_page]
+    return comments, encode_cursor(comments[-1].timestamp, comments[-1].id)
+
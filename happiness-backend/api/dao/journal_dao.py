@@ -7,6 +7,7 @@ from api.app import db
 from api.authentication.auth import token_current_user
 from api.models.models import Journal
 from api.util.errors import failure_response
+from api.util.upsert import upsert
 
 
 def get_journal_by_id(entry_id: int) -> Journal:
@@ -27,6 +28,20 @@ def get_journal_by_date(user_id: int, date: datetime) -> Journal:
     ).scalar()
 
 
+def upsert_journal(user_id: int, timestamp: datetime, encrypted_data: bytes) -> Journal:
+    """
+    Creates a Journal entry for the given day, or overwrites the data of the entry the user
+    already has for that day, in a single statement.
+    """
+    entry, _ = upsert(
+        Journal,
+        dict(user_id=user_id, timestamp=timestamp, data=encrypted_data),
+        index_elements=[Journal.user_id, Journal.timestamp],
+        update_columns=["data"]
+    )
+    return entry
+
+
 def get_journal_by_date_range(user_id: int, start: datetime, end: datetime) -> list[Journal]:
     """
     Returns journal entries between start date and end date, inclusive
@@ -57,6 +72,22 @@ def get_num_journals_by_date_range(user_id: int, start: datetime, end: datetime)
     )
 
 
+def get_journal_version(user_id: int, start: datetime = None, end: datetime = None) -> tuple:
+    """
+    Returns a version of a user's Journal entries (optionally only those between start and end date,
+    inclusive) that changes whenever an entry is added, removed, or edited, without loading the entries.
+    """
+    query = select(Journal.id, Journal.updated_at).where(Journal.user_id == user_id)
+    if start is not None:
+        db_start = datetime.strftime(start, "%Y-%m-%d 00:00:00.000000")
+        db_end = datetime.strftime(end, "%Y-%m-%d 00:00:00.000000")
+        query = query.where(Journal.timestamp.between(db_start, db_end))
+    entries = query.subquery()
+    return tuple(db.session.execute(select(
+        func.count(), func.sum(entries.c.id), func.max(entries.c.id), func.max(entries.c.updated_at)
+    ).select_from(entries)).one())
+
+
 def get_entry_by_id_or_date(args: dict) -> Journal:
     id, date = args.get("id"), args.get("date")
     if id is not None:
@@ -0,0 +1,130 @@
+from collections import defaultdict
+from datetime import date, datetime, time, timedelta
+from typing import Optional
+
+from sqlalchemy import select, delete, insert, func
+from sqlalchemy.orm import Session
+
+from api.app import db
+from api.models.models import Happiness, HappinessRollup, User
+from api.util.upsert import upsert
+
+PERIODS = ("day", "week", "month")
+
+
+def bucket_range(period: str, day: date) -> tuple[date, date]:
+    """Returns the first day of the bucket the given day falls in, and the first day of the next bucket."""
+    if period == "day":
+        return day, day + timedelta(days=1)
+    if period == "week":
+        start = day - timedelta(days=day.weekday())
+        return start, start + timedelta(weeks=1)
+    start = day.replace(day=1)
+    return start, (start + timedelta(days=32)).replace(day=1)
+
+
+def _aggregate(values: list[float]) -> dict:
+    return dict(count=len(values), sum=sum(values), sum_sq=sum(v * v for v in values),
+                min=min(values), max=max(values))
+
+
+def _lock_user_rollups(user_id: int):
+    """
+    Serializes rollup updates of a user until the transaction ends. Otherwise two concurrent writes could each
+    recompute a bucket without the other's entry (entries are read committed), and the last commit would leave
+    a stale aggregate. The user's row is locked FOR NO KEY UPDATE, which does not conflict with the locks taken
+    by inserting their entries (SQLite serializes all writes anyway).
+    """
+    db.session.execute(select(User.id).where(User.id == user_id).with_for_update(key_share=True))
+
+
+def refresh_rollups(user_id: int, timestamp: datetime):
+    """
+    Recomputes the user's day, week, and month rollups containing the given day from their entries
+    (call whenever a happiness entry is created, edited, or deleted, before committing).
+    Only the affected buckets are touched, so this reads at most a month of entries.
+    """
+    day = timestamp.date() if isinstance(timestamp, datetime) else timestamp
+    db.session.flush()
+    _lock_user_rollups(user_id)
+
+    month_start, month_end = bucket_range("month", day)
+    week_start, week_end = bucket_range("week", day)
+    rows = db.session.execute(select(Happiness.timestamp, Happiness.value).where(
+        Happiness.user_id == user_id, Happiness.value.is_not(None),
+        Happiness.timestamp >= datetime.combine(min(month_start, week_start), time()),
+        Happiness.timestamp < datetime.combine(max(month_end, week_end), time())
+    )).all()
+
+    for period in PERIODS:
+        start, end = bucket_range(period, day)
+        values = [value for ts, value in rows if start <= ts.date() < end]
+        if values:
+            upsert(HappinessRollup, dict(user_id=user_id, period=period, bucket=start, **_aggregate(values)),
+                   index_elements=[HappinessRollup.user_id, HappinessRollup.period, HappinessRollup.bucket],
+                   update_columns=["count", "sum", "sum_sq", "min", "max"])
+        else:
+            db.session.execute(delete(HappinessRollup).where(
+                HappinessRollup.user_id == user_id, HappinessRollup.period == period,
+                HappinessRollup.bucket == start
+            ))
+
+
+def rebuild_rollups(user_id: Optional[int] = None, batch_size: int = 1000):
+    """
+    Rebuilds all rollups (or only the given user's rollups) from scratch by streaming
+    the happiness entries once.
+    """
+    query = select(Happiness.user_id, Happiness.timestamp, Happiness.value).where(
+        Happiness.timestamp.is_not(None), Happiness.value.is_not(None))
+    clear = delete(HappinessRollup)
+    if user_id is not None:
+        _lock_user_rollups(user_id)
+        query = query.where(Happiness.user_id == user_id)
+        clear = clear.where(HappinessRollup.user_id == user_id)
+    db.session.execute(clear)
+
+    buckets = defaultdict(list)
+    for uid, timestamp, value in db.session.execute(query.execution_options(yield_per=batch_size)):
+        for period in PERIODS:
+            buckets[(uid, period, bucket_range(period, timestamp.date())[0])].append(value)
+
+    rows = [dict(user_id=uid, period=period, bucket=bucket, **_aggregate(values))
+            for (uid, period, bucket), values in buckets.items()]
+    for i in range(0, len(rows), batch_size):
+        db.session.execute(insert(HappinessRollup), rows[i:i + batch_size])
+    db.session.commit()
+
+
+def delete_rollups(user_id: int):
+    """
+    Deletes all the user's rollups (e.g. when the user is deleted).
+    """
+    db.session.execute(delete(HappinessRollup).where(HappinessRollup.user_id == user_id))
+
+
+def get_rollups(
+    user_id: int,
+    period: str,
+    start: date,
+    end: date,
+    session: Session = db.session,
+) -> list[HappinessRollup]:
+    """
+    Returns the user's rollups for the given period (sorted from oldest to newest) whose buckets
+    contain a day between start and end date (inclusive).
+    """
+    return list(session.execute(select(HappinessRollup).where(
+        HappinessRollup.user_id == user_id,
+        HappinessRollup.period == period,
+        HappinessRollup.bucket.between(bucket_range(period, start)[0], end)
+    ).order_by(HappinessRollup.bucket)).scalars())
+
+
+def get_entry_count(user_id: int) -> int:
+    """
+    Returns the number of happiness entries the user has made, using month rollups.
+    """
+    return db.session.scalar(select(func.coalesce(func.sum(HappinessRollup.count), 0)).where(
+        HappinessRollup.user_id == user_id, HappinessRollup.period == "month"
+    ))
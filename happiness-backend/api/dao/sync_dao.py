@@ -0,0 +1,57 @@
+from datetime import datetime
+
+from sqlalchemy import select
+
+from api.app import db
+from api.models.models import Happiness, Comment, Tombstone, readers_happiness
+
+
+def get_changed_happiness(user_ids: list[int], since: datetime = None) -> list[Happiness]:
+    """
+    Returns the Happiness objects of the given users that were created or edited since the given time
+    (or all of them if no time is given).
+    """
+    query = select(Happiness).where(Happiness.user_id.in_(user_ids))
+    if since is not None:
+        query = query.where(Happiness.updated_at >= since)
+    return list(db.session.execute(query.order_by(Happiness.id)).scalars())
+
+
+def get_changed_comments(user_ids: list[int], since: datetime = None) -> list[Comment]:
+    """
+    Returns the Comments made by the given users on the given users' Happiness entries that were
+    created or edited since the given time (or all of them if no time is given).
+    """
+    query = select(Comment).join(Happiness, Happiness.id == Comment.happiness_id).where(
+        Happiness.user_id.in_(user_ids), Comment.user_id.in_(user_ids)
+    )
+    if since is not None:
+        query = query.where(Comment.updated_at >= since)
+    return list(db.session.execute(query.order_by(Comment.id)).scalars())
+
+
+def get_changed_read_ids(user_id: int, since: datetime = None) -> list[int]:
+    """
+    Returns the IDs of the Happiness entries the given user has read since the given time
+    (or all of them if no time is given).
+    """
+    query = select(readers_happiness.c.happiness_id).where(readers_happiness.c.reader_id == user_id)
+    if since is not None:
+        query = query.where(readers_happiness.c.updated_at >= since)
+    return list(db.session.execute(query).scalars())
+
+
+def get_deleted_ids(user_id: int, user_ids: list[int], since: datetime) -> dict[str, list[int]]:
+    """
+    Returns the IDs of the Happiness entries and Comments of the given users, and the reads of the
+    given user, that were deleted since the given time (grouped by kind).
+    """
+    deleted = {"happiness": [], "comment": [], "read": []}
+    tombstones = db.session.execute(select(Tombstone.kind, Tombstone.row_id, Tombstone.owner_id).where(
+        Tombstone.owner_id.in_(user_ids), Tombstone.deleted_at >= since
+    )).all()
+    for kind, row_id, owner_id in tombstones:
+        # reads are only visible to the reader
+        if kind != "read" or owner_id == user_id:
+            deleted[kind].append(row_id)
+    return deleted
@@ -6,10 +6,10 @@ Helper file containing functions for accessing data in our database
 from datetime import datetime
 from typing import List
 
-from sqlalchemy import select, func
+from sqlalchemy import select, func, or_, case
 
 from api.app import db
-from api.models.models import User, Token, Happiness
+from api.models.models import User, Token, Happiness, NotificationSchedule
 from config import Config
 
 
@@ -22,11 +22,24 @@ def get_user_by_id(user_id: int) -> User:
 
 def get_user_by_username(username: str) -> User:
     """
-    Returns a User object by username (not case-sensitive).
+    Returns a User object by username (not case-sensitive), using the lower(username) index.
     :param username: Username of the User object one is searching for.
     :return: A user object that has the same username as the username that was passed in.
     """
-    return db.session.execute(select(User).where(User.username.ilike(username))).scalar()
+    return db.session.execute(select(User).where(func.lower(User.username) == username.lower())).scalar()
+
+
+def get_users_by_email_or_username(email_or_username: str) -> list[User]:
+    """
+    Returns the users whose email or username is the given value (not case-sensitive), in one query
+    using the lower(email) and lower(username) indexes. The user with a matching email comes first.
+    """
+    key = email_or_username.lower()
+    email_match = func.lower(User.email) == key
+    return list(db.session.execute(
+        select(User).where(or_(email_match, func.lower(User.username) == key))
+        .order_by(case((email_match, 0), else_=1))
+    ).scalars())
 
 
 def get_user_by_email(email: str) -> User:
@@ -35,7 +48,7 @@ def get_user_by_email(email: str) -> User:
     :param email: Email fo the User object one is searching for
     :return: A user object that has the same case-insensitive email, or None if the user is not found.
     """
-    return db.session.execute(select(User).where(User.email.ilike(email))).scalar()
+    return db.session.execute(select(User).where(func.lower(User.email) == email.lower())).scalar()
 
 
 def get_token(token: str) -> Token:
@@ -45,6 +58,19 @@ def get_token(token: str) -> Token:
     return db.session.execute(select(Token).where(Token.session_token == token)).scalar()
 
 
+def get_token_user(token: str) -> tuple[User, datetime] | tuple[None, None]:
+    """
+    Returns the user that owns a session token and the token's expiration, in a single query.
+    Returns (None, None) if no such token exists.
+    """
+    row = db.session.execute(
+        select(User, Token.session_expiration)
+        .join(Token, Token.user_id == User.id)
+        .where(Token.session_token == token)
+    ).first()
+    return (row[0], row[1]) if row else (None, None)
+
+
 def get_active_users() -> List[User]:
     """
     Returns a list of users with >= 20 happiness entries since 1/1/{WRAPPED_YEAR} in descending order
@@ -60,3 +86,19 @@ def get_active_users() -> List[User]:
         .all()
     )
     return active_users
+
+
+def get_notification_schedules(start_minute: int, end_minute: int) -> list[tuple[int, str, str, str]]:
+    """
+    Returns the (user ID, timezone, email, username) of every user to notify between the given UTC minutes
+    of the day (inclusive, wrapping around midnight if start_minute > end_minute), in a single query.
+    """
+    if start_minute <= end_minute:
+        in_range = NotificationSchedule.minute.between(start_minute, end_minute)
+    else:
+        in_range = or_(NotificationSchedule.minute >= start_minute, NotificationSchedule.minute <= end_minute)
+    return [tuple(row) for row in db.session.execute(
+        select(NotificationSchedule.user_id, NotificationSchedule.timezone, User.email, User.username)
+        .join(User, NotificationSchedule.user_id == User.id)
+        .where(in_range)
+    )]
@@ -0,0 +1,31 @@
+import json
+from typing import Optional
+
+from sqlalchemy import select, delete, insert
+
+from api.app import db
+from api.models.models import Wrapped, User
+
+
+def get_wrapped(user_id: int, year: int) -> Optional[str]:
+    """
+    Returns the user's serialized Wrapped data for the given year, or None if they do not have any.
+    """
+    return db.session.scalar(select(Wrapped.data).where(Wrapped.year == year, Wrapped.user_id == user_id))
+
+
+def replace_wrapped(year: int, all_wrapped_data: dict, batch_size: int = 500) -> int:
+    """
+    Replaces all Wrapped data of the given year with the given user ID -> Wrapped data mapping
+    in one transaction, so readers see either the old or the new data. Users that no longer exist
+    are skipped. Returns the number of users stored.
+    """
+    user_ids = set(db.session.execute(select(User.id)).scalars())
+    rows = [dict(year=year, user_id=int(user_id), data=json.dumps(data))
+            for user_id, data in all_wrapped_data.items() if int(user_id) in user_ids]
+
+    db.session.execute(delete(Wrapped).where(Wrapped.year == year))
+    for i in range(0, len(rows), batch_size):
+        db.session.execute(insert(Wrapped), rows[i:i + batch_size])
+    db.session.commit()
+    return len(rows)
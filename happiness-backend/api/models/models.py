@@ -3,21 +3,19 @@ from __future__ import annotations
 import base64
 import hashlib
 import os
-import threading
 from datetime import datetime, timedelta
 
 from cryptography.fernet import Fernet
-from cryptography.hazmat.primitives import hashes
-from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
 from flask import current_app
 from flask_sqlalchemy.model import DefaultMeta
 from sqlalchemy import delete, Integer, String, DateTime, ForeignKey, Column, Boolean, Float, \
-    LargeBinary, select
+    LargeBinary, select, event, insert, Date, Text, func
 from sqlalchemy.orm import mapped_column, relationship
 from werkzeug.security import generate_password_hash, check_password_hash
 
 from api.app import db
-from api.util import email_methods
+from api.authentication import token_cache
+from api.util import kdf, unread_index
 from api.util.jwt_methods import generate_jwt
 
 BaseModel: DefaultMeta = db.Model
@@ -44,7 +42,10 @@ readers_happiness = db.Table(
     BaseModel.metadata,
     Column("happiness_id", Integer, ForeignKey("happiness.id")),
     Column("reader_id", Integer, ForeignKey("user.id")),
-    Column("timestamp", DateTime, default=datetime.utcnow())
+    Column("timestamp", DateTime, default=datetime.utcnow()),
+    Column("updated_at", DateTime, default=datetime.utcnow),
+    # serves the "has this user read this entry" lookups used by the reads and unread feeds
+    db.Index("ix_readers_happiness_reader_id_happiness_id", "reader_id", "happiness_id")
 )
 
 
@@ -65,6 +66,7 @@ class User(BaseModel):
     encrypted_key_recovery = mapped_column(LargeBinary)
 
     settings = relationship("Setting", cascade="delete")
+    notification_schedule = relationship("NotificationSchedule", cascade="delete", uselist=False)
     groups = relationship("Group", secondary=group_users, back_populates="users", lazy='dynamic')
     invites = relationship("Group", secondary=group_invites, back_populates="invited_users")
     posts_read = relationship("Happiness", secondary=readers_happiness, back_populates="readers",
@@ -94,14 +96,8 @@ class User(BaseModel):
         self.encrypted_key = Fernet(password_key).encrypt(user_key)
 
     def derive_password_key(self, password: str) -> bytes:
-        """Derive password key from user password"""
-        kdf = PBKDF2HMAC(
-            algorithm=hashes.SHA256(),
-            length=32,
-            salt=bytes(current_app.config["ENCRYPT_SALT"], 'utf-8'),
-            iterations=200000,
-        )
-        return base64.urlsafe_b64encode(kdf.derive(bytes(password, 'utf-8')))
+        """Derive password key from user password (on the KDF process pool, see util.kdf)"""
+        return kdf.derive_password_key(password)
 
     def generate_password_key_token(self, password: str, expiration=60) -> str:
         return generate_jwt(
@@ -111,15 +107,17 @@ class User(BaseModel):
         """Decrypt user key using password key"""
         return Fernet(bytes(password_key, 'utf-8')).decrypt(self.encrypted_key)
 
+    def get_cipher(self, password_key: str) -> Fernet:
+        """Decrypt user key with password key, returning a cipher for the user's data (see journal_crypto)"""
+        return Fernet(self.decrypt_user_key(password_key))
+
     def encrypt_data(self, password_key: str, data: str) -> bytes:
         """Decrypt user key with password key, then encrypt data with user key"""
-        user_key = self.decrypt_user_key(password_key)
-        return Fernet(user_key).encrypt(bytes(data, 'utf-8'))
+        return self.get_cipher(password_key).encrypt(bytes(data, 'utf-8'))
 
     def decrypt_data(self, password_key: str, data: str) -> bytes:
         """Decrypt user key with password key, then decrypt data with user key"""
-        user_key = self.decrypt_user_key(password_key)
-        return Fernet(user_key).decrypt(data)
+        return self.get_cipher(password_key).decrypt(data)
 
     def avatar_url(self):
         digest = hashlib.md5(self.email.lower().encode('utf-8')).hexdigest()
@@ -170,10 +168,16 @@ class User(BaseModel):
         """
         Checks to see if the current users shares a happiness group user_to_check (a user object)
         """
-        # checks if intersection of user's groups and user_to_check's groups is non-empty
         if user_to_check is None:
             return False
-        return self.groups.intersect(user_to_check.groups).count() > 0
+        return self.has_mutual_group_id(user_to_check.id)
+
+    def has_mutual_group_id(self, user_id: int) -> bool:
+        """
+        Checks to see if the current users shares a happiness group with the user with the given ID
+        """
+        from api.dao.groups_dao import get_co_member_ids
+        return user_id in get_co_member_ids(self.id)
 
     def has_read_happiness(self, happiness):
         """Returns true if the user has read that happiness entry, false otherwise"""
@@ -183,11 +187,22 @@ class User(BaseModel):
         """Adds a read entry for the user"""
         if not self.has_read_happiness(happiness):
             self.posts_read.append(happiness)
+            # the read is back, so it must not also be synced as deleted
+            db.session.execute(delete(Tombstone).where(
+                Tombstone.kind == "read", Tombstone.row_id == happiness.id, Tombstone.owner_id == self.id))
+            unread_index.entry_read(self.id, happiness.id)
 
     def unread_happiness(self, happiness):
         """Removes a read entry for the user"""
         if self.has_read_happiness(happiness):
             self.posts_read.remove(happiness)
+            db.session.add(Tombstone(kind="read", row_id=happiness.id, owner_id=self.id))
+            unread_index.entry_unread(self.id, happiness.id, happiness.timestamp)
+
+
+# serve the case-insensitive email and username lookups (e.g. at login)
+db.Index("ix_user_lower_email", func.lower(User.email))
+db.Index("ix_user_lower_username", func.lower(User.username))
 
 
 class Setting(BaseModel):
@@ -213,6 +228,18 @@ class Setting(BaseModel):
         self.user_id = kwargs.get("user_id")
 
 
+class NotificationSchedule(BaseModel):
+    """
+    NotificationSchedule model. The parsed "notify" setting of a user, if it is enabled and valid,
+    so the users to notify at a given time can be found with an index lookup on the UTC minute of the day.
+    Kept in sync with the setting by api.util.notifications.update_notification_schedule.
+    """
+    __tablename__ = "notification_schedule"
+    user_id = mapped_column(Integer, ForeignKey("user.id", ondelete='cascade'), primary_key=True)
+    minute = mapped_column(Integer, nullable=False, index=True)
+    timezone = mapped_column(String, nullable=False)
+
+
 class Group(BaseModel):
     """
     Group model. Has a many-to-many relationship with User.
@@ -231,41 +258,91 @@ class Group(BaseModel):
         """
         self.name = kwargs.get("name")
 
+    def membership_changed(self):
+        """
+        Invalidates the cached co-members of everyone in the group and the group's cached happiness.
+        Must be called whenever users join or leave the group (before removed users are removed).
+        """
+        from api.dao.groups_dao import invalidate_co_member_ids
+        from api.util import group_happiness_cache
+        invalidate_co_member_ids([user.id for user in self.users])
+        if self.id is not None:
+            group_happiness_cache.groups_changed([self.id])
+
     def invite_users(self, users_to_invite: list[str], send_emails=False, group=None):
         """
         Invites a list of usernames to join a group
         Requires: Users to be invited must exist and not already be in the group
+        Invite emails are queued in the email outbox, so they are only sent if the invites are committed.
         """
-        for username in users_to_invite:
-            user = db.session.execute(select(User).where(User.username.ilike(username))).scalar()
-            if user is not None and user not in self.users and user not in self.invited_users:
-                self.invited_users.append(user)
-                if send_emails and group:
-                    threading.Thread(target=email_methods.send_group_invite_email,
-                                     args=(user, group)).start()
+        from api.util.email_outbox import queue_email
+        users = self._users_by_username(users_to_invite)
+        member_ids, invited_ids = self._member_ids(group_users), self._member_ids(group_invites)
+        new_invites = [user for user in users if user.id not in member_ids and user.id not in invited_ids]
+        if not new_invites:
+            return
+        db.session.execute(insert(group_invites), [dict(group_id=self.id, user_id=user.id) for user in new_invites])
+        self._members_changed(new_invites)
+        if send_emails and group:
+            for user in new_invites:
+                queue_email('group_invite', 'Happiness App Group Invite', user.email,
+                            user=dict(username=user.username), group=dict(name=group.name))
 
     def add_users(self, users_to_add: list[User]):
         """
         Adds a list of user objects to a group
         Requires: Users must already have been invited to the group
         """
-        for user in users_to_add:
-            if user in self.invited_users:
-                self.invited_users.remove(user)
-                self.users.append(user)
+        invited_ids = self._member_ids(group_invites)
+        new_member_ids = sorted({user.id for user in users_to_add if user.id in invited_ids})
+        if not new_member_ids:
+            return
+        db.session.execute(delete(group_invites).where(
+            group_invites.c.group_id == self.id, group_invites.c.user_id.in_(new_member_ids)))
+        db.session.execute(insert(group_users), [dict(group_id=self.id, user_id=user_id) for user_id in new_member_ids])
+        self._members_changed(users_to_add)
+        # the reloaded members include the new ones
+        self.membership_changed()
 
     def remove_users(self, users_to_remove: list[str]):
         """
         Removes a list of usernames from a group
         Requires: Users to be removed must exist and already be in or invited to the group
         """
-        for username in users_to_remove:
-            user = db.session.execute(select(User).where(User.username.ilike(username))).scalar()
-            if user is not None:
-                if user in self.users:
-                    self.users.remove(user)
-                elif user in self.invited_users:
-                    self.invited_users.remove(user)
+        users = self._users_by_username(users_to_remove)
+        member_ids, invited_ids = self._member_ids(group_users), self._member_ids(group_invites)
+        removed_member_ids = [user.id for user in users if user.id in member_ids]
+        removed_invite_ids = [user.id for user in users if user.id not in member_ids and user.id in invited_ids]
+        if removed_member_ids:
+            self.membership_changed()
+            db.session.execute(delete(group_users).where(
+                group_users.c.group_id == self.id, group_users.c.user_id.in_(removed_member_ids)))
+        if removed_invite_ids:
+            db.session.execute(delete(group_invites).where(
+                group_invites.c.group_id == self.id, group_invites.c.user_id.in_(removed_invite_ids)))
+        if removed_member_ids or removed_invite_ids:
+            self._members_changed(users)
+
+    @staticmethod
+    def _users_by_username(usernames: list[str]) -> list[User]:
+        """Returns the users with the given usernames (not case-sensitive), using the lower(username) index."""
+        if not usernames:
+            return []
+        return list(db.session.execute(
+            select(User).where(func.lower(User.username).in_({username.lower() for username in usernames}))
+        ).scalars())
+
+    def _member_ids(self, table) -> set[int]:
+        """Returns the IDs of the group's users (group_users) or invited users (group_invites)."""
+        # pending changes to the relationships must be in the table first, and new groups need an ID
+        db.session.flush()
+        return set(db.session.execute(select(table.c.user_id).where(table.c.group_id == self.id)).scalars())
+
+    def _members_changed(self, users: list[User]):
+        """Reloads the relationships changed by inserting into or deleting from the association tables."""
+        db.session.expire(self, ["users", "invited_users"])
+        for user in users:
+            db.session.expire(user, ["invites"])
 
 
 class Happiness(BaseModel):
@@ -273,11 +350,20 @@ class Happiness(BaseModel):
     Happiness model. Has a many-to-one relationship with users table.
     """
     __tablename__ = "happiness"
+    __table_args__ = (
+        # one entry per user per day (enforced for upserts); also covers the per-user
+        # date range, feed, and unread queries (value included for stats)
+        db.Index("ix_happiness_user_id_timestamp", "user_id", "timestamp", unique=True,
+                 postgresql_include=["value"]),
+        # serves the sync endpoint's "changed since" queries
+        db.Index("ix_happiness_user_id_updated_at", "user_id", "updated_at"),
+    )
     id = mapped_column(Integer, primary_key=True, autoincrement=True)
     user_id = mapped_column(Integer, ForeignKey("user.id"))
     value = mapped_column(Float)
     comment = mapped_column(String)
     timestamp = mapped_column(DateTime)
+    updated_at = mapped_column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
     author = relationship("User")
     discussion_comments = relationship("Comment", cascade='delete', lazy='dynamic')
@@ -304,6 +390,34 @@ class Happiness(BaseModel):
         db.session.commit()
 
 
+class HappinessRollup(BaseModel):
+    """
+    Happiness rollup model. Aggregates of a user's happiness values per day, week (starting on Monday),
+    or month, so statistics can be computed without scanning entries. Kept up to date by
+    rollup_dao.refresh_rollups whenever an entry changes.
+    """
+    __tablename__ = "happiness_rollup"
+    user_id = mapped_column(Integer, ForeignKey("user.id"), primary_key=True)
+    period = mapped_column(String, primary_key=True)
+    bucket = mapped_column(Date, primary_key=True)
+    count = mapped_column(Integer, nullable=False)
+    sum = mapped_column(Float, nullable=False)
+    sum_sq = mapped_column(Float, nullable=False)
+    min = mapped_column(Float, nullable=False)
+    max = mapped_column(Float, nullable=False)
+
+
+class Wrapped(BaseModel):
+    """
+    Wrapped model. A user's Happiness App Wrapped data for a year, stored as the serialized JSON
+    object from the Wrapped generation (see wrapped/create_wrapped.py). Loaded with `flask ingest-wrapped`.
+    """
+    __tablename__ = "wrapped"
+    year = mapped_column(Integer, primary_key=True)
+    user_id = mapped_column(Integer, ForeignKey("user.id", ondelete='cascade'), primary_key=True)
+    data = mapped_column(Text, nullable=False)
+
+
 class Comment(BaseModel):
     """
     Comment model. Has a many-to-one relationship with happiness table.
@@ -314,6 +428,7 @@ class Comment(BaseModel):
     user_id = mapped_column(ForeignKey("user.id"))
     text = mapped_column(String, nullable=False)
     timestamp = mapped_column(DateTime, nullable=False)
+    updated_at = mapped_column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
 
     author = relationship("User")
 
@@ -333,10 +448,14 @@ class Journal(BaseModel):
     Journal model. Has a many-to-one relationship with user table.
     """
     __tablename__ = "journal"
+    __table_args__ = (
+        db.Index("ix_journal_user_id_timestamp", "user_id", "timestamp", unique=True),
+    )
     id = mapped_column(Integer, primary_key=True, autoincrement=True)
     user_id = mapped_column(Integer, ForeignKey("user.id"))
     data = mapped_column(LargeBinary, nullable=False)
     timestamp = mapped_column(DateTime, nullable=False)
+    updated_at = mapped_column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
     def __init__(self, **kwargs):
         """
@@ -356,7 +475,7 @@ class Token(BaseModel):
     id = mapped_column(Integer, primary_key=True, autoincrement=True)
     user_id = mapped_column(Integer, ForeignKey("user.id"))
     session_token = mapped_column(String, nullable=False, unique=True)  # stored using hashing
-    session_expiration = mapped_column(DateTime, nullable=False)
+    session_expiration = mapped_column(DateTime, nullable=False, index=True)
 
     @staticmethod
     def hashed(user_id: int) -> tuple[Token, str]:
@@ -384,9 +503,85 @@ class Token(BaseModel):
     def revoke(self):
         """Expires a user's session token."""
         self.session_expiration = datetime.utcnow() - timedelta(seconds=1)
+        token_cache.invalidate(self.session_token)
 
     @staticmethod
     def clean():
         """Remove any tokens that have been expired for more than a day."""
         yesterday = datetime.utcnow() - timedelta(days=1)
         db.session.execute(delete(Token).where(Token.session_expiration < yesterday))
+        token_cache.clear()
+
+
+class Tombstone(BaseModel):
+    """
+    Tombstone model. Records the deletion of a happiness entry, comment, or read so that clients
+    can sync deletions (see the sync route). The owner is the user whose entry was deleted
+    (or commented on), or the reader for reads.
+    """
+    __tablename__ = "tombstone"
+    __table_args__ = (
+        db.Index("ix_tombstone_owner_id_deleted_at", "owner_id", "deleted_at"),
+    )
+    id = mapped_column(Integer, primary_key=True, autoincrement=True)
+    kind = mapped_column(String, nullable=False)
+    row_id = mapped_column(Integer, nullable=False)
+    owner_id = mapped_column(Integer, nullable=False)
+    deleted_at = mapped_column(DateTime, nullable=False, default=datetime.utcnow, index=True)
+
+    def __init__(self, **kwargs):
+        """
+        Initializes a Tombstone object.
+        Requires non-null kwargs: kind (happiness, comment, or read), row ID, and owner ID.
+        """
+        self.kind = kwargs.get("kind")
+        self.row_id = kwargs.get("row_id")
+        self.owner_id = kwargs.get("owner_id")
+
+    @staticmethod
+    def clean():
+        """Remove tombstones older than the sync retention period."""
+        retention = timedelta(days=current_app.config.get("SYNC_RETENTION_DAYS", 30))
+        db.session.execute(delete(Tombstone).where(Tombstone.deleted_at < datetime.utcnow() - retention))
+        db.session.commit()
+
+
+class OutboxEmail(BaseModel):
+    """
+    OutboxEmail model. An email waiting to be sent by the email outbox (see api.util.email_outbox),
+    stored as the name of its templates and their JSON context. Emails that fail too many times are
+    kept as dead letters.
+    """
+    __tablename__ = "email_outbox"
+    __table_args__ = (
+        db.Index("ix_email_outbox_dead_next_attempt", "dead", "next_attempt"),
+    )
+    id = mapped_column(Integer, primary_key=True, autoincrement=True)
+    template = mapped_column(String, nullable=False)
+    subject = mapped_column(String, nullable=False)
+    recipient = mapped_column(String, nullable=False)
+    context = mapped_column(Text, nullable=False)
+    attempts = mapped_column(Integer, nullable=False, default=0)
+    next_attempt = mapped_column(DateTime, nullable=False, default=datetime.utcnow)
+    error = mapped_column(String)
+    dead = mapped_column(Boolean, nullable=False, default=False)
+    created = mapped_column(DateTime, nullable=False, default=datetime.utcnow)
+
+
+# Deleted happiness entries and comments (including cascaded deletes) leave tombstones
+@event.listens_for(Happiness, "after_delete")
+def _happiness_deleted(mapper, connection, target):
+    connection.execute(insert(Tombstone).values(
+        kind="happiness", row_id=target.id, owner_id=target.user_id, deleted_at=datetime.utcnow()
+    ))
+
+
+@event.listens_for(Comment, "after_delete")
+def _comment_deleted(mapper, connection, target):
+    owner_id = connection.execute(
+        select(Happiness.user_id).where(Happiness.id == target.happiness_id)
+    ).scalar()
+    connection.execute(insert(Tombstone).values(
+        kind="comment", row_id=target.id, owner_id=owner_id if owner_id is not None else target.user_id,
+        deleted_at=datetime.utcnow()
+    ))
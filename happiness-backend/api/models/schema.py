@@ -1,11 +1,10 @@
 from apifairy.fields import FileField
-from marshmallow import post_dump, validates, ValidationError
+from marshmallow import validates, validates_schema, ValidationError, validate
 from flask import current_app
 
 from api.app import ma
-from api.authentication.auth import token_current_user
-from api.models.models import User, Group, Happiness, Setting, Comment, Journal
-from api.util.errors import failure_response
+from api.models.models import User, Group, Happiness, Setting, Comment, Journal, HappinessRollup
+from api.util.notifications import parse_notify_value
 
 
 class EmptySchema(ma.Schema):
@@ -29,6 +28,12 @@ class SettingInfoSchema(ma.Schema):
     enabled = ma.Bool(required=True)
     key = ma.Str(required=True)
 
+    @validates_schema
+    def validate_notify_value(self, data, **kwargs):
+        """Notify settings must be a UTC time and a timezone, e.g. '20:00 America/New_York'."""
+        if data.get("key") == "notify" and "value" in data and parse_notify_value(data["value"]) is None:
+            raise ValidationError("Must be a UTC time and a timezone ('HH:MM timezone').", "value")
+
 
 class UserSchema(ma.SQLAlchemySchema):
     class Meta:
@@ -114,6 +119,16 @@ class CommentSchema(ma.SQLAlchemySchema):
     timestamp = ma.Str(dump_only=True)
 
 
+class CommentGetSchema(ma.Schema):
+    page = ma.Int()
+    count = ma.Int(validate=validate.Range(min=1))
+    cursor = ma.Str()
+
+
+class NextCursorSchema(ma.Schema):
+    next_cursor = ma.Str(data_key='Next-Cursor')
+
+
 class CommentEditSchema(ma.Schema):
     data = ma.Str(required=True)
 
@@ -148,13 +163,15 @@ class HappinessGetTimeSchema(ma.Schema):
 
 class HappinessGetCountSchema(ma.Schema):
     page = ma.Int()
-    count = ma.Int()
+    count = ma.Int(validate=validate.Range(min=1))
+    cursor = ma.Str()
     id = ma.Int()
 
 
 class HappinessGetPaginatedSchema(ma.Schema):
     page = ma.Int()
-    count = ma.Int()
+    count = ma.Int(validate=validate.Range(min=1))
+    cursor = ma.Str()
 
 
 class GetByDateRangeSchema(ma.Schema):
@@ -182,19 +199,8 @@ class JournalSchema(ma.SQLAlchemySchema):
     data = ma.auto_field(required=True)
     timestamp = ma.Date(required=True)
 
-    @post_dump
-    def decrypt_entry(self, data, **kwargs):
-        try:
-            if self.context.get('password_key'):
-                decrypted = token_current_user().decrypt_data(
-                    self.context['password_key'], data['data'])
-                data['data'] = decrypted.decode('utf-8')
-        except Exception as e:
-            print(e)
-            return failure_response('Invalid password key.', 400)
-        return data
-
 
+# dumps entries decrypted with journal_crypto.decrypt_entries
 DecryptedJournalSchema = JournalSchema(many=True)
 
 
@@ -225,6 +231,73 @@ class ReadsSchema(ma.Schema):
     timestamp = ma.Str(dump_only=True, required=True)
 
 
+class SyncGetSchema(ma.Schema):
+    since = ma.DateTime()
+
+
+class DeletedSchema(ma.Schema):
+    class Meta:
+        ordered = True
+
+    happiness = ma.List(ma.Int(), required=True)
+    comments = ma.List(ma.Int(), required=True, attribute="comment")
+    reads = ma.List(ma.Int(), required=True, attribute="read")
+
+
+class SyncSchema(ma.Schema):
+    class Meta:
+        ordered = True
+
+    time = ma.DateTime(required=True)
+    user_ids = ma.List(ma.Int(), required=True)
+    happiness = ma.Nested(HappinessSchema, many=True, required=True)
+    comments = ma.Nested(CommentSchema, many=True, required=True)
+    reads = ma.List(ma.Int(), required=True)
+    deleted = ma.Nested(DeletedSchema, required=True)
+
+
+class StatsGetSchema(ma.Schema):
+    period = ma.Str(required=True, validate=validate.OneOf(["day", "week", "month"]))
+    start = ma.Date(required=True)
+    end = ma.Date()
+    id = ma.Int()
+
+
+class RollupSchema(ma.SQLAlchemySchema):
+    class Meta:
+        model = HappinessRollup
+        ordered = True
+
+    bucket = ma.auto_field(dump_only=True)
+    count = ma.auto_field(dump_only=True)
+    average = ma.Method("get_average", dump_only=True)
+    stddev = ma.Method("get_stddev", dump_only=True)
+    min = ma.auto_field(dump_only=True)
+    max = ma.auto_field(dump_only=True)
+
+    def get_average(self, obj):
+        return obj.sum / obj.count
+
+    def get_stddev(self, obj):
+        # population standard deviation
+        return max(obj.sum_sq / obj.count - (obj.sum / obj.count) ** 2, 0) ** 0.5
+
+
+class ExportSchema(ma.Schema):
+    format = ma.Str(load_default="csv", validate=validate.OneOf(["csv", "ndjson"]))
+    include = ma.List(ma.Str(validate=validate.OneOf(["comments", "reads", "journals"])), load_default=[])
+
+
+class ImportErrorSchema(ma.Schema):
+    line = ma.Int()
+    error = ma.Str()
+
+
+class ImportResultSchema(ma.Schema):
+    imported = ma.Int()
+    errors = ma.List(ma.Nested(ImportErrorSchema))
+
+
 class HappinessMultiFilterSchema(ma.Schema):
     user_id = ma.Int()
     page = ma.Int()
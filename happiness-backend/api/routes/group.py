@@ -7,11 +7,15 @@ from api.app import db
 from api.authentication.auth import token_current_user
 from api.dao.groups_dao import get_group_by_id
 from api.dao.happiness_dao import get_happiness_by_date_range, get_happiness_by_count, \
-    get_happiness_by_unread
+    get_happiness_by_cursor, get_happiness_by_unread, get_date_range_version, get_feed_version, \
+    get_unread_version
 from api.models.models import Group
 from api.models.schema import CreateGroupSchema, EditGroupSchema, GroupSchema, HappinessSchema, \
-    HappinessGetPaginatedSchema, GetByDateRangeSchema, UserGroupsSchema, EmptySchema
+    HappinessGetPaginatedSchema, GetByDateRangeSchema, UserGroupsSchema, EmptySchema, NextCursorSchema
 from api.routes.token import token_auth
+from api.util import email_executor, group_happiness_cache
+from api.util.cursor import cursor_headers
+from api.util.etag import etag
 from api.util.errors import failure_response
 
 group = Blueprint('group', __name__)
@@ -27,6 +31,29 @@ def check_group(cur_group, allow_invited=False):
             return failure_response('Not Allowed', 403)
 
 
+def group_member_ids(group_id):
+    """Returns the IDs of the members of a group, after making sure the user can view it."""
+    cur_group = get_group_by_id(group_id)
+    check_group(cur_group)
+    return [user.id for user in cur_group.users]
+
+
+def range_version(req, group_id):
+    user_ids = group_member_ids(group_id)
+    return user_ids, get_date_range_version(user_ids, req.get("start"), req.get("end", datetime.today().date()))
+
+
+def count_version(req, group_id):
+    user_ids = group_member_ids(group_id)
+    return user_ids, get_feed_version(user_ids)
+
+
+def unread_version(group_id):
+    user_ids = group_member_ids(group_id)
+    user_ids.remove(token_current_user().id)
+    return user_ids, get_unread_version(token_current_user().id, user_ids)
+
+
 @group.post('/')
 @authenticate(token_auth)
 @body(CreateGroupSchema)
@@ -41,6 +68,7 @@ def create_group(req):
 
     new_group = Group(name=req['name'])
     new_group.users.append(token_current_user())  # add group creator to group
+    new_group.membership_changed()
 
     db.session.add(new_group)
     db.session.commit()
@@ -119,6 +147,8 @@ def edit_group(req, group_id):
             db.session.delete(cur_group)
 
     db.session.commit()
+    if add_users is not None:
+        email_executor.drain_outbox_soon()
 
     return cur_group
 
@@ -139,6 +169,7 @@ def delete_group(group_id):
     check_group(cur_group)
 
     # deletes entry from group table and user entries from association table
+    cur_group.membership_changed()
     db.session.delete(cur_group)
     db.session.commit()
 
@@ -148,14 +179,15 @@ def delete_group(group_id):
 @group.get('/<int:group_id>/happiness')
 @authenticate(token_auth)
 @arguments(GetByDateRangeSchema)
+@etag(range_version)
 @response(HappinessSchema(many=True))
-@other_responses({404: 'Invalid Group', 403: 'Not Allowed'})
+@other_responses({404: 'Invalid Group', 403: 'Not Allowed', 304: 'Not Modified'})
 def group_happiness_range(req, group_id):
     """
     Get Group Happiness By Date Range
     Gets the happiness of values of a group between a specified start and end date (inclusive).
     User must be a full member of the group they are viewing. \n
-    See "Get Happiness by Date Range" for more details. \n
+    See "Get Happiness by Date Range" for more details (including conditional requests). \n
     Returns: List of all happiness entries from users in the group between start and end date in sequential order
     """
 
@@ -165,19 +197,26 @@ def group_happiness_range(req, group_id):
     today = datetime.today().date()
     start_date, end_date = req.get("start"), req.get("end", today)
 
-    return get_happiness_by_date_range(list(map(lambda x: x.id, cur_group.users)), start_date, end_date)
+    entries = group_happiness_cache.get(group_id, start_date, end_date)
+    if entries is None:
+        generation = group_happiness_cache.generation(group_id)
+        entries = get_happiness_by_date_range(list(map(lambda x: x.id, cur_group.users)), start_date, end_date)
+        group_happiness_cache.put(group_id, start_date, end_date, HappinessSchema(many=True).dump(entries),
+                                  generation)
+    return entries
 
 
 @group.get('/<int:group_id>/happiness/count')
 @authenticate(token_auth)
 @arguments(HappinessGetPaginatedSchema)
-@response(HappinessSchema(many=True))
-@other_responses({404: 'Invalid Group', 403: 'Not Allowed'})
+@etag(count_version)
+@response(HappinessSchema(many=True), headers=NextCursorSchema)
+@other_responses({404: 'Invalid Group', 403: 'Not Allowed', 400: 'Invalid cursor', 304: 'Not Modified'})
 def group_happiness_count(req, group_id):
     """
     Get Group Happiness By Count
-    Gets the specified number of happiness values of a group in reverse chronological order (paginated).
-    User must be a full member of the group they are viewing. \n
+    Gets the specified number of happiness values of a group in reverse chronological order (paginated
+    by page number or cursor). User must be a full member of the group they are viewing. \n
     See "Get Happiness by Count" for more details. \n
     Returns: List of all the specified happiness entries from users in the group in reverse order
     """
@@ -185,14 +224,19 @@ def group_happiness_count(req, group_id):
     cur_group = get_group_by_id(group_id)
     check_group(cur_group)
 
-    page, count = req.get("page", 1), req.get("count", 10)
-    return get_happiness_by_count(list(map(lambda x: x.id, cur_group.users)), page, count)
+    page, count = req.get("page"), req.get("count", 10)
+    user_ids = list(map(lambda x: x.id, cur_group.users))
+    if page is not None:
+        return get_happiness_by_count(user_ids, page, count)
+    entries, next_cursor = get_happiness_by_cursor(user_ids, count, req.get("cursor"))
+    return entries, cursor_headers(next_cursor)
 
 
 @group.get('/<int:group_id>/happiness/unread')
 @authenticate(token_auth)
+@etag(unread_version)
 @response(HappinessSchema(many=True))
-@other_responses({404: 'Invalid Group', 403: 'Not Allowed'})
+@other_responses({404: 'Invalid Group', 403: 'Not Allowed', 304: 'Not Modified'})
 def group_happiness_unread(group_id):
     """
     Get Group Happiness By Unread
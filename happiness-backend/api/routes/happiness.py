@@ -1,20 +1,29 @@
+import csv
+import io
 from datetime import datetime
 
-import requests
 from apifairy import authenticate, body, arguments, response, other_responses
-from flask import Blueprint, current_app
+from flask import Blueprint, current_app, request, stream_with_context
 
 from api.app import db
 from api.authentication.auth import token_current_user
-from api.dao import happiness_dao, users_dao
+from api.dao import happiness_dao, rollup_dao, wrapped_dao
+from api.dao.groups_dao import get_co_member_ids
 from api.dao.happiness_dao import get_happiness_by_id_or_date
-from api.dao.users_dao import get_user_by_id
-from api.models.models import Happiness, Comment
+from api.models.models import Comment
 from api.models.schema import HappinessSchema, HappinessEditSchema, HappinessGetTimeSchema, \
-    HappinessGetCountSchema, CommentSchema, DateIdGetSchema, HappinessMultiFilterSchema, CommentEditSchema, NumberSchema
+    HappinessGetCountSchema, CommentSchema, DateIdGetSchema, HappinessMultiFilterSchema, CommentEditSchema, NumberSchema, \
+    CommentGetSchema, NextCursorSchema, StatsGetSchema, RollupSchema, ImportResultSchema, \
+    ExportSchema
 from api.routes.token import token_auth
+from api.util import group_happiness_cache, unread_index
+from api.util.cursor import cursor_headers
+from api.util.etag import etag
+from api.util.export import stream_export, export_filename, FORMATS
+from api.util.happiness_import import import_happiness, read_rows
 from api.util.errors import failure_response
 from api.util.webhook import process_webhooks
+from config import Config
 
 happiness = Blueprint('happiness', __name__)
 
@@ -38,27 +47,45 @@ def create_happiness(req):
     today = datetime.today().date()
     value, comment, timestamp = req.get("value"), req.get("comment"), req.get("timestamp", today)
 
-    # overwrite entry if date already exists
-    happiness_obj = happiness_dao.get_happiness_by_date(current_user.id, timestamp)
-    if happiness_obj:
-        happiness_obj.comment = comment
-        happiness_obj.value = value
-        db.session.commit()
-        process_webhooks(current_user, happiness_obj, True)
-        return happiness_obj
-
     # validate happiness value
     if not (value * 2).is_integer() or value < 0 or value > 10:
         return failure_response("Invalid happiness value.", 400)
 
-    # create new entry
-    happiness = Happiness(user_id=current_user.id, value=value, comment=comment, timestamp=timestamp)
-    db.session.add(happiness)
+    # create new entry, or overwrite the entry if date already exists
+    happiness_obj, created = happiness_dao.upsert_happiness(current_user.id, timestamp, value, comment)
+    group_happiness_cache.entry_changed(current_user.id, timestamp)
+    if created:
+        unread_index.entry_created(happiness_obj.id, happiness_obj.timestamp, current_user.id,
+                                   get_co_member_ids(current_user.id))
+    rollup_dao.refresh_rollups(current_user.id, timestamp)
     db.session.commit()
 
-    process_webhooks(current_user, happiness)
+    process_webhooks(current_user, happiness_obj, on_edit=not created)
+
+    return happiness_obj
+
 
-    return happiness
+@happiness.post('/import')
+@authenticate(token_auth)
+@response(ImportResultSchema)
+@other_responses({400: "Malformed input."})
+def import_happiness_entries():
+    """
+    Import Happiness Entries
+    Creates or overwrites many of the current user's happiness entries at once (e.g. from a spreadsheet).
+    The request body is streamed as JSON lines (one entry object per line) or, with a text/csv
+    content type, as CSV with a header row. \n
+    Requires: Entries have a timestamp in the %Y-%m-%d format, a value between 0 and 10 in 0.5 increments,
+    and optionally a comment. \n
+    Returns: The number of imported entries, and the line number and error of every skipped entry.
+    """
+    fmt = "csv" if request.mimetype == "text/csv" else "jsonl"
+    try:
+        stream = io.TextIOWrapper(request.stream, encoding="utf-8", newline="" if fmt == "csv" else None)
+        return import_happiness(read_rows(stream, fmt), token_current_user().id)
+    except (UnicodeDecodeError, csv.Error):
+        db.session.rollback()
+        return failure_response("Malformed input.", 400)
 
 
 @happiness.put('/')
@@ -89,6 +116,8 @@ def edit_happiness(args, req):
             query_data.value = value
         if comment:
             query_data.comment = comment
+        group_happiness_cache.entry_changed(query_data.user_id, query_data.timestamp)
+        rollup_dao.refresh_rollups(query_data.user_id, query_data.timestamp)
         db.session.commit()
         process_webhooks(token_current_user(), query_data, True)
         return query_data
@@ -109,17 +138,40 @@ def delete_happiness(args):
     if query_data:
         if query_data.user_id != token_current_user().id:
             return failure_response("Not Allowed.", 403)
+        group_happiness_cache.entry_changed(query_data.user_id, query_data.timestamp)
+        unread_index.entry_deleted(query_data.id, query_data.user_id, get_co_member_ids(query_data.user_id))
         db.session.delete(query_data)
+        rollup_dao.refresh_rollups(query_data.user_id, query_data.timestamp)
         db.session.commit()
         return "", 204
     return failure_response("Happiness Not Found.", 404)
 
 
+def check_can_view(id: int):
+    """Makes sure the current user is the user with the given ID or shares a group with them."""
+    if token_current_user().id != id and not token_current_user().has_mutual_group_id(id):
+        return failure_response("Not Allowed.", 403)
+
+
+def date_range_version(req):
+    id = req.get("id", token_current_user().id)
+    check_can_view(id)
+    return happiness_dao.get_date_range_version([id], req.get("start"),
+                                                req.get("end", datetime.today().date()))
+
+
+def count_version(req):
+    id = req.get("id", token_current_user().id)
+    check_can_view(id)
+    return happiness_dao.get_feed_version([id])
+
+
 @happiness.get('/')
 @authenticate(token_auth)
 @arguments(HappinessGetTimeSchema)
+@etag(date_range_version)
 @response(HappinessSchema(many=True))
-@other_responses({403: "Not Allowed."})
+@other_responses({403: "Not Allowed.", 304: "Not Modified."})
 def get_happiness_date_range(req):
     """
     Get Happiness by Date Range
@@ -127,13 +179,14 @@ def get_happiness_date_range(req):
     End date defaults to today. User must share a group with the user they are viewing. \n
     Requires: Start date is provided and comes before the end date.
     Dates must be given in the YYYY-MM-DD format. \n
+    Supports conditional requests (`If-None-Match` with the `ETag` of a previous response). \n
     Returns: List of all happiness entries between start and end date in sequential order
     """
     user_id = token_current_user().id
     today = datetime.today().date()
     start, end, id = req.get("start"), req.get("end", today), req.get("id", user_id)
 
-    if user_id == id or token_current_user().has_mutual_group(users_dao.get_user_by_id(id)):
+    if user_id == id or token_current_user().has_mutual_group_id(id):
         return happiness_dao.get_happiness_by_date_range([id], start, end)
     return failure_response("Not Allowed.", 403)
 
@@ -141,23 +194,49 @@ def get_happiness_date_range(req):
 @happiness.get('/count')
 @authenticate(token_auth)
 @arguments(HappinessGetCountSchema)
-@response(HappinessSchema(many=True))
-@other_responses({403: "Not Allowed."})
+@etag(count_version)
+@response(HappinessSchema(many=True), headers=NextCursorSchema)
+@other_responses({403: "Not Allowed.", 400: "Invalid cursor.", 304: "Not Modified."})
 def get_paginated_happiness(req):
     """
     Get Happiness by Count
     Gets the specified number of happiness values in reverse chronological order.
     Requires: User must share a group with the user they are viewing. \n
-    Paginated based on page number and happiness entries per page. Defaults to page=1 and count=10. \n
+    Paginated based on happiness entries per page (defaults to count=10) and either a page number, or
+    the cursor returned in the `Next-Cursor` header of the previous page (recommended for deep pages).
+    Defaults to the first page. Supports conditional requests (see "Get Happiness by Date Range"). \n
     Returns: Specified happiness entries in reverse order.
     """
     user_id = token_current_user().id
-    page, count, id = req.get("page", 1), req.get("count", 10), req.get("id", user_id)
-    if user_id == id or token_current_user().has_mutual_group(users_dao.get_user_by_id(id)):
-        return happiness_dao.get_happiness_by_count([id], page, count)
+    page, count, id = req.get("page"), req.get("count", 10), req.get("id", user_id)
+    if user_id == id or token_current_user().has_mutual_group_id(id):
+        if page is not None:
+            return happiness_dao.get_happiness_by_count([id], page, count)
+        entries, next_cursor = happiness_dao.get_happiness_by_cursor([id], count, req.get("cursor"))
+        return entries, cursor_headers(next_cursor)
     return failure_response("Not Allowed.", 403)
 
 
+@happiness.get('/stats')
+@authenticate(token_auth)
+@arguments(StatsGetSchema)
+@response(RollupSchema(many=True))
+@other_responses({403: "Not Allowed."})
+def get_happiness_stats(req):
+    """
+    Get Happiness Stats
+    Gets happiness statistics (entry count, average, standard deviation, min, and max) of a given
+    user per day, week (starting on Monday), or month, between a specified start and end date (inclusive).
+    End date defaults to today. User must share a group with the user they are viewing. \n
+    Requires: period is one of day, week, or month. Dates must be given in the YYYY-MM-DD format. \n
+    Returns: Statistics of every day/week/month with entries in the date range, in sequential order
+    (identified by the first day of the day/week/month)
+    """
+    id = req.get("id", token_current_user().id)
+    check_can_view(id)
+    return rollup_dao.get_rollups(id, req.get("period"), req.get("start"), req.get("end", datetime.today().date()))
+
+
 @happiness.post('/<int:id>/comment')
 @authenticate(token_auth)
 @body(CommentSchema)
@@ -174,7 +253,7 @@ def create_comment(req, id):
     user_id = token_current_user().id
     happiness_obj = happiness_dao.get_happiness_by_id(id)
     if happiness_obj:
-        if token_current_user().has_mutual_group(users_dao.get_user_by_id(happiness_obj.user_id)):
+        if token_current_user().has_mutual_group_id(happiness_obj.user_id):
             comment = Comment(happiness_id=id, user_id=user_id, text=req.get("text"))
             db.session.add(comment)
             db.session.commit()
@@ -185,25 +264,26 @@ def create_comment(req, id):
 
 @happiness.get('/<int:id>/comments')
 @authenticate(token_auth)
-@response(CommentSchema(many=True))
-@other_responses({403: "Not Allowed.", 404: "Happiness Not Found."})
-def get_comments(id):
+@arguments(CommentGetSchema)
+@response(CommentSchema(many=True), headers=NextCursorSchema)
+@other_responses({403: "Not Allowed.", 404: "Happiness Not Found.", 400: "Invalid cursor."})
+def get_comments(req, id):
     """
     Get Discussion Comments
     Gets all the discussion comments for a happiness entry. \n
+    Optionally paginated by providing count (comments per page) along with either a page number or
+    the cursor returned in the `Next-Cursor` header of the previous page. \n
     Requires: User must share a group with the user who created the happiness entry. \n
     Returns: List of discussion comments in ascending timestamp order, only including the
     comments where the commenter shares a group with the current user
     """
     happiness_obj = happiness_dao.get_happiness_by_id(id)
     if happiness_obj:
-        if token_current_user().has_mutual_group(get_user_by_id(happiness_obj.user_id)):
+        if token_current_user().has_mutual_group_id(happiness_obj.user_id):
             # only show comments if the commenter shares a group with the current user
-            filtered = []
-            for comment in happiness_obj.discussion_comments:
-                if token_current_user().has_mutual_group(get_user_by_id(comment.user_id)):
-                    filtered.append(comment)
-            return filtered
+            comments, next_cursor = happiness_dao.get_visible_comments(
+                id, token_current_user().id, req.get("page"), req.get("count"), req.get("cursor"))
+            return comments, cursor_headers(next_cursor)
         return failure_response("Not Allowed.", 403)
     return failure_response("Happiness Not Found.", 404)
 
@@ -254,16 +334,37 @@ def delete_comment(id):
 
 @happiness.get('/export')
 @authenticate(token_auth)
-def export_happiness():
+@arguments(ExportSchema)
+def export_happiness(req):
     """
     Export Happiness
-    Exports a user's happiness, emailing the user with a CSV file attached, containing their comment, value, and timestamp.
+    Exports a user's happiness, emailing the user with a file attached, containing their comment, value, and timestamp.
+    Optional values: format (csv or ndjson, defaults to csv), include (any of comments, reads,
+    and journals; journals are exported encrypted)
     """
     current_user = token_current_user()
-    current_app.job_queue.enqueue("jobs.jobs.export_happiness", current_user.id)
+    current_app.job_queue.enqueue("jobs.jobs.export_happiness", current_user.id, req.get("format"),
+                                  tuple(req.get("include")))
     return "Happiness entries exported"
 
 
+@happiness.get('/export/download')
+@authenticate(token_auth)
+@arguments(ExportSchema)
+def download_happiness_export(req):
+    """
+    Download Happiness Export
+    Exports a user's happiness like Export Happiness, but streams the file as the response instead of emailing it. \n
+    Returns: The export file (as an attachment).
+    """
+    current_user = token_current_user()
+    fmt = req.get("format")
+    chunks = stream_export(current_user.id, fmt, tuple(req.get("include")))
+    response = current_app.response_class(stream_with_context(chunks), mimetype=FORMATS[fmt][0])
+    response.headers.set("Content-Disposition", "attachment", filename=export_filename(current_user.username, fmt))
+    return response
+
+
 @happiness.get('/search')
 @authenticate(token_auth)
 @arguments(HappinessMultiFilterSchema)
@@ -284,7 +385,7 @@ def multi_filter_search_happiness(req):
     text = req.get("text")
     page, count = req.get("page", 1), req.get("count", 10)
     if not (user_id == token_auth.current_user().id or
-            token_auth.current_user().has_mutual_group(users_dao.get_user_by_id(user_id))):
+            token_auth.current_user().has_mutual_group_id(user_id)):
         return failure_response("Not Allowed.", 403)
     return happiness_dao.get_happiness_by_filter(user_id, page, count, start, end, low, high, text)
 
@@ -307,7 +408,7 @@ def count_multi_filter_search_happiness(req):
     low, high = req.get("low"), req.get("high")
     text = req.get("text")
     if not (user_id == token_auth.current_user().id or
-            token_auth.current_user().has_mutual_group(users_dao.get_user_by_id(user_id))):
+            token_auth.current_user().has_mutual_group_id(user_id)):
         return failure_response("Not Allowed.", 403)
     return {"number": happiness_dao.get_num_happiness_by_filter(user_id, start, end, low, high, text)}
 
@@ -318,8 +419,11 @@ def count_multi_filter_search_happiness(req):
 def get_wrapped():
     """
     Get Happiness App Wrapped Data
+    Gets the current user's Happiness App Wrapped data for WRAPPED_YEAR. \n
+    Returns: The user's Wrapped data, or a failure response if they do not have any.
     """
-    all_wrapped_data = requests.get(current_app.config["WRAPPED_DATA_URL"]).json()
-    if str(token_current_user().id) in all_wrapped_data.keys():
-        return all_wrapped_data[str(token_auth.current_user().id)]
-    return failure_response("Not Allowed.", 400)
+    data = wrapped_dao.get_wrapped(token_current_user().id, Config.WRAPPED_YEAR)
+    if data is None:
+        return failure_response("Not Allowed.", 400)
+    # already serialized, so it is returned as is
+    return current_app.response_class(data, mimetype="application/json")
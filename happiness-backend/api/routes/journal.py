@@ -4,15 +4,17 @@ from api.app import db
 from api.authentication.auth import token_auth, token_current_user
 from api.dao import journal_dao
 from api.dao.journal_dao import get_entry_by_id_or_date
-from api.models.models import Journal
 from api.models.schema import (DateIdGetSchema, DecryptedJournalSchema,
                                EmptySchema, GetByDateRangeSchema,
                                GetPasswordKeySchema, JournalEditSchema,
                                JournalGetSchema, JournalSchema, NumberSchema,
                                PasswordKeyJWTSchema)
 from api.util.errors import failure_response
+from api.util.etag import etag
+from api.util.journal_crypto import journal_cipher, decrypt_entries
 from api.util.jwt_methods import verify_token
 from apifairy import arguments, authenticate, body, other_responses, response
+from cryptography.fernet import InvalidToken
 from flask import Blueprint
 
 journal = Blueprint('journal', __name__)
@@ -25,6 +27,32 @@ def get_verify_key_token(token: str) -> str:
     return payload['Password-Key']
 
 
+def get_cipher(headers):
+    password_key = get_verify_key_token(headers.get('key_token'))
+    try:
+        return journal_cipher(password_key)
+    except InvalidToken:
+        return failure_response('Invalid password key.', 400)
+
+
+def decrypt_or_fail(cipher, entries) -> list[dict]:
+    try:
+        return decrypt_entries(cipher, entries)
+    except InvalidToken:
+        return failure_response('Invalid password key.', 400)
+
+
+def entries_version(args, headers):
+    get_verify_key_token(headers.get('key_token'))
+    return journal_dao.get_journal_version(token_current_user().id)
+
+
+def date_range_version(args, headers):
+    get_verify_key_token(headers.get('key_token'))
+    return journal_dao.get_journal_version(token_current_user().id, args.get("start"),
+                                           args.get("end", datetime.today().date()))
+
+
 @journal.post('/key')
 @authenticate(token_auth)
 @body(GetPasswordKeySchema)
@@ -60,67 +88,54 @@ def create_entry(req, headers):
     If a journal already exists for that date, the data in the journal is overridden. \n
     Requires: the user's password key token for data encryption (provided by the `Get Password Key` endpoint)
     """
-    password_key = get_verify_key_token(headers.get('key_token'))
-    potential_journal = journal_dao.get_journal_by_date(
-        token_current_user().id, req.get('timestamp'))
-    if potential_journal:
-        potential_journal.data = token_current_user(
-        ).encrypt_data(password_key, req.get('data'))
-        db.session.commit()
-        return potential_journal
+    encrypted_data = get_cipher(headers).encrypt(bytes(req.get('data'), 'utf-8'))
 
-    try:
-        encrypted_data = token_current_user().encrypt_data(password_key, req.get('data'))
-        entry = Journal(user_id=token_current_user().id, encrypted_data=encrypted_data,
-                        timestamp=req.get('timestamp'))
-        db.session.add(entry)
-        db.session.commit()
-        return entry
-    except Exception as e:
-        print(e)
-        return failure_response('Invalid password key.', 400)
+    # create new entry, or overwrite the entry if date already exists
+    entry = journal_dao.upsert_journal(token_current_user().id, req.get('timestamp'), encrypted_data)
+    db.session.commit()
+    return entry
 
 
 @journal.get('/')
 @authenticate(token_auth)
 @arguments(JournalGetSchema)
 @arguments(PasswordKeyJWTSchema, location='headers')
+@etag(entries_version)
 @response(DecryptedJournalSchema)
-@other_responses({400: "Invalid password key."})
+@other_responses({400: "Invalid password key.", 304: "Not Modified."})
 def get_entries(args, headers):
     """
     Get Journal Entries
     Gets a specified number of journal entries in reverse order.
     Paginated based on page number and journal entries per page. Defaults to page=1 and count=10. \n
-    Requires: the user's password key token for data decryption (provided by the `Get Password Key` endpoint)
+    Requires: the user's password key token for data decryption (provided by the `Get Password Key` endpoint) \n
+    Supports conditional requests (`If-None-Match` with the `ETag` of a previous response).
     """
-    password_key = get_verify_key_token(headers.get('key_token'))
+    cipher = get_cipher(headers)
     page, count = args.get("page", 1), args.get("count", 10)
-
-    # add password key to schema context so entries can be decrypted
-    DecryptedJournalSchema.context['password_key'] = password_key
-    return journal_dao.get_entries_by_count(token_current_user().id, page, count)
+    return decrypt_or_fail(cipher, journal_dao.get_entries_by_count(token_current_user().id, page, count))
 
 
 @journal.get('/dates/')
 @authenticate(token_auth)
 @arguments(GetByDateRangeSchema)
 @arguments(PasswordKeyJWTSchema, location='headers')
+@etag(date_range_version)
 @response(DecryptedJournalSchema)
-@other_responses({400: "Invalid password key or date range"})
+@other_responses({400: "Invalid password key or date range", 304: "Not Modified"})
 def get_entries_by_date_range(args, headers):
     """
     Get Journals by Date Range
     Gets the journal entries between the start and end date (inclusive). \n
     Requires that start date is passed in, end date will default to today if not specified. \n
-    Requires the user's password key for data decryption (provided by the `Get Password Key` endpoint) 
+    Requires the user's password key for data decryption (provided by the `Get Password Key` endpoint) \n
+    Supports conditional requests (`If-None-Match` with the `ETag` of a previous response).
     """
     start, end = args.get("start"), args.get("end", datetime.today().date())
     user_id = token_current_user().id
-    password_key = get_verify_key_token(headers.get('key_token'))
-
-    DecryptedJournalSchema.context['password_key'] = password_key
-    return journal_dao.get_journal_by_date_range(user_id, start, end)
+    cipher = get_cipher(headers)
+    # large ranges are decrypted in parallel (see JOURNAL_DECRYPT_PARALLEL_MIN)
+    return decrypt_or_fail(cipher, journal_dao.get_journal_by_date_range(user_id, start, end))
 
 
 @journal.get('/dates/count/')
@@ -153,17 +168,13 @@ def edit_entry(args, headers, req):
     Modifies the journal entry corresponding to the provided ID with the given text. \n
     Requires: the user's password key token for data en/decryption (provided by the `Get Password Key` endpoint)
     """
-    password_key = get_verify_key_token(headers.get('key_token'))
+    cipher = get_cipher(headers)
     entry = get_entry_by_id_or_date(args)
     if not entry:
         return failure_response("Entry Not Found.", 404)
-    try:
-        entry.data = token_current_user().encrypt_data(password_key, req.get('data'))
-        db.session.commit()
-        return entry
-    except Exception as e:
-        print(e)
-        return failure_response('Invalid password key.', 400)
+    entry.data = cipher.encrypt(bytes(req.get('data'), 'utf-8'))
+    db.session.commit()
+    return entry
 
 
 @journal.delete('/')
@@ -40,7 +40,8 @@ from starlette.responses import JSONResponse
 from starlette.middleware.base import BaseHTTPMiddleware
 from sqlalchemy import select
 
-from api.dao import happiness_dao
+from api.authentication import token_cache
+from api.dao import happiness_dao, rollup_dao
 from api.models.models import Token
 from api.util.db_session import session_scope
 
@@ -114,12 +115,17 @@ def get_user_from_token(authorization_header: Optional[str]) -> Optional[int]:
     # Validate token using session_scope (works in ASGI context)
     session_token = parts[1]
     token_hash = hashlib.sha256(session_token.encode()).hexdigest()
+    user_id = token_cache.get_user_id(token_hash)
+    if user_id is not None:
+        return user_id
+
     with session_scope() as session:
         token = session.execute(
             select(Token).where(Token.session_token == token_hash)
         ).scalar()
 
         if token and token.verify():
+            token_cache.put(token_hash, token.user_id, token.session_expiration)
             return token.user_id
 
     return None
@@ -188,6 +194,45 @@ def create_mcp_server() -> FastMCP:
 
         return result
 
+    @mcp.tool()
+    def happiness_stats(period: str, start: str, end: str) -> dict:
+        """
+        Get happiness statistics per day, week (starting on Monday), or month between two dates (inclusive).
+
+        Args:
+            period: One of "day", "week", or "month"
+            start: Start date in YYYY-MM-DD format
+            end: End date in YYYY-MM-DD format
+
+        Returns:
+            Dictionary with the entry count, average, min, and max happiness value of each period
+        """
+        if period not in rollup_dao.PERIODS:
+            return {"error": "Period must be one of day, week, or month"}
+        try:
+            start_date = datetime.strptime(start, "%Y-%m-%d").date()
+            end_date = datetime.strptime(end, "%Y-%m-%d").date()
+        except ValueError as e:
+            return {"error": f"Invalid date format. Use YYYY-MM-DD. {str(e)}"}
+
+        # Get user_id from context variable (set by middleware)
+        user_id = _current_user_id.get()
+        with session_scope() as session:
+            rollups = rollup_dao.get_rollups(user_id, period, start_date, end_date, session=session)
+
+        return {
+            "periods": [
+                {
+                    "start": rollup.bucket.strftime("%Y-%m-%d"),
+                    "count": rollup.count,
+                    "average": round(rollup.sum / rollup.count, 2),
+                    "min": rollup.min,
+                    "max": rollup.max
+                }
+                for rollup in rollups
+            ]
+        }
+
     @mcp.tool()
     def happiness_search(
         text: Optional[str] = None,
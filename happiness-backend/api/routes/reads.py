@@ -4,8 +4,11 @@ from flask import Blueprint
 from api.app import db
 from api.authentication.auth import token_auth, token_current_user
 from api.dao import happiness_dao
-from api.models.models import Happiness
-from api.models.schema import CreateReadsSchema, HappinessSchema, HappinessGetPaginatedSchema
+from api.dao.groups_dao import get_co_member_ids
+from api.models.schema import CreateReadsSchema, HappinessSchema, HappinessGetPaginatedSchema, \
+    NextCursorSchema
+from api.util.cursor import cursor_headers
+from api.util.etag import etag
 from api.util.errors import failure_response
 
 reads = Blueprint('reads', __name__)
@@ -54,43 +57,40 @@ def mark_unread(req):
 @reads.get('/')
 @arguments(HappinessGetPaginatedSchema)
 @authenticate(token_auth)
-@response(HappinessSchema(many=True))
+@etag(lambda req: happiness_dao.get_read_happiness_version(token_current_user().id))
+@response(HappinessSchema(many=True), headers=NextCursorSchema)
+@other_responses({400: "Invalid cursor.", 304: "Not Modified."})
 def get_read_happiness(req):
     """
     Get Read Happiness
     Gets paginated list of all happiness entries that the user has read.
-    Optionally takes "page" and "count" in request body, which default to 1 and 10 respectively.
+    Optionally takes "count" (defaults to 10) and either "page" or the "cursor" returned in the
+    `Next-Cursor` header of the previous page. Defaults to the first page.
+    Supports conditional requests (`If-None-Match` with the `ETag` of a previous response).
     """
-    page, per_page = req.get("page", 1), req.get("count", 10)
+    page, per_page = req.get("page"), req.get("count", 10)
     user = token_current_user()
-    return user.posts_read.order_by(Happiness.timestamp.desc()).paginate(page=page, per_page=per_page, error_out=False)
+    if page is not None:
+        return happiness_dao.get_read_happiness_by_count(user.id, page, per_page)
+    entries, next_cursor = happiness_dao.get_read_happiness_by_cursor(user.id, per_page, req.get("cursor"))
+    return entries, cursor_headers(next_cursor)
+
+
+def friend_ids() -> list[int]:
+    # don't fetch posts made by current user
+    return list(get_co_member_ids(token_current_user().id) - {token_current_user().id})
 
 
 @reads.get("/unread/")
 @authenticate(token_auth)
+@etag(lambda: happiness_dao.get_unread_version(token_current_user().id, friend_ids()))
 @response(HappinessSchema(many=True))
+@other_responses({304: "Not Modified."})
 def get_unread_happiness():
     """
     Get Unread Happiness
     Gets a list of all happiness entries that the user has not read in the past week.
+    Supports conditional requests (`If-None-Match` with the `ETag` of a previous response).
     """
-    # Also I am aware that has_mutual_group exists, but we can't use that as a SQLAlchemy query,
-    # and we don't want to for loop through all happiness entries on the db.
-    current_user = token_current_user()
-
-    # use a set to avoid duplicates
-    friend_users = set()
-    user_groups = current_user.groups.all()
-
-    # For each group, get all happiness entries for that group in the past week
-    # Yes this is O(n^2), but even at full scale this should be at most 100 iterations
-    for g in user_groups:
-        for u in g.users:
-            friend_users.add(u.id)
-
-    # don't fetch posts made by current user
-    if len(user_groups) > 0:
-        friend_users.remove(current_user.id)
-
     # Find unread entries by selecting happiness with some criteria
-    return happiness_dao.get_happiness_by_unread(current_user.id, list(friend_users))
+    return happiness_dao.get_happiness_by_unread(token_current_user().id, friend_ids())
@@ -0,0 +1,56 @@
+from datetime import datetime, timedelta, timezone
+
+from apifairy import authenticate, arguments, response, other_responses
+from flask import Blueprint, current_app
+
+from api.authentication.auth import token_auth, token_current_user
+from api.dao import sync_dao
+from api.dao.groups_dao import get_co_member_ids
+from api.models.schema import SyncGetSchema, SyncSchema
+from api.util.errors import failure_response
+
+sync = Blueprint('sync', __name__)
+
+
+@sync.get('/')
+@authenticate(token_auth)
+@arguments(SyncGetSchema)
+@response(SyncSchema)
+@other_responses({410: "Too far behind, full sync required."})
+def get_changes(req):
+    """
+    Delta Sync
+    Gets everything that changed for the user since the given time: the happiness entries
+    (and discussion comments) of the user and everyone they share a group with that were created or
+    edited, the happiness entries the user read, and the IDs of everything that was deleted. \n
+    Omit `since` to get everything (a full sync). Pass the returned `time` as `since` in the next request.
+    The returned time is SYNC_OVERLAP_SECONDS before the sync, so changes committed while it ran are not
+    missed, and some changes may be returned again (clients should replace items by ID).
+    If `user_ids` changed since the last sync (someone joined or left a group), clients should drop the
+    data of users that are no longer listed and do a full sync. \n
+    Requires: since is an ISO 8601 datetime within the last SYNC_RETENTION_DAYS days
+    (deletions are not remembered for longer), otherwise a full sync is required.
+    """
+    # taken before querying, so changes made while this request runs are included in the next sync
+    now = datetime.utcnow()
+    # updated_at is stamped when a change is flushed, not committed, so changes committed after this
+    # sync may have older timestamps: the next sync starts a little earlier to include them
+    next_since = now - timedelta(seconds=current_app.config.get("SYNC_OVERLAP_SECONDS", 0))
+    since = req.get("since")
+    if since is not None:
+        if since.tzinfo is not None:
+            since = since.astimezone(timezone.utc).replace(tzinfo=None)
+        if since < now - timedelta(days=current_app.config.get("SYNC_RETENTION_DAYS", 30)):
+            return failure_response("Too far behind, full sync required.", 410)
+
+    user_id = token_current_user().id
+    user_ids = sorted(get_co_member_ids(user_id) | {user_id})
+    return {
+        "time": next_since,
+        "user_ids": user_ids,
+        "happiness": sync_dao.get_changed_happiness(user_ids, since),
+        "comments": sync_dao.get_changed_comments(user_ids, since),
+        "reads": sync_dao.get_changed_read_ids(user_id, since),
+        "deleted": sync_dao.get_deleted_ids(user_id, user_ids, since) if since is not None
+        else {"happiness": [], "comment": [], "read": []},
+    }
@@ -6,7 +6,6 @@ from flask import Blueprint, request
 from api.app import db
 from api.authentication.auth import basic_auth, token_auth
 from api.dao.users_dao import get_token
-from api.models.models import Token
 from api.models.schema import TokenSchema
 from api.util.errors import failure_response
 
@@ -30,7 +29,7 @@ def new_token():
     if user.encrypted_key is None:
         user.e2e_init(request.authorization.password)
 
-    Token.clean()
+    # expired tokens are deleted by the clean_tokens job
     db.session.commit()
 
     return {'session_token': token}
@@ -1,4 +1,3 @@
-import threading
 import uuid
 from datetime import datetime
 
@@ -9,17 +8,21 @@ from flask import Blueprint
 from flask import current_app
 
 from api.app import db
+from api.authentication import token_cache
 from api.authentication.auth import token_current_user
+from api.dao.groups_dao import get_co_member_ids, invalidate_co_member_ids
 from api.dao.users_dao import get_user_by_email
 from api.util.jwt_methods import verify_token
-from api.dao import users_dao, happiness_dao
+from api.dao import users_dao, rollup_dao
 from api.models.models import User, Setting, Happiness, Journal
 from api.models.schema import UserSchema, CreateUserSchema, SettingsSchema, SettingInfoSchema, \
     UserInfoSchema, EmailSchema, SimpleUserSchema, EmptySchema, PasswordResetSchema, \
     FileUploadSchema, AmountSchema, CountSchema, UserDeleteSchema, JournalEditSchema
 from api.routes.token import token_auth
-from api.util import email_methods
+from api.util import email_executor, email_methods, group_happiness_cache
+from api.util.email_outbox import queue_email
 from api.util.errors import failure_response
+from api.util.notifications import update_notification_schedule
 
 user = Blueprint('user', __name__)
 
@@ -111,8 +114,12 @@ def delete_user(req):
     for journal_record in journal_records:
         db.session.delete(journal_record)
 
+    invalidate_co_member_ids(get_co_member_ids(current_user.id))
+    group_happiness_cache.groups_changed([group.id for group in current_user.groups])
+    rollup_dao.delete_rollups(current_user.id)
     db.session.delete(current_user)
     db.session.commit()
+    token_cache.invalidate_user(current_user.id)
     return '', 204
 
 
@@ -126,6 +133,7 @@ def add_user_setting(req):
     Add Settings
     Adds a setting to the current user's property bag. \n
     If the setting already exists in the property bag, it can enable or disable the setting. \n
+    The value of the "notify" setting must be a UTC time and a timezone, e.g. "20:00 America/New_York". \n
     Returns: A JSON success response that contains the added setting, or a failure response.
     """
     current_user = token_current_user()
@@ -140,12 +148,16 @@ def add_user_setting(req):
             new_setting = Setting(key=key, enabled=enabled,
                                   value=value, user_id=current_user.id)
         db.session.add(new_setting)
+        if key == "notify":
+            update_notification_schedule(new_setting)
         db.session.commit()
         return new_setting
 
     old_setting.enabled = enabled
     if value is not None:
         old_setting.value = value
+    if key == "notify":
+        update_notification_schedule(old_setting)
     db.session.commit()
     return old_setting
 
@@ -196,6 +208,8 @@ def change_user_info(req):
             return failure_response("Provide data already exists", 400)
 
         current_user.username = new_username
+        # cached group happiness embeds the author's username
+        group_happiness_cache.groups_changed([group.id for group in current_user.groups])
     elif data_type == "email":
         # Changes a user's email, which requires their email to be unique.
         new_email = req.get("data")
@@ -259,7 +273,7 @@ def reset_password(req, token):
 @user.post('/initiate_password_reset/')
 @body(EmailSchema)
 @response(EmptySchema, 204, 'Password reset email sent')
-@other_responses({400: "User associated with email address not found"})
+@other_responses({400: "User associated with email address not found", 503: "Too many emails being sent"})
 def send_reset_password_email(req):
     """
     Send Reset Password Email
@@ -269,8 +283,8 @@ def send_reset_password_email(req):
     user_by_email = users_dao.get_user_by_email(req.get("email"))
     if user_by_email is None:
         return failure_response("User associated with email address not found", 400)
-    threading.Thread(target=email_methods.send_password_reset_email,
-                     args=(user_by_email,)).start()
+    if not email_executor.submit(email_methods.send_password_reset_email, user_by_email):
+        return failure_response("Too many emails are being sent, please try again later.", 503)
     return '', 204
 
 
@@ -332,6 +346,8 @@ def add_pfp(req):
     img_url = (f"https://{current_app.config['AWS_BUCKET_NAME']}.s3." +
                f"{current_app.config['AWS_REGION']}.amazonaws.com/{file_name}")
     current_user.profile_picture = img_url
+    # cached group happiness embeds the author's profile picture
+    group_happiness_cache.groups_changed([group.id for group in current_user.groups])
     db.session.commit()
 
     return current_user
@@ -349,10 +365,10 @@ def profile_stats(req):
     """
     user_id = req.get("user_id", token_current_user().id)
     if not (user_id == token_current_user().id or
-            token_current_user().has_mutual_group(users_dao.get_user_by_id(user_id))):
+            token_current_user().has_mutual_group_id(user_id)):
         return failure_response("Not Allowed.", 403)
     num_groups = users_dao.get_user_by_id(user_id).groups.count()
-    return {"entries": happiness_dao.get_num_of_entries(user_id, low=0, high=10), "groups": num_groups}
+    return {"entries": rollup_dao.get_entry_count(user_id), "groups": num_groups}
 
 
 @user.post('/nudge/')
@@ -364,8 +380,10 @@ def nudge_user(req):
     Send an email to invite a non-registered user to create an account
     """
     if not get_user_by_email(req.get("email")):
-        threading.Thread(target=email_methods.send_nudge_email,
-                         args=(req.get("email"), token_current_user())).start()
+        queue_email("nudge_user", "You've Been Invited to Join Happiness App!", req.get("email"),
+                    user=dict(username=token_current_user().username), email=req.get("email"))
+        db.session.commit()
+        email_executor.drain_outbox_soon()
         return "", 204
     return failure_response("User already exists.", 400)
 
@@ -414,5 +432,5 @@ def nudge_user(req):
 #     """
 #     for active_user in users_dao.get_active_users():
 #         print(active_user.username)
-#         threading.Thread(target=email_methods.send_wrapped_email, args=(active_user,)).start()
+#         email_executor.submit(email_methods.send_wrapped_email, active_user)
 #     return "", 204
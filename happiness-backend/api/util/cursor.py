@@ -0,0 +1,34 @@
+"""
+Opaque cursors for keyset pagination.
+
+A cursor encodes the sort key of the last item on a page, so the next page can be fetched with a
+WHERE clause on the sort key instead of an OFFSET.
+"""
+import base64
+import json
+from datetime import datetime
+
+from api.util.errors import failure_response
+
+
+def encode_cursor(timestamp: datetime, tiebreaker: int) -> str:
+    """Encodes the (timestamp, tiebreaker) sort key of the last item on a page."""
+    payload = json.dumps([timestamp.isoformat(), tiebreaker])
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> tuple[datetime, int]:
+    """Decodes a cursor created by encode_cursor, aborting with a 400 error if it is invalid."""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        timestamp, tiebreaker = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        return datetime.fromisoformat(timestamp), int(tiebreaker)
+    except (ValueError, TypeError):
+        return failure_response("Invalid cursor.", 400)
+
+
+def cursor_headers(next_cursor: str) -> dict:
+    """Response headers for returning the cursor of the next page (if any) to the client."""
+    if next_cursor is None:
+        return {}
+    return {'Next-Cursor': next_cursor, 'Access-Control-Expose-Headers': 'Next-Cursor'}
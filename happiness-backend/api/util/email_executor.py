@@ -0,0 +1,150 @@
+"""
+Bounded in-process executor for sending emails in the background.
+
+Emails are sent on a shared pool of EMAIL_WORKERS threads (each running in an app context) instead of
+a new thread per email. At most EMAIL_QUEUE_SIZE tasks can be queued or running: submit waits up to
+EMAIL_SUBMIT_TIMEOUT seconds for room and is rejected after that, so a burst of requests cannot exhaust
+the worker's memory, threads, or SMTP connections. Queued tasks are finished before the process exits.
+With EMAIL_WORKERS = 0 (e.g. in tests) tasks run in the calling thread.
+
+Requests that queue emails in the email outbox call drain_outbox_soon after committing them, so they
+are sent right away on the pool (at most one drain is queued at a time; the scheduled drain sends
+anything missed). The queue depth of each process with tasks pending is kept in Redis (like the KDF
+pool's, see kdf.py) and can be viewed with `flask email-stats`.
+"""
+import atexit
+import os
+import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional
+
+import click
+import redis
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import select, func
+
+from api.app import db
+from api.models.models import OutboxEmail
+from api.util import email_outbox
+
+DEPTH_KEY = "email_executor:queue_depth"
+DEPTH_TTL = 60 * 60
+
+_executor: Optional[ThreadPoolExecutor] = None
+_executor_pid: Optional[int] = None
+_slots: Optional[threading.BoundedSemaphore] = None
+_lock = threading.Lock()
+# held while publishing, so the depths are published in order
+_depth_lock = threading.Lock()
+_depth = 0
+_drain_queued = False
+
+
+def _get_executor(workers: int, queue_size: int) -> ThreadPoolExecutor:
+    global _executor, _executor_pid, _slots
+    with _lock:
+        # threads do not survive forking (e.g. preloaded gunicorn workers)
+        if _executor is None or _executor_pid != os.getpid():
+            _executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="email")
+            _executor_pid = os.getpid()
+            _slots = threading.BoundedSemaphore(queue_size)
+        return _executor
+
+
+def queue_depth() -> int:
+    """Returns the number of this process's tasks that are queued or running on the executor."""
+    with _depth_lock:
+        return _depth
+
+
+def _track(client: redis.Redis, delta: int):
+    global _depth
+    with _depth_lock:
+        _depth += delta
+        try:
+            pipe = client.pipeline()
+            process = f"{socket.gethostname()}:{os.getpid()}"
+            if _depth:
+                pipe.hset(DEPTH_KEY, process, _depth)
+            else:
+                pipe.hdel(DEPTH_KEY, process)
+            pipe.expire(DEPTH_KEY, DEPTH_TTL)
+            pipe.execute()
+        except redis.RedisError:
+            pass
+
+
+def submit(fn: Callable, *args, block: bool = True) -> bool:
+    """
+    Runs fn(*args) in an app context on the executor. Returns False (without running it) if the executor
+    stays full for EMAIL_SUBMIT_TIMEOUT seconds, or immediately if not block.
+    """
+    app = current_app._get_current_object()
+    workers = app.config.get("EMAIL_WORKERS", 0)
+    if not workers:
+        fn(*args)
+        return True
+
+    executor = _get_executor(workers, app.config.get("EMAIL_QUEUE_SIZE", 100))
+    slots = _slots
+    if not slots.acquire(blocking=block, timeout=app.config.get("EMAIL_SUBMIT_TIMEOUT", 5) if block else None):
+        return False
+    _track(app.redis, 1)
+
+    def run():
+        try:
+            with app.app_context():
+                fn(*args)
+        except Exception:
+            app.logger.exception("Background email task failed")
+        finally:
+            slots.release()
+            _track(app.redis, -1)
+
+    executor.submit(run)
+    return True
+
+
+def _drain_outbox():
+    global _drain_queued
+    with _lock:
+        _drain_queued = False
+    email_outbox.drain_all()
+
+
+def drain_outbox_soon():
+    """Drains the email outbox on the executor, unless a drain is already queued or the executor is disabled."""
+    global _drain_queued
+    if not current_app.config.get("EMAIL_WORKERS", 0):
+        return
+    with _lock:
+        if _drain_queued:
+            return
+        _drain_queued = True
+    if not submit(_drain_outbox, block=False):
+        # the scheduled drain will send the emails
+        with _lock:
+            _drain_queued = False
+
+
+@atexit.register
+def shutdown():
+    """Waits for the queued tasks to finish."""
+    if _executor is not None and _executor_pid == os.getpid():
+        _executor.shutdown(wait=True)
+
+
+@click.command("email-stats")
+@with_appcontext
+def email_stats():
+    """Print the email executor queue depth of every process and the email outbox size."""
+    depths = {key.decode(): int(value) for key, value in current_app.redis.hgetall(DEPTH_KEY).items()}
+    for process, depth in sorted(depths.items()):
+        click.echo(f"{process}: {depth}")
+    pending, dead = [
+        db.session.scalar(select(func.count()).select_from(OutboxEmail).where(OutboxEmail.dead.is_(is_dead)))
+        for is_dead in (False, True)
+    ]
+    click.echo(f"queue depth: {sum(depths.values())}, outbox: {pending} pending, {dead} dead letters")
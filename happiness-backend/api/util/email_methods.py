@@ -50,32 +50,6 @@ def send_password_reset_email(user):
                           html_body=render_template('reset_password.html', user=user, token=token))
 
 
-def send_group_invite_email(user, group):
-    """
-    Sends an email telling a user they have been invited to a group.
-    """
-    with my_app.app_context():
-        send_email_helper('Happiness App Group Invite',
-                          sender="noreply@happinessapp.org",
-                          recipients=[user.email],
-                          text_body=render_template(
-                              'group_invite.txt', user=user, group=group),
-                          html_body=render_template('group_invite.html', user=user, group=group))
-
-
-def send_nudge_email(email, user):
-    """
-    Sends an email inviting a non-registered user to create an account.
-    """
-    with my_app.app_context():
-        send_email_helper("You've Been Invited to Join Happiness App!",
-                          sender="noreply@happinessapp.org",
-                          recipients=[email],
-                          text_body=render_template(
-                              'nudge_user.txt', user=user, email=email),
-                          html_body=render_template('nudge_user.html', user=user, email=email))
-
-
 def send_wrapped_email(user):
     with my_app.app_context():
         wrapped_year = Config.WRAPPED_YEAR
@@ -0,0 +1,173 @@
+"""
+Email outbox.
+
+Emails are queued as rows of the email_outbox table (in the same transaction as the change that
+causes them, e.g. a group invite) and sent in batches by drain, which reuses one SMTP connection
+for a whole batch instead of connecting for every message. Each template is loaded once per batch
+and rendered with each email's context.
+
+A drain claims its batch by leasing the emails (moving their next attempt LEASE into the future) and
+committing, so concurrent drains skip them without any rows being locked while the emails are sent.
+If a drain dies, its emails are retried once the lease expires.
+
+Emails that fail to send are retried with exponential backoff, and become dead letters (kept in the
+table with their last error) after MAX_ATTEMPTS failures, or at once if the recipient is permanently
+refused (5xx).
+The outbox is drained every minute by a scheduled job, or with `flask drain-outbox`.
+"""
+import json
+import smtplib
+from datetime import datetime, timedelta
+
+import click
+import jinja2
+from flask import current_app
+from flask.cli import with_appcontext
+from flask_mail import Message
+from sqlalchemy import select, update, delete, func
+
+from api.app import db
+from api.models.models import OutboxEmail
+from api.util import email_methods
+
+SENDER = "noreply@happinessapp.org"
+BATCH_SIZE = 200
+MAX_ATTEMPTS = 5
+RETRY_DELAY = timedelta(minutes=5)
+# longer than a batch takes to send
+LEASE = timedelta(minutes=15)
+
+
+def queue_email(template: str, subject: str, recipient: str, **context):
+    """
+    Adds an email to the outbox, rendered from the given template ('{template}.txt' and '{template}.html')
+    with the given JSON serializable context. Does not commit.
+    """
+    db.session.add(OutboxEmail(template=template, subject=subject, recipient=recipient,
+                               context=json.dumps(context)))
+
+
+def _template_renderer():
+    templates = {}
+
+    def render(name: str, context: dict) -> str:
+        if name not in templates:
+            templates[name] = current_app.jinja_env.get_template(name)
+        return templates[name].render(**context)
+
+    return render
+
+
+def _failed(email, error: Exception, now: datetime, permanent: bool = False):
+    attempts = email.attempts + 1
+    values = dict(attempts=attempts, error=f"{type(error).__name__}: {error}"[:500])
+    if permanent or attempts >= MAX_ATTEMPTS:
+        values["dead"] = True
+    else:
+        values["next_attempt"] = now + RETRY_DELAY * 2 ** (attempts - 1)
+    db.session.execute(update(OutboxEmail).where(OutboxEmail.id == email.id).values(**values))
+
+
+def _claim(now: datetime, batch_size: int) -> list:
+    """Leases a batch of the due emails to this drain and commits. Returns their rows, oldest first."""
+    due = (
+        select(OutboxEmail.id).where(OutboxEmail.dead.is_(False), OutboxEmail.next_attempt <= now)
+        .order_by(OutboxEmail.id).limit(batch_size).with_for_update(skip_locked=True)
+    )
+    rows = db.session.execute(
+        update(OutboxEmail).where(OutboxEmail.id.in_(due)).values(next_attempt=now + LEASE)
+        .returning(OutboxEmail.id, OutboxEmail.template, OutboxEmail.subject, OutboxEmail.recipient,
+                   OutboxEmail.context, OutboxEmail.attempts)
+    ).all()
+    db.session.commit()
+    return sorted(rows)
+
+
+def _release(emails: list, now: datetime):
+    """Ends the lease of emails that were not attempted, so the next drain sends them."""
+    if emails:
+        db.session.execute(update(OutboxEmail).where(OutboxEmail.id.in_([email.id for email in emails]))
+                           .values(next_attempt=now))
+
+
+def drain(batch_size: int = BATCH_SIZE) -> tuple[int, int]:
+    """
+    Sends a batch of the due emails in the outbox over one SMTP connection.
+    Returns the number of emails sent and failed. Raises an error (leaving the emails in the outbox)
+    if the SMTP server cannot be connected to.
+    """
+    now = datetime.utcnow()
+    emails = _claim(now, batch_size)
+    if not emails:
+        return 0, 0
+
+    render = _template_renderer()
+    sent_ids = []
+    attempted = failed = 0
+    try:
+        with email_methods.mail.connect() as connection:
+            for email in emails:
+                attempted += 1
+                try:
+                    context = json.loads(email.context)
+                    message = Message(email.subject, sender=SENDER, recipients=[email.recipient],
+                                      body=render(f"{email.template}.txt", context),
+                                      html=render(f"{email.template}.html", context))
+                    connection.send(message)
+                except smtplib.SMTPRecipientsRefused as e:
+                    # temporary (4xx) refusals, e.g. greylisting, are retried
+                    _failed(email, e, now, permanent=all(code >= 500 for code, _ in e.recipients.values()))
+                    failed += 1
+                except (jinja2.TemplateError, ValueError) as e:
+                    # will never succeed
+                    _failed(email, e, now, permanent=True)
+                    failed += 1
+                except smtplib.SMTPServerDisconnected as e:
+                    # the rest of the batch is sent by the next drain
+                    _failed(email, e, now)
+                    failed += 1
+                    break
+                except (smtplib.SMTPException, OSError) as e:
+                    _failed(email, e, now)
+                    failed += 1
+                else:
+                    sent_ids.append(email.id)
+    except smtplib.SMTPServerDisconnected:
+        # raised when closing a connection that was dropped
+        pass
+    except (smtplib.SMTPException, OSError):
+        if not attempted:
+            # could not connect
+            _release(emails, now)
+            db.session.commit()
+            raise
+    db.session.execute(delete(OutboxEmail).where(OutboxEmail.id.in_(sent_ids)))
+    _release(emails[attempted:], now)
+    db.session.commit()
+    return len(sent_ids), failed
+
+
+def drain_all(batch_size: int = BATCH_SIZE) -> tuple[int, int]:
+    """Drains the outbox until no due emails are left. Returns the number of emails sent and failed."""
+    total_sent = total_failed = 0
+    while True:
+        sent, failed = drain(batch_size)
+        total_sent += sent
+        total_failed += failed
+        if sent + failed < batch_size:
+            return total_sent, total_failed
+
+
+@click.command("drain-outbox")
+@click.option("--batch-size", type=int, default=BATCH_SIZE, show_default=True)
+@click.option("--retry-dead", is_flag=True, help="Retry the dead letters.")
+@with_appcontext
+def drain_outbox(batch_size, retry_dead):
+    """Send the due emails in the email outbox."""
+    if retry_dead:
+        db.session.execute(update(OutboxEmail).where(OutboxEmail.dead.is_(True))
+                           .values(dead=False, attempts=0, next_attempt=datetime.utcnow()))
+        db.session.commit()
+    sent, failed = drain_all(batch_size)
+    dead = db.session.scalar(select(func.count()).select_from(OutboxEmail).where(OutboxEmail.dead.is_(True)))
+    click.echo(f"Sent {sent} emails, {failed} failed ({dead} dead letters)")
@@ -0,0 +1,43 @@
+"""
+Conditional GET support (ETag / If-None-Match) for read endpoints.
+
+Instead of hashing the serialized response, each endpoint provides a cheap version of the data it
+returns (e.g. the count, max ID and max updated_at of the entries in the requested range), so
+unchanged responses can be answered with `304 Not Modified` without loading or serializing anything.
+"""
+import hashlib
+from functools import wraps
+
+from flask import make_response, request
+
+from api.authentication.auth import token_current_user
+
+
+def etag(version):
+    """
+    Makes an endpoint conditional. version is called with the same arguments as the endpoint and
+    returns a version of its response (it can also abort, e.g. if the user is not allowed to view it).
+    Must be placed directly above the endpoint's @response decorator (below @arguments).
+    ETags are weak, as the version does not cover every detail of the response (e.g. author usernames).
+    """
+
+    def decorator(f):
+        @wraps(f)
+        def _etag(*args, **kwargs):
+            # versions are only meaningful for the exact request they were computed for
+            key = repr((token_current_user().id, request.full_path, version(*args, **kwargs)))
+            tag = hashlib.sha1(key.encode()).hexdigest()
+
+            if request.if_none_match.contains_weak(tag):
+                response = make_response('', 304)
+            else:
+                response = make_response(f(*args, **kwargs))
+            response.set_etag(tag, weak=True)
+            # allow caching, but always revalidate
+            response.cache_control.private = True
+            response.cache_control.no_cache = True
+            return response
+
+        return _etag
+
+    return decorator
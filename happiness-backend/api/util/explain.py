@@ -0,0 +1,102 @@
+"""
+Index advisor for the hot DAO queries.
+
+Runs each DAO query against the configured database, captures the SQL it emits, and prints the
+query plan for every statement. Statements whose plan contains a full table scan are flagged,
+which usually means an index is missing or cannot be used for that query.
+
+Usage: `flask explain-queries [--user-id ID]`
+"""
+from datetime import datetime, timedelta
+
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import event, select
+
+from api.app import db
+from api.util.cursor import encode_cursor
+
+
+def _dao_queries(user_id: int) -> dict:
+    """Returns a mapping of query name -> callable that runs the DAO query being checked."""
+    from api.dao import happiness_dao, journal_dao
+    from api.models.models import Token
+
+    today = datetime.today()
+    last_week = today - timedelta(weeks=1)
+    return {
+        "happiness_dao.get_happiness_by_date_range":
+            lambda: happiness_dao.get_happiness_by_date_range([user_id], last_week, today),
+        "happiness_dao.get_happiness_by_count":
+            lambda: happiness_dao.get_happiness_by_count([user_id], 1, 10),
+        "happiness_dao.get_happiness_by_cursor":
+            lambda: happiness_dao.get_happiness_by_cursor(
+                [user_id], 10, encode_cursor(today, user_id)),
+        "happiness_dao.get_happiness_by_unread":
+            lambda: happiness_dao.get_happiness_by_unread(user_id, [user_id]),
+        "journal_dao.get_entries_by_count":
+            lambda: journal_dao.get_entries_by_count(user_id, 1, 10),
+        "Token.clean": Token.clean,
+    }
+
+
+def _capture_statements(query) -> list[tuple[str, object]]:
+    """Runs a DAO query and returns the (statement, parameters) pairs it sent to the database."""
+    captured = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        captured.append((statement, parameters))
+
+    engine = db.engine
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        query()
+    finally:
+        event.remove(engine, "before_cursor_execute", before_cursor_execute)
+        db.session.rollback()  # never persist side effects (e.g. Token.clean)
+    return captured
+
+
+def _explain(statement: str, parameters) -> tuple[list[str], bool]:
+    """
+    Returns the plan lines for a statement and whether the plan contains a sequential scan.
+    On Postgres, sequential scans are disabled for the transaction so that a reported seq scan
+    means no index can serve the query (rather than the planner preferring a scan of a small table).
+    """
+    connection = db.session.connection()
+    if connection.dialect.name == "postgresql":
+        connection.exec_driver_sql("SET LOCAL enable_seqscan = off")
+        rows = connection.exec_driver_sql("EXPLAIN " + statement, parameters).all()
+        lines = [row[0] for row in rows]
+        return lines, any("Seq Scan" in line for line in lines)
+
+    rows = connection.exec_driver_sql("EXPLAIN QUERY PLAN " + statement, parameters).all()
+    lines = [row[-1] for row in rows]
+    # SQLite reports full table scans as "SCAN <table>" (index-only scans mention an index)
+    return lines, any(line.startswith("SCAN") and "INDEX" not in line and
+                      line.split()[1] in db.metadata.tables for line in lines)
+
+
+@click.command("explain-queries")
+@click.option("--user-id", type=int, help="User to run the queries for (defaults to the first user).")
+@with_appcontext
+def explain_queries(user_id):
+    """Print query plans for the hot DAO queries and flag sequential scans."""
+    from api.models.models import User
+
+    if user_id is None:
+        user_id = db.session.execute(select(User.id).order_by(User.id)).scalar() or 1
+
+    flagged = 0
+    for name, query in _dao_queries(user_id).items():
+        click.echo(name)
+        for statement, parameters in _capture_statements(query):
+            lines, seq_scan = _explain(statement, parameters)
+            db.session.rollback()
+            if seq_scan:
+                flagged += 1
+            click.echo(("  [SEQ SCAN] " if seq_scan else "  [ok] ") + " ".join(statement.split()))
+            for line in lines:
+                click.echo("      " + line)
+
+    click.echo(f"{flagged} statement(s) with sequential scans")
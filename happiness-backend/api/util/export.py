@@ -0,0 +1,121 @@
+"""
+Streaming export of a user's data as CSV or NDJSON.
+
+Rows are streamed from the database in batches (yield_per) and serialized as they are read, so an
+export never holds all of a user's entries in memory or writes them to disk. The same generator backs
+the download endpoint and the emailed export. Happiness entries are exported with the same columns
+(value, comment, timestamp) and timestamp format as before exports were streamed.
+
+Besides happiness entries, an export can include the discussion comments on the user's entries,
+the entries the user has read, and the user's journal entries. Journals are exported as their
+encrypted data, so they can only be decrypted client-side with the user's password key.
+Every timestamp of such an export is in ISO 8601 (and every entry_date is an ISO 8601 date).
+"""
+import csv
+import io
+import json
+from typing import Iterator
+
+from sqlalchemy import select
+
+from api.app import db
+from api.models.models import Happiness, Comment, Journal, User, readers_happiness
+
+BATCH_SIZE = 1000
+
+FORMATS = {
+    "csv": ("text/csv", "csv"),
+    "ndjson": ("application/x-ndjson", "ndjson"),
+}
+INCLUDES = ("comments", "reads", "journals")
+
+HAPPINESS_FIELDS = ["value", "comment", "timestamp"]
+# rows of every type share these fields when extra data is included
+ALL_FIELDS = ["type", "timestamp", "value", "comment", "author", "entry_date", "data"]
+
+
+def export_fields(include: tuple = ()) -> list[str]:
+    return ALL_FIELDS if include else HAPPINESS_FIELDS
+
+
+def _stream(query):
+    return db.session.execute(query.execution_options(yield_per=BATCH_SIZE))
+
+
+def export_rows(user_id: int, include: tuple = ()) -> Iterator[dict]:
+    """
+    Yields the rows of a user's export (happiness entries, then any included data) oldest first.
+    """
+    for timestamp, value, comment in _stream(
+            select(Happiness.timestamp, Happiness.value, Happiness.comment)
+            .where(Happiness.user_id == user_id).order_by(Happiness.timestamp)):
+        if include:
+            yield dict(type="happiness", value=value, comment=comment, timestamp=timestamp.isoformat())
+        else:
+            yield dict(value=value, comment=comment, timestamp=str(timestamp))
+
+    if "comments" in include:
+        for timestamp, text, author, entry_date in _stream(
+                select(Comment.timestamp, Comment.text, User.username, Happiness.timestamp)
+                .join(Happiness, Comment.happiness_id == Happiness.id).join(User, Comment.user_id == User.id)
+                .where(Happiness.user_id == user_id).order_by(Comment.timestamp)):
+            yield dict(type="comment", timestamp=timestamp.isoformat(), comment=text, author=author,
+                       entry_date=entry_date.date().isoformat())
+
+    if "reads" in include:
+        for timestamp, author, entry_date in _stream(
+                select(readers_happiness.c.timestamp, User.username, Happiness.timestamp)
+                .join(Happiness, readers_happiness.c.happiness_id == Happiness.id)
+                .join(User, Happiness.user_id == User.id)
+                .where(readers_happiness.c.reader_id == user_id).order_by(readers_happiness.c.timestamp)):
+            yield dict(type="read", timestamp=timestamp.isoformat() if timestamp else None, author=author,
+                       entry_date=entry_date.date().isoformat())
+
+    if "journals" in include:
+        for timestamp, data in _stream(
+                select(Journal.timestamp, Journal.data)
+                .where(Journal.user_id == user_id).order_by(Journal.timestamp)):
+            # journal data is a Fernet token (base64), so it is exported as is
+            yield dict(type="journal", timestamp=timestamp.isoformat(), data=data.decode())
+
+
+def _batches(rows: Iterator[dict]) -> Iterator[list[dict]]:
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == BATCH_SIZE:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _stream_csv(rows: Iterator[dict], fields: list[str]) -> Iterator[bytes]:
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=fields)
+    writer.writeheader()
+    for batch in _batches(rows):
+        writer.writerows(batch)
+        yield buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode()
+
+
+def _stream_ndjson(rows: Iterator[dict]) -> Iterator[bytes]:
+    for batch in _batches(rows):
+        yield "".join(json.dumps(row) + "\n" for row in batch).encode()
+
+
+def stream_export(user_id: int, fmt: str = "csv", include: tuple = ()) -> Iterator[bytes]:
+    """Returns a generator of the chunks of a user's export in the given format."""
+    fields = export_fields(include)
+    rows = export_rows(user_id, include)
+    if fmt == "csv":
+        return _stream_csv(rows, fields)
+    return _stream_ndjson(rows)
+
+
+def export_filename(username: str, fmt: str) -> str:
+    return f"{username} happiness export.{FORMATS[fmt][1]}"
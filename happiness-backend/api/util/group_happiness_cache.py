@@ -0,0 +1,182 @@
+"""
+Redis read-through cache for group happiness date range responses.
+
+Caches the serialized response of `GET /api/group/<id>/happiness` keyed by (group ID, start, end)
+for GROUP_HAPPINESS_CACHE_TTL seconds. Each group also has a set indexing its cached ranges, so when
+a member's entry on some day changes only the ranges containing that day are deleted, and all of the
+group's ranges are deleted when its membership changes. Like the co-member cache, cached ranges are
+only deleted once the change is committed.
+
+Every change bumps the group's generation counter. A response is only cached if the counter did not change
+since it was read (before the entries were queried), since a change committed while the entries were being
+queried could otherwise be cached until the range expires (like the unread index, see unread_index.py).
+
+Hit and miss counts are kept in Redis and can be viewed with `flask group-cache-stats`.
+"""
+import json
+from datetime import date, datetime
+from typing import Optional
+
+import click
+import redis
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import select, event
+from sqlalchemy.orm import Session
+
+from api.app import db
+from api.models.models import group_users
+
+STATS_KEY = "group_happiness_cache:stats"
+
+
+def _ttl() -> int:
+    return current_app.config.get("GROUP_HAPPINESS_CACHE_TTL", 0)
+
+
+def _range_key(group_id: int, date_range: str) -> str:
+    return f"group_happiness:{group_id}:{date_range}"
+
+
+def _index_key(group_id: int) -> str:
+    return f"group_happiness:{group_id}:ranges"
+
+
+def _generation_key(group_id: int) -> str:
+    return f"group_happiness:{group_id}:generation"
+
+
+def _date_range(start: date, end: date) -> str:
+    return f"{start.isoformat()}:{end.isoformat()}"
+
+
+def get(group_id: int, start: date, end: date) -> Optional[list[dict]]:
+    """
+    Returns the cached happiness entries of a group between start and end (inclusive),
+    or None if they are not cached (or caching is disabled).
+    """
+    if not _ttl():
+        return None
+    try:
+        cached = current_app.redis.get(_range_key(group_id, _date_range(start, end)))
+        current_app.redis.hincrby(STATS_KEY, "misses" if cached is None else "hits", 1)
+    except redis.RedisError:
+        return None
+    if cached is None:
+        return None
+
+    entries = json.loads(cached)
+    # HappinessSchema serializes dates, so the response can be dumped again as usual
+    for entry in entries:
+        entry["timestamp"] = date.fromisoformat(entry["timestamp"])
+    return entries
+
+
+def generation(group_id: int) -> Optional[bytes]:
+    """Returns the group's cache generation, to be passed to put. Must be read before querying the entries."""
+    if not _ttl():
+        return None
+    try:
+        return current_app.redis.get(_generation_key(group_id))
+    except redis.RedisError:
+        return None
+
+
+def put(group_id: int, start: date, end: date, entries: list[dict], built_generation: Optional[bytes]):
+    """
+    Caches the serialized happiness entries of a group between start and end (inclusive), queried after
+    reading the cache generation built_generation. They are not cached if the group changed since then.
+    """
+    ttl = _ttl()
+    if not ttl:
+        return
+    date_range = _date_range(start, end)
+    try:
+        # the transaction is atomic with the generation bumps of _delete_changed_ranges
+        pipe = current_app.redis.pipeline()
+        pipe.set(_range_key(group_id, date_range), json.dumps(entries), ex=ttl)
+        pipe.sadd(_index_key(group_id), date_range)
+        # the index always outlives the ranges it points to
+        pipe.expire(_index_key(group_id), ttl)
+        pipe.get(_generation_key(group_id))
+        if pipe.execute()[-1] != built_generation:
+            pipe = current_app.redis.pipeline()
+            pipe.delete(_range_key(group_id, date_range))
+            pipe.srem(_index_key(group_id), date_range)
+            pipe.execute()
+    except redis.RedisError:
+        pass
+
+
+def entry_changed(user_id: int, timestamp: date):
+    """
+    Marks the cached ranges that contain the given day as changed for all the user's groups
+    (call whenever a happiness entry is created, edited, or deleted).
+    """
+    day = timestamp.date() if isinstance(timestamp, datetime) else timestamp
+    group_ids = db.session.execute(
+        select(group_users.c.group_id).where(group_users.c.user_id == user_id)
+    ).scalars()
+    changed = db.session.info.setdefault("group_happiness_changed", {})
+    for group_id in group_ids:
+        if group_id not in changed:
+            changed[group_id] = set()
+        if changed[group_id] is not None:
+            changed[group_id].add(day.isoformat())
+
+
+def groups_changed(group_ids):
+    """Marks all the cached ranges of the given groups as changed (e.g. when membership changes)."""
+    changed = db.session.info.setdefault("group_happiness_changed", {})
+    for group_id in group_ids:
+        changed[group_id] = None
+
+
+def _is_stale(date_range: str, days: Optional[set[str]]) -> bool:
+    if days is None:
+        return True
+    # ISO dates compare the same way as the dates themselves
+    start, end = date_range.split(":")
+    return any(start <= day <= end for day in days)
+
+
+@event.listens_for(Session, "after_commit")
+def _delete_changed_ranges(session):
+    changed = session.info.pop("group_happiness_changed", None)
+    if not changed or not _ttl():
+        return
+    try:
+        # bumped first, so ranges being cached concurrently are discarded by put
+        pipe = current_app.redis.pipeline()
+        for group_id in changed:
+            pipe.incr(_generation_key(group_id))
+            pipe.expire(_generation_key(group_id), _ttl())
+        pipe.execute()
+        for group_id, days in changed.items():
+            stale = [date_range.decode() for date_range in current_app.redis.smembers(_index_key(group_id))
+                     if _is_stale(date_range.decode(), days)]
+            if stale:
+                pipe = current_app.redis.pipeline()
+                pipe.delete(*[_range_key(group_id, date_range) for date_range in stale])
+                pipe.srem(_index_key(group_id), *stale)
+                pipe.execute()
+    except redis.RedisError:
+        pass
+
+
+@event.listens_for(Session, "after_rollback")
+def _discard_changed_ranges(session):
+    session.info.pop("group_happiness_changed", None)
+
+
+@click.command("group-cache-stats")
+@click.option("--reset", is_flag=True, help="Reset the counters after printing them.")
+@with_appcontext
+def group_cache_stats(reset):
+    """Print hit and miss counts of the group happiness cache."""
+    stats = {key.decode(): int(value) for key, value in current_app.redis.hgetall(STATS_KEY).items()}
+    hits, misses = stats.get("hits", 0), stats.get("misses", 0)
+    total = hits + misses
+    click.echo(f"hits: {hits}, misses: {misses}, hit rate: {hits / total if total else 0:.1%}")
+    if reset:
+        current_app.redis.delete(STATS_KEY)
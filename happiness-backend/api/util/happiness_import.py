@@ -0,0 +1,151 @@
+"""
+Bulk import of happiness entries (e.g. a user's spreadsheet history) from JSON lines or CSV.
+
+Rows are validated as they are read from the stream, with the same rules as creating an entry,
+and upserted in batches (see bulk_upsert). Invalid rows are reported with their line number
+without aborting the import. After importing, the affected users' rollups are rebuilt and their
+groups' cached happiness and co-members' unread indexes are invalidated.
+
+Rows have the keys timestamp (%Y-%m-%d), value, and optionally comment and user_id.
+CSV input must have a header row with the same names.
+
+Usage: `flask import-happiness FILE [--user-id ID] [--format jsonl|csv] [--batch-size N]`
+The same import is available to users for their own entries at `POST /api/happiness/import`.
+"""
+import csv
+import json
+from datetime import datetime
+from typing import Iterable, Iterator, Optional, TextIO
+
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import select
+
+from api.app import db
+from api.dao import happiness_dao, rollup_dao
+from api.models.models import User, group_users
+from api.util import group_happiness_cache, unread_index
+
+BATCH_SIZE = 1000
+
+
+def read_rows(stream: TextIO, fmt: str) -> Iterator[tuple[int, dict]]:
+    """
+    Yields the (line number, row) of each row of a JSON lines or CSV stream.
+    Rows that are not valid JSON objects are yielded as their error message.
+    """
+    if fmt == "csv":
+        reader = csv.DictReader(stream)
+        for row in reader:
+            yield reader.line_num, row
+        return
+
+    for line_num, line in enumerate(stream, 1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError:
+            yield line_num, "Malformed JSON."
+            continue
+        yield line_num, row if isinstance(row, dict) else "Expected a JSON object."
+
+
+def validate_row(row: dict, user_id: Optional[int], user_ids: set[int]) -> dict:
+    """
+    Returns the happiness entry of a row, or raises ValueError if it is invalid.
+    Rows are imported for user_id if given, otherwise for their own user_id.
+    """
+    row_user_id = row.get("user_id")
+    if row_user_id in (None, ""):
+        row_user_id = user_id
+    try:
+        row_user_id = int(row_user_id)
+    except (TypeError, ValueError):
+        raise ValueError("Invalid user_id.")
+    if user_id is not None and row_user_id != user_id:
+        raise ValueError("Not Allowed.")
+    if row_user_id not in user_ids:
+        raise ValueError("User not found.")
+
+    try:
+        timestamp = datetime.strptime(str(row.get("timestamp")), "%Y-%m-%d").date()
+    except ValueError:
+        raise ValueError("Invalid timestamp.")
+
+    try:
+        value = float(row.get("value"))
+    except (TypeError, ValueError):
+        raise ValueError("Invalid happiness value.")
+    if not (value * 2).is_integer() or value < 0 or value > 10:
+        raise ValueError("Invalid happiness value.")
+
+    # like the comment of a created entry, which can be any string
+    comment = row.get("comment") or None
+    if comment is not None and not isinstance(comment, str):
+        raise ValueError("Invalid comment.")
+    return dict(user_id=row_user_id, timestamp=timestamp, value=value, comment=comment)
+
+
+def import_happiness(rows: Iterable[tuple[int, dict]], user_id: Optional[int] = None,
+                     batch_size: int = BATCH_SIZE) -> dict:
+    """
+    Validates and upserts happiness entries from (line number, row) pairs, in batches.
+    If user_id is given, all rows are imported for that user (rows for other users are rejected).
+    Returns the number of imported entries and the errors of the rows that were skipped.
+    """
+    user_ids = {user_id} if user_id is not None else set(db.session.execute(select(User.id)).scalars())
+    imported, errors = 0, []
+    imported_users = set()
+    # keyed by (user, day) so the last row for a day wins within a batch
+    batch = {}
+
+    def flush():
+        nonlocal imported
+        happiness_dao.bulk_upsert_happiness(list(batch.values()))
+        imported += len(batch)
+        batch.clear()
+
+    for line_num, row in rows:
+        try:
+            if isinstance(row, str):
+                raise ValueError(row)
+            entry = validate_row(row, user_id, user_ids)
+        except ValueError as e:
+            errors.append({"line": line_num, "error": str(e)})
+            continue
+        batch[(entry["user_id"], entry["timestamp"])] = entry
+        imported_users.add(entry["user_id"])
+        if len(batch) >= batch_size:
+            flush()
+    flush()
+
+    group_ids = list(db.session.execute(
+        select(group_users.c.group_id).where(group_users.c.user_id.in_(imported_users)).distinct()
+    ).scalars())
+    group_happiness_cache.groups_changed(group_ids)
+    # imported entries may be unread by the users' co-members
+    unread_index.invalidate(db.session.execute(
+        select(group_users.c.user_id).where(group_users.c.group_id.in_(group_ids)).distinct()
+    ).scalars())
+    db.session.commit()
+    # imports can span years, so rebuilding is cheaper than refreshing every affected bucket
+    for imported_user in imported_users:
+        rollup_dao.rebuild_rollups(imported_user)
+    return {"imported": imported, "errors": errors}
+
+
+@click.command("import-happiness")
+@click.argument("file", type=click.File("r", encoding="utf-8"))
+@click.option("--user-id", type=int, help="Import all rows for this user (default: each row's user_id).")
+@click.option("--format", "fmt", type=click.Choice(["jsonl", "csv"]),
+              help="Input format (default: csv for .csv files, otherwise jsonl).")
+@click.option("--batch-size", type=int, default=BATCH_SIZE, help="Number of rows upserted at once.")
+@with_appcontext
+def import_happiness_command(file, user_id, fmt, batch_size):
+    """Import happiness entries from a JSON lines or CSV file."""
+    fmt = fmt or ("csv" if file.name.endswith(".csv") else "jsonl")
+    result = import_happiness(read_rows(file, fmt), user_id, batch_size)
+    for error in result["errors"]:
+        click.echo(f"line {error['line']}: {error['error']}", err=True)
+    click.echo(f"Imported {result['imported']} entries ({len(result['errors'])} errors)")
@@ -0,0 +1,61 @@
+"""
+Per-request journal encryption context.
+
+Journal entries are encrypted with the user's key, which is itself stored encrypted with their
+password key. journal_cipher unwraps the user key once per request and keeps the resulting Fernet
+object on `g`, so encrypting or decrypting any number of entries only unwraps the key once.
+decrypt_entries decrypts a whole page of entries with it, in parallel for large date ranges.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, Optional
+
+from cryptography.fernet import Fernet
+from flask import current_app, g
+
+from api.authentication.auth import token_current_user
+from api.models.models import Journal
+
+_executor: Optional[ThreadPoolExecutor] = None
+
+
+def journal_cipher(password_key: str) -> Fernet:
+    """
+    Returns the current user's Fernet cipher for the given password key, unwrapping the user key
+    only on the first call of a request. Raises InvalidToken if the password key is wrong.
+    """
+    user = token_current_user()
+    # keyed on the encrypted key too, as it changes with the user's password
+    key = (user.id, password_key, user.encrypted_key)
+    cached = g.get("journal_cipher")
+    if cached is None or cached[0] != key:
+        cached = (key, user.get_cipher(password_key))
+        g.journal_cipher = cached
+    return cached[1]
+
+
+def _executor_for(workers: int) -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="journal-decrypt")
+    return _executor
+
+
+def decrypt_entries(cipher: Fernet, entries: Iterable[Journal]) -> list[dict]:
+    """
+    Returns the given Journal entries as dictionaries with their data decrypted, for serialization.
+    Decrypts in a thread pool once there are at least JOURNAL_DECRYPT_PARALLEL_MIN entries
+    (JOURNAL_DECRYPT_WORKERS threads). Raises InvalidToken if any entry cannot be decrypted.
+    """
+    entries = list(entries)
+    workers = current_app.config.get("JOURNAL_DECRYPT_WORKERS", 0)
+    threshold = current_app.config.get("JOURNAL_DECRYPT_PARALLEL_MIN", 0)
+
+    def decrypt(entry: Journal) -> str:
+        return cipher.decrypt(entry.data).decode("utf-8")
+
+    if workers > 1 and threshold and len(entries) >= threshold:
+        texts = list(_executor_for(workers).map(decrypt, entries))
+    else:
+        texts = [decrypt(entry) for entry in entries]
+    return [dict(id=entry.id, user_id=entry.user_id, data=text, timestamp=entry.timestamp)
+            for entry, text in zip(entries, texts)]
@@ -0,0 +1,111 @@
+"""
+Password key derivation (PBKDF2-HMAC-SHA256) on a dedicated process pool.
+
+Deriving a password key takes ~100 ms of CPU, and is needed for journal keys, signups, password
+changes, and key recovery. With KDF_WORKERS > 0, derivations run on a pool of KDF_WORKERS processes
+instead of the request worker, so bursts of logins or signups queue up on the pool (bounding the CPU
+spent on key derivation) rather than starving request workers. With KDF_WORKERS = 0 keys are derived
+in the calling thread.
+
+The pool's queue depth (derivations submitted but not finished) of each process with derivations
+pending is kept in Redis and can be viewed with `flask kdf-stats`. A process's entry is removed when
+its queue is empty, and the entries expire after DEPTH_TTL seconds without derivations (e.g. left by
+a process that was killed).
+"""
+import base64
+import multiprocessing
+import os
+import socket
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+
+import click
+import redis
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+from flask import current_app
+from flask.cli import with_appcontext
+
+ITERATIONS = 200000
+DEPTH_KEY = "kdf:queue_depth"
+DEPTH_TTL = 60 * 60
+STATS_KEY = "kdf:stats"
+
+_pool: Optional[ProcessPoolExecutor] = None
+_pool_pid: Optional[int] = None
+_lock = threading.Lock()
+# held while publishing, so the depths are published in order
+_depth_lock = threading.Lock()
+_depth = 0
+
+
+def _derive(password: bytes, salt: bytes) -> bytes:
+    kdf = PBKDF2HMAC(algorithm=hashes.SHA256(), length=32, salt=salt, iterations=ITERATIONS)
+    return base64.urlsafe_b64encode(kdf.derive(password))
+
+
+def _get_pool(workers: int) -> ProcessPoolExecutor:
+    global _pool, _pool_pid
+    with _lock:
+        # pools cannot be shared with forked (e.g. preloaded gunicorn) worker processes
+        if _pool is None or _pool_pid != os.getpid():
+            # spawned, as forking a process with running threads (e.g. the scheduler) is unsafe
+            _pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+            _pool_pid = os.getpid()
+        return _pool
+
+
+def queue_depth() -> int:
+    """Returns the number of this process's derivations that are queued or running on the pool."""
+    with _depth_lock:
+        return _depth
+
+
+def _publish_depth(client: redis.Redis, depth: int, submitted: bool):
+    try:
+        pipe = client.pipeline()
+        process = f"{socket.gethostname()}:{os.getpid()}"
+        if depth:
+            pipe.hset(DEPTH_KEY, process, depth)
+        else:
+            pipe.hdel(DEPTH_KEY, process)
+        pipe.expire(DEPTH_KEY, DEPTH_TTL)
+        if submitted:
+            pipe.hincrby(STATS_KEY, "submitted", 1)
+        pipe.execute()
+    except redis.RedisError:
+        pass
+
+
+def _track(client: redis.Redis, delta: int):
+    global _depth
+    with _depth_lock:
+        _depth += delta
+        _publish_depth(client, _depth, submitted=delta > 0)
+
+
+def derive_password_key(password: str) -> bytes:
+    """Derives the password key (urlsafe base64) of a password, on the KDF pool if enabled."""
+    salt = bytes(current_app.config["ENCRYPT_SALT"], 'utf-8')
+    workers = current_app.config.get("KDF_WORKERS", 0)
+    if not workers:
+        return _derive(bytes(password, 'utf-8'), salt)
+
+    client = current_app.redis
+    _track(client, 1)
+    try:
+        return _get_pool(workers).submit(_derive, bytes(password, 'utf-8'), salt).result()
+    finally:
+        _track(client, -1)
+
+
+@click.command("kdf-stats")
+@with_appcontext
+def kdf_stats():
+    """Print the KDF pool queue depth of every process."""
+    depths = {key.decode(): int(value) for key, value in current_app.redis.hgetall(DEPTH_KEY).items()}
+    for process, depth in sorted(depths.items()):
+        click.echo(f"{process}: {depth}")
+    submitted = int(current_app.redis.hget(STATS_KEY, "submitted") or 0)
+    click.echo(f"queue depth: {sum(depths.values())}, derivations submitted: {submitted}")
@@ -0,0 +1,103 @@
+"""
+Happiness reminder notifications.
+
+Users with an enabled "notify" setting ('HH:MM timezone', the time being in UTC) are reminded at that
+time when they are missing entries in the past week (in their timezone). The setting is parsed when it
+is saved into the notification_schedule table (UTC minute of the day and timezone), so due_notifications
+finds every user due a reminder with an index lookup on the minute, then fetches all of their entries of
+the past week in one query and computes the dates they are missing, so the per-user email jobs do no
+database work.
+"""
+from collections import defaultdict
+from datetime import datetime, date, timedelta
+from typing import NamedTuple, Optional
+
+import pytz
+
+from api.app import db
+from api.dao import happiness_dao, users_dao
+from api.models.models import NotificationSchedule, Setting
+
+DAYS = 6
+# notifications are queued every half hour (see jobs/scheduler.py)
+INTERVAL_MINUTES = 30
+
+
+class DueNotification(NamedTuple):
+    user_id: int
+    email: str
+    username: str
+    missing_dates: list[str]
+
+
+def parse_notify_value(value: Optional[str]) -> Optional[tuple[int, str]]:
+    """
+    Returns the UTC minute of the day and the timezone of a notify setting value ('HH:MM timezone'),
+    or None if it is not valid.
+    """
+    parts = (value or "").split(" ")
+    if len(parts) != 2 or parts[1] not in pytz.all_timezones_set:
+        return None
+    try:
+        time = datetime.strptime(parts[0], "%H:%M")
+    except ValueError:
+        return None
+    return time.hour * 60 + time.minute, parts[1]
+
+
+def update_notification_schedule(setting: Setting):
+    """
+    Updates the notification schedule of the setting's user from their notify setting
+    (removing it if the setting is disabled or not valid). Does not commit.
+    """
+    schedule = db.session.get(NotificationSchedule, setting.user_id)
+    parsed = parse_notify_value(setting.value) if setting.enabled else None
+    if parsed is None:
+        if schedule is not None:
+            db.session.delete(schedule)
+        return
+    if schedule is None:
+        schedule = NotificationSchedule(user_id=setting.user_id)
+        db.session.add(schedule)
+    schedule.minute, schedule.timezone = parsed
+
+
+def _local_today(now: datetime, zone: str) -> Optional[date]:
+    try:
+        return pytz.utc.localize(now).astimezone(pytz.timezone(zone)).date()
+    except pytz.UnknownTimeZoneError:
+        return None
+
+
+def due_notifications(now: datetime, interval: int = INTERVAL_MINUTES) -> list[DueNotification]:
+    """
+    Returns the reminders due at the given (naive UTC) time: every user with a notify time in the interval
+    ending at the last scheduler tick (e.g. 19:31 to 20:00 at 20:00, or a delayed 20:02) who has less than
+    6 entries from a week before today to today, with the dates they are missing (from yesterday to 6 days ago,
+    formatted '%m-%d').
+    """
+    minute = now.hour * 60 + now.minute
+    end = minute - minute % interval
+    schedules = users_dao.get_notification_schedules((end - interval + 1) % (24 * 60), end)
+
+    # each timezone is only parsed once, and all users in it share the same local dates
+    by_zone = defaultdict(list)
+    for user_id, zone, email, username in schedules:
+        by_zone[zone].append((user_id, email, username))
+    today_by_zone = {zone: _local_today(now, zone) for zone in by_zone}
+    today_by_zone = {zone: today for zone, today in today_by_zone.items() if today is not None}
+
+    entry_dates = happiness_dao.get_entry_dates([
+        ([user_id for user_id, _, _ in by_zone[zone]], today - timedelta(days=DAYS), today)
+        for zone, today in today_by_zone.items()
+    ])
+
+    due = []
+    for zone, today in today_by_zone.items():
+        for user_id, email, username in by_zone[zone]:
+            present = entry_dates.get(user_id, set())
+            if len(present) < DAYS:
+                missing = [(today - timedelta(days=i)).strftime("%m-%d") for i in range(1, DAYS + 1)
+                           if today - timedelta(days=i) not in present]
+                due.append(DueNotification(user_id, email, username, missing))
+    return due
@@ -0,0 +1,23 @@
+"""
+Maintenance commands for the happiness rollups (see rollup_dao).
+
+Usage: `flask rebuild-rollups [--user-id ID] [--now]`
+"""
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+
+
+@click.command("rebuild-rollups")
+@click.option("--user-id", type=int, help="Only rebuild this user's rollups.")
+@click.option("--now", is_flag=True, help="Rebuild in this process instead of queuing a job.")
+@with_appcontext
+def rebuild_rollups(user_id, now):
+    """Rebuild the happiness rollups from the happiness entries."""
+    if now:
+        from api.dao import rollup_dao
+        rollup_dao.rebuild_rollups(user_id)
+        click.echo("Rollups rebuilt")
+    else:
+        current_app.job_queue.enqueue("jobs.jobs.rebuild_happiness_rollups", user_id)
+        click.echo("Queued job for rebuilding rollups")
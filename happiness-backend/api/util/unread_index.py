@@ -0,0 +1,166 @@
+"""
+Redis index of each user's unread happiness entries.
+
+Each user has a sorted set of the IDs of their co-members' entries they have not read, scored by
+the entry's timestamp, so the unread feeds only have to load the entries in the set (instead of
+checking every co-member's entries of the past week against the reads table).
+
+A user's set is built from the database the first time their unread entries are requested, and
+kept for UNREAD_INDEX_TTL seconds. Meanwhile it is updated as entries are created or deleted
+(fanned out to the author's co-members) and read or marked unread, and entries older than a week
+are pruned whenever it is read. Sets are dropped (and rebuilt on the next request) when a user's
+group membership changes. Like the other caches, changes are only applied once they are committed.
+
+Every change applied to a user's set bumps their generation counter. A build reads the counter before
+querying the database, and is discarded if the counter changed before the set was written, since a
+change committed while the entries were being queried could otherwise be overwritten by the build.
+"""
+from datetime import datetime, timedelta
+from typing import Optional
+
+import redis
+from flask import current_app
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from api.app import db
+
+WINDOW = timedelta(weeks=1)
+
+
+def _ttl() -> int:
+    return current_app.config.get("UNREAD_INDEX_TTL", 0)
+
+
+def enabled() -> bool:
+    return bool(_ttl())
+
+
+def _key(user_id: int) -> str:
+    return f"unread:{user_id}"
+
+
+def _built_key(user_id: int) -> str:
+    return f"unread:{user_id}:built"
+
+
+def _generation_key(user_id: int) -> str:
+    return f"unread:{user_id}:generation"
+
+
+def _score(timestamp) -> float:
+    # naive timestamps are UTC, like the window of the unread query
+    if not isinstance(timestamp, datetime):
+        timestamp = datetime.combine(timestamp, datetime.min.time())
+    return (timestamp - datetime(1970, 1, 1)).total_seconds()
+
+
+def get_unread_ids(user_id: int) -> Optional[list[int]]:
+    """
+    Returns the IDs of the user's unread entries of the past week,
+    or None if their index is not built (or the index is disabled).
+    """
+    if not _ttl():
+        return None
+    now = datetime.utcnow()
+    try:
+        pipe = current_app.redis.pipeline()
+        pipe.exists(_built_key(user_id))
+        pipe.zremrangebyscore(_key(user_id), "-inf", f"({_score(now - WINDOW)}")
+        pipe.zrangebyscore(_key(user_id), _score(now - WINDOW), _score(now))
+        built, _, ids = pipe.execute()
+    except redis.RedisError:
+        return None
+    if not built:
+        return None
+    return [int(happiness_id) for happiness_id in ids]
+
+
+def generation(user_id: int) -> Optional[bytes]:
+    """Returns the user's index generation, to be passed to build. Must be read before querying the entries."""
+    try:
+        return current_app.redis.get(_generation_key(user_id))
+    except redis.RedisError:
+        return None
+
+
+def build(user_id: int, entries: list[tuple[int, datetime]], built_generation: Optional[bytes]):
+    """
+    Replaces the user's index with the given (ID, timestamp) of their unread entries, queried after reading
+    the index generation built_generation. The index is dropped if it was changed since then.
+    """
+    ttl = _ttl()
+    if not ttl:
+        return
+    try:
+        # the transaction is atomic with the changes applied by _apply_changes
+        pipe = current_app.redis.pipeline()
+        pipe.delete(_key(user_id))
+        if entries:
+            pipe.zadd(_key(user_id), {str(happiness_id): _score(timestamp) for happiness_id, timestamp in entries})
+        pipe.expire(_key(user_id), ttl)
+        pipe.set(_built_key(user_id), 1, ex=ttl)
+        pipe.get(_generation_key(user_id))
+        if pipe.execute()[-1] != built_generation:
+            # rebuilt on the next request
+            current_app.redis.delete(_key(user_id), _built_key(user_id))
+    except redis.RedisError:
+        pass
+
+
+def _pending() -> list:
+    return db.session.info.setdefault("unread_index_changes", [])
+
+
+def entry_created(happiness_id: int, timestamp: datetime, author_id: int, co_member_ids):
+    """Adds a new entry to the indexes of the author's co-members."""
+    readers = [user_id for user_id in co_member_ids if user_id != author_id]
+    _pending().append(("add", readers, happiness_id, _score(timestamp)))
+
+
+def entry_deleted(happiness_id: int, author_id: int, co_member_ids):
+    """Removes a deleted entry from the indexes of the author's co-members."""
+    readers = [user_id for user_id in co_member_ids if user_id != author_id]
+    _pending().append(("remove", readers, happiness_id, None))
+
+
+def entry_read(user_id: int, happiness_id: int):
+    _pending().append(("remove", [user_id], happiness_id, None))
+
+
+def entry_unread(user_id: int, happiness_id: int, timestamp: datetime):
+    _pending().append(("add", [user_id], happiness_id, _score(timestamp)))
+
+
+def invalidate(user_ids):
+    """Drops the indexes of the given users (e.g. when their co-members change)."""
+    _pending().append(("invalidate", list(user_ids), None, None))
+
+
+@event.listens_for(Session, "after_commit")
+def _apply_changes(session):
+    changes = session.info.pop("unread_index_changes", None)
+    if not changes or not _ttl():
+        return
+    try:
+        pipe = current_app.redis.pipeline()
+        for action, user_ids, happiness_id, score in changes:
+            for user_id in user_ids:
+                pipe.incr(_generation_key(user_id))
+                pipe.expire(_generation_key(user_id), _ttl())
+                if action == "add":
+                    pipe.zadd(_key(user_id), {str(happiness_id): score})
+                    # indexes that are not built are replaced when they are built, but must not linger
+                    pipe.expire(_key(user_id), _ttl())
+                elif action == "remove":
+                    pipe.zrem(_key(user_id), str(happiness_id))
+                else:
+                    pipe.delete(_key(user_id), _built_key(user_id))
+        pipe.execute()
+    except redis.RedisError:
+        pass
+
+
+@event.listens_for(Session, "after_rollback")
+def _discard_changes(session):
+    session.info.pop("unread_index_changes", None)
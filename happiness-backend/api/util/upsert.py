@@ -0,0 +1,133 @@
+"""
+Single-statement upserts (INSERT ... ON CONFLICT DO UPDATE ... RETURNING) for Postgres and SQLite,
+and bulk upserts of many rows at once. Other databases fall back to a select, then an insert or update.
+"""
+import io
+from datetime import date, datetime
+
+from sqlalchemy import literal_column, text, select, insert, update
+from sqlalchemy.dialects import postgresql, sqlite
+
+from api.app import db
+
+
+def upsert(model, values: dict, index_elements: list, update_columns: list[str]):
+    """
+    Inserts a row for model, or updates update_columns of the row that conflicts with it on
+    index_elements (which must be covered by a unique index), in a single statement.
+    Returns the resulting model object and whether it was newly created.
+    """
+    # column onupdate defaults are not applied to the ON CONFLICT update
+    if "updated_at" in model.__table__.c:
+        values = {**values, "updated_at": datetime.utcnow()}
+        update_columns = [*update_columns, "updated_at"]
+
+    dialect = db.session.get_bind().dialect.name
+    if dialect == "postgresql":
+        stmt = postgresql.insert(model)
+        # xmax is only set on rows written by an update
+        inserted = literal_column("xmax = 0")
+    elif dialect == "sqlite":
+        stmt = sqlite.insert(model)
+        # SQLite has no way to tell an inserted row from an updated one, so check for the row first.
+        # created is best-effort: the select only takes a shared lock in a deferred transaction, so
+        # another connection can insert the row before the upsert (which then updates it, atomically)
+        inserted = literal_column("1" if _find(model, values, index_elements) is None else "0")
+    else:
+        return _select_then_write(model, values, index_elements, update_columns)
+
+    stmt = stmt.values(**values)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=index_elements,
+        set_={column: stmt.excluded[column] for column in update_columns}
+    )
+    obj, created = db.session.execute(
+        stmt.returning(model, inserted), execution_options={"populate_existing": True}
+    ).one()
+    return obj, bool(int(created))
+
+
+def _key_filter(model, values: dict, index_elements: list):
+    return [column == values[column.key] for column in index_elements]
+
+
+def _find(model, values: dict, index_elements: list):
+    return db.session.execute(
+        select(model.__table__.c[index_elements[0].key]).where(*_key_filter(model, values, index_elements))
+    ).first()
+
+
+def _select_then_write(model, values: dict, index_elements: list, update_columns: list[str]):
+    # portable (but not atomic) upsert for databases without ON CONFLICT
+    created = _find(model, values, index_elements) is None
+    if created:
+        db.session.execute(insert(model).values(**values))
+    else:
+        db.session.execute(update(model).where(*_key_filter(model, values, index_elements))
+                           .values({column: values[column] for column in update_columns}))
+    obj = db.session.execute(
+        select(model).where(*_key_filter(model, values, index_elements)),
+        execution_options={"populate_existing": True}
+    ).scalar_one()
+    return obj, created
+
+
+def _copy_value(value) -> str:
+    # COPY csv format: unquoted empty values are NULL, so strings are always quoted
+    if value is None:
+        return ""
+    if isinstance(value, str):
+        return '"' + value.replace('"', '""') + '"'
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    return str(value)
+
+
+def bulk_upsert(model, rows: list[dict], index_elements: list, update_columns: list[str]):
+    """
+    Inserts many rows for model (all with the same keys), updating update_columns of the rows that
+    conflict with them on index_elements. Rows must not conflict with each other.
+    On Postgres the rows are streamed with COPY into a temporary staging table and upserted from it
+    in one statement; on SQLite they are upserted with a single executemany, and otherwise one by one.
+    """
+    if not rows:
+        return
+    if "updated_at" in model.__table__.c:
+        now = datetime.utcnow()
+        rows = [{**row, "updated_at": now} for row in rows]
+        update_columns = [*update_columns, "updated_at"]
+    columns = list(rows[0].keys())
+
+    dialect = db.session.get_bind().dialect.name
+    if dialect == "postgresql":
+        table = model.__table__
+        staging = f"{table.name}_staging"
+        column_list = ", ".join(f'"{column}"' for column in columns)
+        db.session.execute(text(
+            f'CREATE TEMP TABLE IF NOT EXISTS {staging} ON COMMIT DROP AS '
+            f'SELECT {column_list} FROM "{table.name}" WITH NO DATA'
+        ))
+        db.session.execute(text(f"TRUNCATE {staging}"))
+
+        data = io.StringIO()
+        for row in rows:
+            data.write(",".join(_copy_value(row[column]) for column in columns) + "\n")
+        data.seek(0)
+        cursor = db.session.connection().connection.dbapi_connection.cursor()
+        cursor.copy_expert(f"COPY {staging} ({column_list}) FROM STDIN WITH (FORMAT csv)", data)
+
+        staged = select(*[literal_column(f'"{column}"') for column in columns]).select_from(text(staging))
+        stmt = postgresql.insert(model).from_select(columns, staged)
+        db.session.execute(stmt.on_conflict_do_update(
+            index_elements=index_elements,
+            set_={column: stmt.excluded[column] for column in update_columns}
+        ))
+    elif dialect == "sqlite":
+        stmt = sqlite.insert(model)
+        db.session.execute(stmt.on_conflict_do_update(
+            index_elements=index_elements,
+            set_={column: stmt.excluded[column] for column in update_columns}
+        ), rows)
+    else:
+        for row in rows:
+            _select_then_write(model, row, index_elements, update_columns)
@@ -0,0 +1,40 @@
+"""
+Loads the Wrapped data generated by wrapped/create_wrapped.py into the database (see wrapped_dao).
+
+Usage: `flask ingest-wrapped [SOURCE] [--year YEAR]`
+SOURCE is a path or URL of the wrapped_data_{year}.json file (default: WRAPPED_DATA_URL), and
+YEAR defaults to WRAPPED_YEAR. Re-ingesting a year replaces its data atomically, so the next
+year's data can be loaded ahead of time and served by updating WRAPPED_YEAR.
+"""
+import json
+
+import click
+import requests
+from flask.cli import with_appcontext
+
+from config import Config
+
+
+@click.command("ingest-wrapped")
+@click.argument("source", required=False)
+@click.option("--year", type=int, help="Year of the Wrapped data (default: WRAPPED_YEAR).")
+@with_appcontext
+def ingest_wrapped(source, year):
+    """Load Wrapped data from a JSON file or URL into the database."""
+    from api.dao import wrapped_dao
+
+    source = source or Config.WRAPPED_DATA_URL
+    year = year or Config.WRAPPED_YEAR
+    if source is None:
+        raise click.UsageError("No source given and WRAPPED_DATA_URL is not set")
+
+    if source.startswith(("http://", "https://")):
+        response = requests.get(source)
+        response.raise_for_status()
+        all_wrapped_data = response.json()
+    else:
+        with open(source) as f:
+            all_wrapped_data = json.load(f)
+
+    count = wrapped_dao.replace_wrapped(year, all_wrapped_data)
+    click.echo(f"Loaded Wrapped data of {count} users for {year}")
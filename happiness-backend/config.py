@@ -34,12 +34,33 @@ class Config:
     AWS_BUCKET_NAME = os.environ.get("AWS_BUCKET_NAME")
     AWS_REGION = os.environ.get("AWS_REGION")
 
-    # Happiness export
-    UPLOAD_FOLDER = "./export/"
-
     # Scheduled jobs
     REDISCLOUD_URL = os.environ.get("REDISCLOUD_URL")
 
+    # Caching (in seconds, 0 to disable)
+    TOKEN_CACHE_TTL = 60
+    CO_MEMBER_CACHE_TTL = 300
+    GROUP_HAPPINESS_CACHE_TTL = 300
+    UNREAD_INDEX_TTL = 3600
+
+    # Background email threads, and how many emails can be waiting for them (waiting at most
+    # EMAIL_SUBMIT_TIMEOUT seconds for room); 0 threads to send in the request worker
+    EMAIL_WORKERS = 2
+    EMAIL_QUEUE_SIZE = 100
+    EMAIL_SUBMIT_TIMEOUT = 5
+
+    # Password key derivation processes (0 to derive in the request worker)
+    KDF_WORKERS = 2
+
+    # Journal pages with at least this many entries are decrypted on JOURNAL_DECRYPT_WORKERS threads
+    JOURNAL_DECRYPT_WORKERS = 4
+    JOURNAL_DECRYPT_PARALLEL_MIN = 100
+
+    # Delta sync (deletions are only remembered for this many days)
+    SYNC_RETENTION_DAYS = 30
+    # the returned sync time is this many seconds early, to include changes committed during a sync
+    SYNC_OVERLAP_SECONDS = 60
+
     # Discord webhooks
     AST_WEBHOOK_URL = os.environ.get("AST_WEBHOOK_URL")
     BOIS_WEBHOOK_URL = os.environ.get("BOIS_WEBHOOK_URL")
@@ -59,7 +59,9 @@ all_user_data = list(
     filter(lambda x: datetime.datetime.strptime(x['timestamp'], "%Y-%m-%d") >= since,
            all_user_data))
 
-import_data = requests.post(f'{backend_url}/api/happiness/import',
-                            headers={"Content-Type": "application/json"},
-                            data=json.dumps(all_user_data))
-print(import_data.text)
+# entries of several users can only be imported by the backend's CLI (users can import their own
+# entries with POST /api/happiness/import)
+with open('happiness_import.jsonl', 'w') as f:
+    for entry in all_user_data:
+        f.write(json.dumps(entry) + '\n')
+print(f'{len(all_user_data)} entries written, import with: flask import-happiness happiness_import.jsonl')
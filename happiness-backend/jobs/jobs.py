@@ -1,18 +1,19 @@
-import csv
 import os
-import uuid
-from datetime import datetime, timedelta
+from datetime import datetime
 
-import pytz
 import redis
 from dotenv import load_dotenv
 from flask import render_template
 from rq import Queue
 
 from api import create_app
-from api.dao import happiness_dao, users_dao
-from api.models.models import Token, Setting, Happiness
+from api.app import db
+from api.dao import users_dao, rollup_dao
+from api.models.models import Token, Happiness, Tombstone
+from api.util import email_outbox
 from api.util.email_methods import send_email_helper
+from api.util.export import stream_export, export_filename, FORMATS
+from api.util.notifications import due_notifications
 
 """
 jobs.py contains all scheduled jobs that will be queued by scheduler.py
@@ -28,22 +29,6 @@ conn = redis.from_url(redis_url)
 q = Queue('happiness-backend-jobs', connection=conn)
 
 
-def clear_exported_happiness():
-    """
-    Deletes all files in the `export` folder that are older than 1 hour.
-    """
-    minutes5ago = (datetime.now() - timedelta(hours=1))
-    folder_path = "export"
-
-    for root, dirs, files in os.walk(folder_path):
-        for file in files:
-            file_path = os.path.join(root, file)
-            created_time = datetime.fromtimestamp(os.path.getctime(file_path))
-
-            if created_time < minutes5ago:
-                os.remove(file_path)
-
-
 def clean_tokens():
     """
     Deletes all expired tokens
@@ -58,83 +43,45 @@ def clean_reads():
     Happiness.clean_old_reads()
 
 
-def export_happiness(user_id):
+def rebuild_happiness_rollups(user_id=None):
     """
-    Export Happiness
-    Exports a user's happiness, returning a CSV file containing the values, comments, and timestamps.
+    Rebuilds the happiness rollups of all users (or the given user) from their entries
     """
-    current_user = users_dao.get_user_by_id(user_id)
-    entries = happiness_dao.get_all_happiness(current_user.id)
-
-    def to_dict_entry(n):
-        new_dict = n.__dict__
-        new_dict.pop('_sa_instance_state')
-        new_dict.pop('user_id')
-        new_dict.pop('id')
-
-        return new_dict
-
-    entries_dict = map(to_dict_entry, entries)
-    fields = ['value', 'comment', 'timestamp']
-    filename = f"happiness_export_{uuid.uuid4()}"
-    file_path = f"export/{filename}"
-    with open(file_path, 'w', newline='') as file:
-        writer = csv.DictWriter(file, fieldnames=fields)
-        writer.writeheader()
-        writer.writerows(entries_dict)
-    with open(file_path, 'r', newline='') as file:
-        send_email_helper(
-            subject="Your Happiness Export :)",
-            sender="noreply@happinessapp.org",
-            recipients=[current_user.email],
-            text_body=render_template('happiness_export.txt', user=current_user),
-            html_body=render_template('happiness_export.html', user=current_user),
-            attachments=[(f"{current_user.username} happiness export.csv", "text/csv", file.read())]
-        )
-    # Leftover files are deleted by a scheduled job, so no need to be worried about that here.
-
-
-def send_notification_email(user_id):
+    rollup_dao.rebuild_rollups(user_id)
+
+
+def clean_tombstones():
     """
-    Sends a happiness app reminder notification email to the given email.
-    Requires: user is missing at least 1 entry in the past week
-    The time must be a 24-hour time in the '%H:%M' format, then a space, followed by a valid pytz timezone.
-    See https://gist.github.com/heyalexej/8bf688fd67d7199be4a1682b3eec7568 for list of valid pytz timezones.
+    Deletes all tombstones older than the sync retention period
     """
-    user_to_send = users_dao.get_user_by_id(user_id)
-    user_setting = Setting.query.filter_by(key="notify", user_id=user_id).first()
-    timezone = pytz.timezone(user_setting.value.split(" ")[1])
-    now = datetime.now(tz=timezone)
-
-    dates_should_be_present = [
-        (now - timedelta(days=i)).strftime("%Y-%m-%d") for i in range(1, 7)
-    ]
-
-    yesterday = now - timedelta(days=1)
-    last_week = now - timedelta(days=6)
-    entries = happiness_dao.get_happiness_by_date_range(start=last_week, end=yesterday, user_ids=[user_id])
-    entries = list(filter(lambda x: x is not None, entries))
-    entries = [x.timestamp.strftime("%Y-%m-%d") for x in entries]
-
-    for timestamp in entries:
-        if timestamp in dates_should_be_present:
-            dates_should_be_present.remove(timestamp)
-
-    missing_dates_str = ""
-    for i, d in enumerate(dates_should_be_present):
-        missing_dates_str += d[5:]
-        if i != len(dates_should_be_present) - 1:
-            missing_dates_str += ", "
+    Tombstone.clean()
 
+
+def export_happiness(user_id, fmt="csv", include=()):
+    """
+    Export Happiness
+    Exports a user's happiness, emailing them a CSV (or NDJSON) file containing the values, comments,
+    and timestamps, and optionally their discussion comments, reads, and encrypted journals.
+    """
+    current_user = users_dao.get_user_by_id(user_id)
     send_email_helper(
-        subject="Enter Your Happiness :)",
+        subject="Your Happiness Export :)",
         sender="noreply@happinessapp.org",
-        recipients=[user_to_send.email],
-        text_body=render_template('notify_happiness.txt', user=user_to_send, dates=missing_dates_str),
-        html_body=render_template('notify_happiness.html', user=user_to_send, dates=missing_dates_str)
+        recipients=[current_user.email],
+        text_body=render_template('happiness_export.txt', user=current_user),
+        html_body=render_template('happiness_export.html', user=current_user),
+        attachments=[(export_filename(current_user.username, fmt), FORMATS[fmt][0],
+                      b"".join(stream_export(current_user.id, fmt, include)))]
     )
 
 
+def drain_email_outbox():
+    """
+    Sends all due emails in the email outbox, over one SMTP connection per batch
+    """
+    email_outbox.drain_all()
+
+
 def queue_send_notification_emails():
     """
     Adds all notification email requests to the redis queue
@@ -148,24 +95,12 @@ def queue_send_notification_emails():
     The UTC time they provided is used for the actual notification time
 
     They have less than 6 Happiness entries from yesterday to 1 week before today
+    All due users and their missing dates are found with two queries (see api.util.notifications), and their
+    emails are queued in the email outbox and sent in batches
     """
-    current_time = str(datetime.utcnow().time().strftime("%H:%M"))
-
-    to_notify = Setting.query.filter(Setting.value.startswith(str(current_time)), Setting.key == "notify",
-                                     Setting.enabled.is_(True)).all()
-    for setting in to_notify:
-        timezone = pytz.timezone(setting.value.split(" ")[1])
-        now = datetime.now(tz=timezone)
-        last_week = (now - timedelta(days=6))
-        # For some reason, the between query for SQLAlchemy seems to be exclusive for the end date
-        # This is very confusing since according to the docs between should be inclusive
-        # It translates to BETWEEN in SQL:
-        # https://docs.sqlalchemy.org/en/20/core/sqlelement.html#sqlalchemy.sql.expression.between
-        # BETWEEN is inclusive: https://www.w3schools.com/sql/sql_between.asp
-        # But it works so for now I will keep it
-        entries = happiness_dao.get_happiness_by_date_range(start=last_week, end=now, user_ids=[setting.user_id])
-        entries = list(filter(lambda x: x is not None, entries))
-        if len(entries) < 6:
-            # They are missing an entry, and we are guaranteed to send an email which is expensive
-            # Therefore we queue another job to redis
-            q.enqueue("jobs.jobs.send_notification_email", setting.user_id)
+    for notification in due_notifications(datetime.utcnow()):
+        email_outbox.queue_email("notify_happiness", "Enter Your Happiness :)", notification.email,
+                                 user=dict(username=notification.username),
+                                 dates=", ".join(notification.missing_dates))
+    db.session.commit()
+    email_outbox.drain_all()
@@ -27,11 +27,6 @@ def init_app(app):
 
     q = app.job_queue
 
-    @sched.scheduled_job('interval', days=1)
-    def scheduled_clear_exported_happiness():
-        scheduler_log("Queuing job for exporting happiness")
-        q.enqueue("jobs.jobs.clear_exported_happiness")
-
     @sched.scheduled_job('interval', days=1)
     def scheduled_clean_tokens():
         scheduler_log("Queuing job for cleaning tokens")
@@ -42,11 +37,20 @@ def init_app(app):
         scheduler_log("Queuing job for cleaning reads")
         q.enqueue("jobs.jobs.clean_reads")
 
+    @sched.scheduled_job('interval', days=1)
+    def scheduled_clean_tombstones():
+        scheduler_log("Queuing job for cleaning tombstones")
+        q.enqueue("jobs.jobs.clean_tombstones")
+
     @sched.scheduled_job('cron', minute="0,30")
     def scheduled_queue_send_notification_emails():
         scheduler_log("Queuing job for sending notification emails")
         q.enqueue("jobs.jobs.queue_send_notification_emails")
 
+    @sched.scheduled_job('interval', minutes=1)
+    def scheduled_drain_email_outbox():
+        q.enqueue("jobs.jobs.drain_email_outbox")
+
     if RUN_SCHEDULER:
         scheduler_log("Starting scheduler")
         sched.start()
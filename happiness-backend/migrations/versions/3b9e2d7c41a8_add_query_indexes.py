@@ -0,0 +1,48 @@
+"""add query indexes
+
+Revision ID: 3b9e2d7c41a8
+Revises: f10cda871fc9
+Create Date: 2026-10-17 10:12:41.502913
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3b9e2d7c41a8'
+down_revision = 'f10cda871fc9'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('happiness', schema=None) as batch_op:
+        batch_op.create_index('ix_happiness_user_id_timestamp', ['user_id', 'timestamp'],
+                              unique=False, postgresql_include=['value'])
+
+    with op.batch_alter_table('journal', schema=None) as batch_op:
+        batch_op.create_index('ix_journal_user_id_timestamp', ['user_id', 'timestamp'],
+                              unique=False)
+
+    with op.batch_alter_table('readers_happiness', schema=None) as batch_op:
+        batch_op.create_index('ix_readers_happiness_reader_id_happiness_id',
+                              ['reader_id', 'happiness_id'], unique=False)
+
+    with op.batch_alter_table('token', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_token_session_expiration'), ['session_expiration'],
+                              unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('token', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_token_session_expiration'))
+
+    with op.batch_alter_table('readers_happiness', schema=None) as batch_op:
+        batch_op.drop_index('ix_readers_happiness_reader_id_happiness_id')
+
+    with op.batch_alter_table('journal', schema=None) as batch_op:
+        batch_op.drop_index('ix_journal_user_id_timestamp')
+
+    with op.batch_alter_table('happiness', schema=None) as batch_op:
+        batch_op.drop_index('ix_happiness_user_id_timestamp')
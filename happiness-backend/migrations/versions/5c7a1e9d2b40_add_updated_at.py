@@ -0,0 +1,35 @@
+"""add updated_at to happiness and journal
+
+Revision ID: 5c7a1e9d2b40
+Revises: 8d51c0f3a2e6
+Create Date: 2026-10-17 13:05:27.114203
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5c7a1e9d2b40'
+down_revision = '8d51c0f3a2e6'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('happiness', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('updated_at', sa.DateTime(), nullable=True))
+
+    with op.batch_alter_table('journal', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('updated_at', sa.DateTime(), nullable=True))
+
+    op.execute("UPDATE happiness SET updated_at = CURRENT_TIMESTAMP")
+    op.execute("UPDATE journal SET updated_at = CURRENT_TIMESTAMP")
+
+
+def downgrade():
+    with op.batch_alter_table('journal', schema=None) as batch_op:
+        batch_op.drop_column('updated_at')
+
+    with op.batch_alter_table('happiness', schema=None) as batch_op:
+        batch_op.drop_column('updated_at')
@@ -0,0 +1,63 @@
+"""unique happiness and journal entry per day
+
+Revision ID: 8d51c0f3a2e6
+Revises: 3b9e2d7c41a8
+Create Date: 2026-10-17 11:03:18.224710
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8d51c0f3a2e6'
+down_revision = '3b9e2d7c41a8'
+branch_labels = None
+depends_on = None
+
+# ids of entries that are not the first (lowest id) entry for their user and day,
+# which was the entry updated by the old check-then-insert code
+DUPLICATE_IDS = '''
+    SELECT t.id FROM {table} t WHERE EXISTS (
+        SELECT 1 FROM {table} t2
+        WHERE t2.user_id = t.user_id AND t2.timestamp = t.timestamp AND t2.id < t.id
+    )
+'''
+
+
+def upgrade():
+    # remove duplicate entries left by concurrent submits, moving their comments to the kept entry
+    duplicate_happiness = DUPLICATE_IDS.format(table='happiness')
+    op.execute(f'''
+        UPDATE comment SET happiness_id = (
+            SELECT MIN(h2.id) FROM happiness h, happiness h2
+            WHERE h.id = comment.happiness_id
+              AND h2.user_id = h.user_id AND h2.timestamp = h.timestamp
+        )
+        WHERE happiness_id IN ({duplicate_happiness})
+    ''')
+    op.execute(f'DELETE FROM readers_happiness WHERE happiness_id IN ({duplicate_happiness})')
+    op.execute(f'DELETE FROM happiness WHERE id IN ({duplicate_happiness})')
+    op.execute(f"DELETE FROM journal WHERE id IN ({DUPLICATE_IDS.format(table='journal')})")
+
+    with op.batch_alter_table('happiness', schema=None) as batch_op:
+        batch_op.drop_index('ix_happiness_user_id_timestamp')
+        batch_op.create_index('ix_happiness_user_id_timestamp', ['user_id', 'timestamp'],
+                              unique=True, postgresql_include=['value'])
+
+    with op.batch_alter_table('journal', schema=None) as batch_op:
+        batch_op.drop_index('ix_journal_user_id_timestamp')
+        batch_op.create_index('ix_journal_user_id_timestamp', ['user_id', 'timestamp'],
+                              unique=True)
+
+
+def downgrade():
+    with op.batch_alter_table('journal', schema=None) as batch_op:
+        batch_op.drop_index('ix_journal_user_id_timestamp')
+        batch_op.create_index('ix_journal_user_id_timestamp', ['user_id', 'timestamp'],
+                              unique=False)
+
+    with op.batch_alter_table('happiness', schema=None) as batch_op:
+        batch_op.drop_index('ix_happiness_user_id_timestamp')
+        batch_op.create_index('ix_happiness_user_id_timestamp', ['user_id', 'timestamp'],
+                              unique=False, postgresql_include=['value'])
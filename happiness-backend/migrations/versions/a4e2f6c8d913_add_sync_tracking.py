@@ -0,0 +1,61 @@
+"""add updated_at to comments and reads, and deletion tombstones
+
+Revision ID: a4e2f6c8d913
+Revises: 5c7a1e9d2b40
+Create Date: 2026-10-17 14:21:09.550317
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a4e2f6c8d913'
+down_revision = '5c7a1e9d2b40'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('tombstone',
+    sa.Column('id', sa.Integer(), autoincrement=True, nullable=False),
+    sa.Column('kind', sa.String(), nullable=False),
+    sa.Column('row_id', sa.Integer(), nullable=False),
+    sa.Column('owner_id', sa.Integer(), nullable=False),
+    sa.Column('deleted_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    with op.batch_alter_table('tombstone', schema=None) as batch_op:
+        batch_op.create_index('ix_tombstone_owner_id_deleted_at', ['owner_id', 'deleted_at'], unique=False)
+        batch_op.create_index(batch_op.f('ix_tombstone_deleted_at'), ['deleted_at'], unique=False)
+
+    with op.batch_alter_table('comment', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('updated_at', sa.DateTime(), nullable=True))
+        batch_op.create_index(batch_op.f('ix_comment_updated_at'), ['updated_at'], unique=False)
+
+    with op.batch_alter_table('readers_happiness', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('updated_at', sa.DateTime(), nullable=True))
+
+    with op.batch_alter_table('happiness', schema=None) as batch_op:
+        batch_op.create_index('ix_happiness_user_id_updated_at', ['user_id', 'updated_at'], unique=False)
+
+    op.execute("UPDATE comment SET updated_at = timestamp")
+    op.execute("UPDATE readers_happiness SET updated_at = CURRENT_TIMESTAMP")
+
+
+def downgrade():
+    with op.batch_alter_table('happiness', schema=None) as batch_op:
+        batch_op.drop_index('ix_happiness_user_id_updated_at')
+
+    with op.batch_alter_table('readers_happiness', schema=None) as batch_op:
+        batch_op.drop_column('updated_at')
+
+    with op.batch_alter_table('comment', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_comment_updated_at'))
+        batch_op.drop_column('updated_at')
+
+    with op.batch_alter_table('tombstone', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_tombstone_deleted_at'))
+        batch_op.drop_index('ix_tombstone_owner_id_deleted_at')
+
+    op.drop_table('tombstone')
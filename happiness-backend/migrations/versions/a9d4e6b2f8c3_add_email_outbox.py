@@ -0,0 +1,38 @@
+"""add email outbox
+
+Revision ID: a9d4e6b2f8c3
+Revises: f2a7c5e9d3b1
+Create Date: 2026-10-17 20:03:27.716254
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a9d4e6b2f8c3'
+down_revision = 'f2a7c5e9d3b1'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('email_outbox',
+    sa.Column('id', sa.Integer(), autoincrement=True, nullable=False),
+    sa.Column('template', sa.String(), nullable=False),
+    sa.Column('subject', sa.String(), nullable=False),
+    sa.Column('recipient', sa.String(), nullable=False),
+    sa.Column('context', sa.Text(), nullable=False),
+    sa.Column('attempts', sa.Integer(), nullable=False),
+    sa.Column('next_attempt', sa.DateTime(), nullable=False),
+    sa.Column('error', sa.String(), nullable=True),
+    sa.Column('dead', sa.Boolean(), nullable=False),
+    sa.Column('created', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_email_outbox_dead_next_attempt', 'email_outbox', ['dead', 'next_attempt'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_email_outbox_dead_next_attempt', table_name='email_outbox')
+    op.drop_table('email_outbox')
@@ -0,0 +1,28 @@
+"""add lower(email) and lower(username) indexes
+
+Revision ID: b8f3e1d2c7a4
+Revises: e7b2c4f1a9d6
+Create Date: 2026-10-17 19:12:37.508214
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b8f3e1d2c7a4'
+down_revision = 'e7b2c4f1a9d6'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.create_index('ix_user_lower_email', [sa.text('lower(email)')], unique=False)
+        batch_op.create_index('ix_user_lower_username', [sa.text('lower(username)')], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.drop_index('ix_user_lower_username')
+        batch_op.drop_index('ix_user_lower_email')
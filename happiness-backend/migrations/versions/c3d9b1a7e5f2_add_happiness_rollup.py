@@ -0,0 +1,61 @@
+"""add happiness rollup table
+
+Revision ID: c3d9b1a7e5f2
+Revises: a4e2f6c8d913
+Create Date: 2026-10-17 15:02:44.871026
+
+"""
+from collections import defaultdict
+from datetime import timedelta
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c3d9b1a7e5f2'
+down_revision = 'a4e2f6c8d913'
+branch_labels = None
+depends_on = None
+
+
+def _bucket(period, day):
+    if period == 'day':
+        return day
+    if period == 'week':
+        return day - timedelta(days=day.weekday())
+    return day.replace(day=1)
+
+
+def upgrade():
+    rollup = op.create_table('happiness_rollup',
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('period', sa.String(), nullable=False),
+    sa.Column('bucket', sa.Date(), nullable=False),
+    sa.Column('count', sa.Integer(), nullable=False),
+    sa.Column('sum', sa.Float(), nullable=False),
+    sa.Column('sum_sq', sa.Float(), nullable=False),
+    sa.Column('min', sa.Float(), nullable=False),
+    sa.Column('max', sa.Float(), nullable=False),
+    sa.ForeignKeyConstraint(['user_id'], ['user.id'], ),
+    sa.PrimaryKeyConstraint('user_id', 'period', 'bucket')
+    )
+
+    # backfill from the existing entries (same as `flask rebuild-rollups`)
+    happiness = sa.table('happiness', sa.column('user_id', sa.Integer), sa.column('timestamp', sa.DateTime),
+                         sa.column('value', sa.Float))
+    buckets = defaultdict(list)
+    for user_id, timestamp, value in op.get_bind().execute(
+            sa.select(happiness.c.user_id, happiness.c.timestamp, happiness.c.value)
+            .where(happiness.c.timestamp.is_not(None), happiness.c.value.is_not(None))):
+        for period in ('day', 'week', 'month'):
+            buckets[(user_id, period, _bucket(period, timestamp.date()))].append(value)
+    rows = [dict(user_id=user_id, period=period, bucket=bucket, count=len(values), sum=sum(values),
+                 sum_sq=sum(v * v for v in values), min=min(values), max=max(values))
+            for (user_id, period, bucket), values in buckets.items()]
+    if rows:
+        op.bulk_insert(rollup, rows)
+
+
+def downgrade():
+    op.drop_table('happiness_rollup')
@@ -0,0 +1,30 @@
+"""add wrapped table
+
+Revision ID: e7b2c4f1a9d6
+Revises: c3d9b1a7e5f2
+Create Date: 2026-10-17 17:41:09.215384
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e7b2c4f1a9d6'
+down_revision = 'c3d9b1a7e5f2'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('wrapped',
+    sa.Column('year', sa.Integer(), nullable=False),
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('data', sa.Text(), nullable=False),
+    sa.ForeignKeyConstraint(['user_id'], ['user.id'], ondelete='cascade'),
+    sa.PrimaryKeyConstraint('year', 'user_id')
+    )
+
+
+def downgrade():
+    op.drop_table('wrapped')
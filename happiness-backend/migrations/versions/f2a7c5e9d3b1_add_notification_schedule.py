@@ -0,0 +1,50 @@
+"""add notification schedule
+
+Revision ID: f2a7c5e9d3b1
+Revises: b8f3e1d2c7a4
+Create Date: 2026-10-17 19:12:44.508127
+
+"""
+from datetime import datetime
+
+from alembic import op
+import pytz
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f2a7c5e9d3b1'
+down_revision = 'b8f3e1d2c7a4'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    schedule = op.create_table('notification_schedule',
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('minute', sa.Integer(), nullable=False),
+    sa.Column('timezone', sa.String(), nullable=False),
+    sa.ForeignKeyConstraint(['user_id'], ['user.id'], ondelete='cascade'),
+    sa.PrimaryKeyConstraint('user_id')
+    )
+    op.create_index(op.f('ix_notification_schedule_minute'), 'notification_schedule', ['minute'], unique=False)
+
+    # backfill from the enabled notify settings ('HH:MM timezone'), skipping values that are not valid
+    rows = {}
+    for user_id, value in op.get_bind().execute(sa.text(
+            "SELECT user_id, value FROM setting WHERE key = 'notify' AND enabled AND user_id IS NOT NULL")):
+        parts = (value or "").split(" ")
+        if len(parts) != 2 or parts[1] not in pytz.all_timezones_set:
+            continue
+        try:
+            time = datetime.strptime(parts[0], "%H:%M")
+        except ValueError:
+            continue
+        rows[user_id] = dict(user_id=user_id, minute=time.hour * 60 + time.minute, timezone=parts[1])
+    if rows:
+        op.bulk_insert(schedule, list(rows.values()))
+
+
+def downgrade():
+    op.drop_index(op.f('ix_notification_schedule_minute'), table_name='notification_schedule')
+    op.drop_table('notification_schedule')
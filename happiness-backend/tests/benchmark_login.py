@@ -0,0 +1,95 @@
+"""
+Login throughput benchmark for POST /api/token.
+
+Compares the previous login flow (separate email and username lookups, each followed by a password
+check, and a table-wide token clean in the login transaction) against the current one, using an
+in-memory SQLite database. Passwords are hashed with a cheap method by default, so the timings show
+the lookup and transaction costs rather than the (unchanged) password hash.
+
+Usage: `python -m tests.benchmark_login [--users N] [--rounds N] [--expired-tokens N] [--hash-method M]`
+"""
+import argparse
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import insert
+from werkzeug.security import generate_password_hash
+
+from api import create_app
+from api.app import db
+from api.authentication.auth import verify_password
+from api.dao.users_dao import get_user_by_email, get_user_by_username
+from api.models.models import User, Token
+from config import TestConfig
+
+
+def legacy_login(email_or_username: str, password: str):
+    # the login flow before the single lookup
+    user = get_user_by_email(email_or_username)
+    if not (user and user.verify_password(password)):
+        user = get_user_by_username(email_or_username)
+        if not (user and user.verify_password(password)):
+            return None
+    token_obj, token = user.create_token()
+    db.session.add(token_obj)
+    Token.clean()
+    db.session.commit()
+    return token
+
+
+def current_login(email_or_username: str, password: str):
+    # same as the new_token route
+    user = verify_password(email_or_username, password)
+    if user is None:
+        return None
+    token_obj, token = user.create_token()
+    db.session.add(token_obj)
+    db.session.commit()
+    return token
+
+
+def run(name: str, login, logins: list[str]) -> float:
+    start = time.perf_counter()
+    for login_name in logins:
+        assert login(login_name)
+    elapsed = time.perf_counter() - start
+    print(f"{name}: {len(logins)} logins in {elapsed:.2f}s ({len(logins) / elapsed:.1f} logins/s)")
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--users", type=int, default=10)
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--expired-tokens", type=int, default=20000,
+                        help="Tokens expired since the last clean (tokens are cleaned daily).")
+    parser.add_argument("--hash-method", default="pbkdf2:sha256:1",
+                        help="werkzeug password hash method (e.g. scrypt for the production cost).")
+    args = parser.parse_args()
+
+    app = create_app(TestConfig)
+    with app.app_context():
+        db.create_all()
+        users = [User(email=f"user{i}@example.app", username=f"user{i}", password="test")
+                 for i in range(args.users)]
+        for user in users:
+            user.password = generate_password_hash("test", method=args.hash_method)
+        db.session.add_all(users)
+        expired = datetime.utcnow() - timedelta(days=2)
+        db.session.execute(insert(Token), [
+            dict(user_id=1, session_token=f"expired{i}", session_expiration=expired)
+            for i in range(args.expired_tokens)
+        ])
+        db.session.commit()
+
+        # half of the logins use usernames, which previously needed a second lookup
+        logins = [login for i in range(args.users) for login in (f"user{i}@example.app", f"user{i}")]
+        logins *= args.rounds
+
+        legacy = run("legacy", lambda login_name: legacy_login(login_name, "test"), logins)
+        current = run("current", lambda login_name: current_login(login_name, "test"), logins)
+        print(f"speedup: {legacy / current:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
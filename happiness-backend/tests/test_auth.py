@@ -1,16 +1,19 @@
 import base64
+import hashlib
 import random
 import string
 
 import pytest
-from flask import json
+from flask import json, current_app
 from sqlalchemy.sql.functions import current_user
 
 from api import create_app
 from api.app import db
+from api.authentication import token_cache
 from api.dao.groups_dao import get_group_by_id
 from api.dao.users_dao import *
-from api.models.models import Happiness
+from api.models.models import Happiness, NotificationSchedule, Setting
+from api.util.notifications import due_notifications
 from config import TestConfig
 from tests.test_groups import auth_header, invite_in_group_json_model, group_in_user_modal, invite_in_user_modal, \
     user_in_group_json_model
@@ -235,6 +238,54 @@ def test_login_user(client):
         "session_token") is not None
 
 
+def test_login_lookup(client):
+    """
+    Tests logging in with a differently cased email or username, and wrong passwords.
+    """
+    client.post('/api/user/', json={'email': 'Test@Example.com', 'username': 'Test', 'password': 'test'})
+
+    def login(credentials):
+        auth = base64.b64encode(credentials).decode('utf-8')
+        return client.post('/api/token/', headers={"Authorization": f"Basic {auth}"}).status_code
+
+    assert login(b"test@example.COM:test") == 201
+    assert login(b"TEST:test") == 201
+    assert login(b"test:wrong") == 401
+    assert login(b"t%:test") == 401
+
+
+def test_token_cache(init_client):
+    client, tokens = init_client
+    hashed_token = hashlib.sha256(tokens[0].encode()).hexdigest()
+
+    # disabled by default in tests
+    client.get('/api/user/self/', headers=auth_header(tokens[0]))
+    assert token_cache.get_user_id(hashed_token) is None
+
+    current_app.config['TOKEN_CACHE_TTL'] = 60
+    token_cache.init_app(current_app)
+
+    get_self = client.get('/api/user/self/', headers=auth_header(tokens[0]))
+    assert get_self.status_code == 200
+    assert token_cache.get_user_id(hashed_token) == 1
+
+    cached_get_self = client.get('/api/user/self/', headers=auth_header(tokens[0]))
+    assert cached_get_self.status_code == 200 and cached_get_self.json['id'] == 1
+
+    revoke = client.delete('/api/token/', headers=auth_header(tokens[0]))
+    assert revoke.status_code == 204
+    assert token_cache.get_user_id(hashed_token) is None
+    revoked_get_self = client.get('/api/user/self/', headers=auth_header(tokens[0]))
+    assert revoked_get_self.status_code == 401
+
+    client.get('/api/user/self/', headers=auth_header(tokens[1]))
+    delete_user = client.delete('/api/user/', json={'password': 'test'}, headers=auth_header(tokens[1]))
+    assert delete_user.status_code == 204
+    assert token_cache.get_user_id(hashlib.sha256(tokens[1].encode()).hexdigest()) is None
+    deleted_get_self = client.get('/api/user/self/', headers=auth_header(tokens[1]))
+    assert deleted_get_self.status_code == 401
+
+
 def test_delete_user(client):
     user_create_response = client.post('/api/user/', json={
         'email': 'test@example.com',
@@ -438,13 +489,13 @@ def test_add_user_setting(client):
                                            json={
                                                "key": k4,
                                                "enabled": not v4,
-                                               "value": "2000"
+                                               "value": "20:00 UTC"
                                            })
     assert add_email_notif_time_res.status_code == 201
     b4 = json.loads(add_email_notif_time_res.get_data())
     assert b4.get("key") == k4
     assert b4.get("enabled") == True
-    assert b4.get("value") == "2000"
+    assert b4.get("value") == "20:00 UTC"
 
     # def test_get_user_settings(client):
     """
@@ -479,6 +530,60 @@ def test_add_user_setting(client):
     assert settings[1].get("enabled") == v2
 
 
+def test_due_notifications(init_client):
+    """
+    Tests the notification schedule kept from notify settings, and finding the users due a reminder
+    notification and their missing dates.
+    """
+    client, tokens = init_client
+
+    def notify(token, value, enabled=True, status_code=201):
+        setting = {"key": "notify", "enabled": enabled}
+        if value is not None:
+            setting["value"] = value
+        res = client.post('/api/user/settings/', json=setting, headers=auth_header(token))
+        assert res.status_code == status_code
+
+    notify(tokens[0], "20:00 America/New_York")
+    notify(tokens[1], "19:45 Asia/Tokyo")
+    notify(tokens[2], "20:30 UTC")
+    assert [(s.user_id, s.minute, s.timezone) for s in NotificationSchedule.query.order_by("user_id")] == [
+        (1, 1200, "America/New_York"), (2, 1185, "Asia/Tokyo"), (3, 1230, "UTC")]
+    # invalid values are rejected
+    notify(tokens[2], "2030", status_code=400)
+    notify(tokens[2], "20:30 Not/AZone", status_code=400)
+    assert db.session.get(NotificationSchedule, 3).minute == 1230
+    assert Setting.query.filter_by(user_id=3, key="notify").one().value == "20:30 UTC"
+    notify(tokens[2], "00:00 UTC")
+
+    # user 1 (still March 10th) is missing the 7th, user 2 (already March 11th) is missing the 10th
+    for day in [4, 5, 6, 8, 9]:
+        db.session.add(Happiness(user_id=1, value=5, comment="", timestamp=datetime(2024, 3, day)))
+    for day in [4, 5, 6, 7, 8, 9]:
+        db.session.add(Happiness(user_id=2, value=5, comment="", timestamp=datetime(2024, 3, day)))
+    db.session.commit()
+
+    now = datetime(2024, 3, 10, 20, 0)
+    assert sorted(due_notifications(now)) == [
+        (1, "test1@example.app", "user1", ["03-07"]),
+        (2, "test2@example.app", "user2", ["03-10"]),
+    ]
+    # a delayed job still covers the times up to its tick
+    assert len(due_notifications(datetime(2024, 3, 10, 20, 7))) == 2
+    assert due_notifications(datetime(2024, 3, 10, 20, 30)) == []
+    assert [n.user_id for n in due_notifications(datetime(2024, 3, 10, 0, 0))] == [3]
+
+    # complete weeks (including today) are not reminded
+    db.session.add(Happiness(user_id=1, value=5, comment="", timestamp=datetime(2024, 3, 10)))
+    db.session.commit()
+    assert [notification.user_id for notification in due_notifications(now)] == [2]
+
+    notify(tokens[1], None, enabled=False)
+    assert due_notifications(now) == []
+    notify(tokens[1], None)
+    assert [notification.user_id for notification in due_notifications(now)] == [2]
+
+
 def test_change_username(client):
     """
     Tests to change the username of a randomly generated user.
@@ -0,0 +1,261 @@
+import smtplib
+import threading
+import time
+from datetime import datetime, timedelta
+
+import pytest
+from flask import current_app
+
+from api import create_app
+from api.app import db
+from api.models.models import User, OutboxEmail
+from api.util import email_executor, email_methods, email_outbox
+from config import TestConfig
+from tests.test_groups import auth_header, InMemoryRedis
+
+
+@pytest.fixture
+def init_client():
+    app = create_app(TestConfig)
+
+    client = app.test_client()
+    with app.app_context():
+        db.create_all()
+
+        user1 = User(email='test1@example.app', username='user1', password='test')
+        user2 = User(email='test2@example.app', username='user2', password='test')
+        user3 = User(email='test3@example.app', username='user3', password='test')
+        db.session.add_all([user1, user2, user3])
+        db.session.commit()
+        token_objs, tokens = zip(*[user1.create_token(), user2.create_token(), user3.create_token()])
+        db.session.add_all(token_objs)
+        db.session.commit()
+
+        yield client, tokens
+
+
+class FakeSMTP:
+    """
+    SMTP connection that refuses the recipients in `refused` (or temporarily, in `greylisted`)
+    or fails the recipients in `failing`.
+    """
+    connections = []
+    refused = set()
+    greylisted = set()
+    failing = set()
+
+    def __init__(self, host, port):
+        self.sent = []
+        FakeSMTP.connections.append(self)
+
+    def set_debuglevel(self, level):
+        pass
+
+    def sendmail(self, sender, recipients, message, mail_options, rcpt_options):
+        if recipients[0] in FakeSMTP.refused:
+            raise smtplib.SMTPRecipientsRefused({recipients[0]: (550, b"No such user")})
+        if recipients[0] in FakeSMTP.greylisted:
+            raise smtplib.SMTPRecipientsRefused({recipients[0]: (451, b"Greylisted, try again later")})
+        if recipients[0] in FakeSMTP.failing:
+            raise smtplib.SMTPDataError(451, b"Try again later")
+        self.sent.append((recipients[0], message))
+
+    def quit(self):
+        pass
+
+
+def use_smtp_server(host, port):
+    current_app.config.update(MAIL_SERVER=host, MAIL_PORT=port, MAIL_SUPPRESS_SEND=False,
+                              MAIL_USE_SSL=False, MAIL_USE_TLS=False, MAIL_USERNAME=None)
+    email_methods.init_app(current_app)
+
+
+def test_email_outbox(init_client):
+    client, tokens = init_client
+    client.post('/api/group/', json={'name': 'test group'}, headers=auth_header(tokens[0]))
+    client.put('/api/group/1', json={'invite_users': ['user2', 'user3']}, headers=auth_header(tokens[0]))
+    assert client.post('/api/user/nudge/', json={'email': 'friend@example.app'},
+                       headers=auth_header(tokens[0])).status_code == 204
+
+    # queued with the invites, not sent yet
+    assert [email.recipient for email in OutboxEmail.query.order_by(OutboxEmail.id)] == \
+           ['test2@example.app', 'test3@example.app', 'friend@example.app']
+
+    with email_methods.mail.record_messages() as outbox:
+        assert email_outbox.drain() == (3, 0)
+    assert [message.recipients for message in outbox] == \
+           [['test2@example.app'], ['test3@example.app'], ['friend@example.app']]
+    assert outbox[0].subject == 'Happiness App Group Invite'
+    assert 'test group' in outbox[0].body and 'user2' in outbox[0].html
+    assert 'friend@example.app' in outbox[2].body
+    assert OutboxEmail.query.count() == 0
+    assert email_outbox.drain() == (0, 0)
+
+
+def test_email_outbox_retries(init_client, monkeypatch):
+    monkeypatch.setattr(smtplib, "SMTP", FakeSMTP)
+    monkeypatch.setattr(FakeSMTP, "connections", [])
+    monkeypatch.setattr(FakeSMTP, "refused", {"refused@example.app"})
+    monkeypatch.setattr(FakeSMTP, "greylisted", {"greylisted@example.app"})
+    monkeypatch.setattr(FakeSMTP, "failing", {"flaky@example.app"})
+    use_smtp_server("localhost", 2525)
+
+    for recipient in ["a@example.app", "refused@example.app", "greylisted@example.app", "flaky@example.app",
+                      "b@example.app"]:
+        email_outbox.queue_email("notify_happiness", "Enter Your Happiness :)", recipient,
+                                 user=dict(username="user1"), dates="03-07")
+    db.session.commit()
+
+    # one connection for the batch
+    assert email_outbox.drain_all() == (2, 3)
+    assert len(FakeSMTP.connections) == 1
+    assert [recipient for recipient, _ in FakeSMTP.connections[0].sent] == ["a@example.app", "b@example.app"]
+
+    refused = OutboxEmail.query.filter_by(recipient="refused@example.app").one()
+    assert refused.dead and refused.attempts == 1 and "SMTPRecipientsRefused" in refused.error
+    flaky = OutboxEmail.query.filter_by(recipient="flaky@example.app").one()
+    assert not flaky.dead and flaky.attempts == 1 and flaky.next_attempt > datetime.utcnow()
+    # temporary refusals are retried
+    greylisted = OutboxEmail.query.filter_by(recipient="greylisted@example.app").one()
+    assert not greylisted.dead and greylisted.attempts == 1 and greylisted.next_attempt > datetime.utcnow()
+    FakeSMTP.greylisted.clear()
+    greylisted.next_attempt = datetime.utcnow()
+    db.session.commit()
+    assert email_outbox.drain() == (1, 0)
+
+    # retried with backoff, then dead-lettered
+    assert email_outbox.drain() == (0, 0)
+    for attempt in range(2, email_outbox.MAX_ATTEMPTS + 1):
+        flaky.next_attempt = datetime.utcnow()
+        db.session.commit()
+        assert email_outbox.drain() == (0, 1)
+        assert flaky.attempts == attempt
+    assert flaky.dead
+
+    # dead letters can be retried
+    FakeSMTP.failing.clear()
+    result = current_app.test_cli_runner().invoke(args=["drain-outbox", "--retry-dead"])
+    assert "Sent 1 emails, 1 failed (1 dead letters)" in result.output
+    assert [email.recipient for email in OutboxEmail.query] == ["refused@example.app"]
+
+
+def test_email_outbox_lease(init_client, monkeypatch):
+    monkeypatch.setattr(smtplib, "SMTP", FakeSMTP)
+    monkeypatch.setattr(FakeSMTP, "connections", [])
+    use_smtp_server("localhost", 2525)
+
+    def queue(*recipients):
+        for recipient in recipients:
+            email_outbox.queue_email("notify_happiness", "Enter Your Happiness :)", recipient,
+                                     user=dict(username="user1"), dates="03-07")
+        db.session.commit()
+
+    # emails are leased (and their rows unlocked) while they are sent, so a concurrent drain skips them
+    queue("a@example.app", "b@example.app")
+    concurrent = []
+    sendmail = FakeSMTP.sendmail
+
+    def sendmail_during_drain(self, *args):
+        concurrent.append(email_outbox.drain())
+        return sendmail(self, *args)
+
+    monkeypatch.setattr(FakeSMTP, "sendmail", sendmail_during_drain)
+    assert email_outbox.drain() == (2, 0)
+    assert concurrent == [(0, 0), (0, 0)]
+
+    # the emails of a drain that crashed are sent once their lease expires
+    def crash(self, *args):
+        raise RuntimeError("worker killed")
+
+    queue("c@example.app")
+    monkeypatch.setattr(FakeSMTP, "sendmail", crash)
+    with pytest.raises(RuntimeError):
+        email_outbox.drain()
+    db.session.rollback()
+    monkeypatch.setattr(FakeSMTP, "sendmail", sendmail)
+    assert email_outbox.drain() == (0, 0)
+    email = OutboxEmail.query.one()
+    assert email.next_attempt > datetime.utcnow() + email_outbox.LEASE - timedelta(minutes=1)
+    email.next_attempt = datetime.utcnow()
+    db.session.commit()
+    assert email_outbox.drain() == (1, 0)
+
+    # emails are released if the SMTP server cannot be connected to
+    def refuse(host, port):
+        raise ConnectionRefusedError()
+
+    queue("d@example.app")
+    monkeypatch.setattr(smtplib, "SMTP", refuse)
+    with pytest.raises(ConnectionRefusedError):
+        email_outbox.drain()
+    monkeypatch.setattr(smtplib, "SMTP", FakeSMTP)
+    assert email_outbox.drain() == (1, 0)
+    assert OutboxEmail.query.count() == 0
+
+
+def test_email_outbox_smtp_sink(init_client):
+    controller_module = pytest.importorskip("aiosmtpd.controller")
+    received = []
+
+    class Handler:
+        async def handle_DATA(self, server, session, envelope):
+            received.append((session.peer, envelope.rcpt_tos[0]))
+            return "250 OK"
+
+    controller = controller_module.Controller(Handler(), hostname="127.0.0.1", port=8025)
+    controller.start()
+    try:
+        use_smtp_server("127.0.0.1", 8025)
+        for i in range(5):
+            email_outbox.queue_email("notify_happiness", "Enter Your Happiness :)", f"user{i}@example.app",
+                                     user=dict(username=f"user{i}"), dates="03-07")
+        db.session.commit()
+        assert email_outbox.drain_all() == (5, 0)
+    finally:
+        controller.stop()
+
+    assert [recipient for _, recipient in received] == [f"user{i}@example.app" for i in range(5)]
+    # all sent over the same connection
+    assert len({peer for peer, _ in received}) == 1
+
+
+def test_email_executor(init_client, monkeypatch):
+    client, tokens = init_client
+    current_app.config.update(EMAIL_WORKERS=2, EMAIL_QUEUE_SIZE=3, EMAIL_SUBMIT_TIMEOUT=0.1)
+    current_app.redis = InMemoryRedis()
+    monkeypatch.setattr(email_executor, "_executor", None)
+
+    def wait_until_idle():
+        for _ in range(100):
+            if email_executor.queue_depth() == 0:
+                return
+            time.sleep(0.05)
+        raise AssertionError("email executor did not finish")
+
+    try:
+        # backpressure: only 3 tasks can be waiting or running
+        release = threading.Event()
+        assert all(email_executor.submit(release.wait) for _ in range(3))
+        assert email_executor.queue_depth() == 3
+        assert not email_executor.submit(release.wait)
+        res = client.post('/api/user/initiate_password_reset/', json={'email': 'test1@example.app'})
+        assert res.status_code == 503
+        result = current_app.test_cli_runner().invoke(args=["email-stats"])
+        assert "queue depth: 3, outbox: 0 pending, 0 dead letters" in result.output
+        release.set()
+        wait_until_idle()
+        # idle processes are removed from the queue depths
+        assert current_app.redis.hgetall(email_executor.DEPTH_KEY) == {}
+
+        with email_methods.mail.record_messages() as outbox:
+            assert client.post('/api/user/initiate_password_reset/',
+                               json={'email': 'test1@example.app'}).status_code == 204
+            # invite emails are sent right after they are committed
+            client.post('/api/group/', json={'name': 'test group'}, headers=auth_header(tokens[0]))
+            client.put('/api/group/1', json={'invite_users': ['user2', 'user3']}, headers=auth_header(tokens[0]))
+            wait_until_idle()
+        assert sorted(message.recipients[0] for message in outbox) == \
+               ['test1@example.app', 'test2@example.app', 'test3@example.app']
+        assert OutboxEmail.query.count() == 0
+    finally:
+        email_executor.shutdown()
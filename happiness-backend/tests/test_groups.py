@@ -1,16 +1,102 @@
 import random
-from datetime import datetime
+from datetime import date, datetime
 
 import pytest
+from flask import g, current_app
+from sqlalchemy import event
 
 from api import create_app
 from api.app import db
-from api.dao.groups_dao import get_group_by_id
+from api.dao.groups_dao import get_group_by_id, get_co_member_ids, get_mutual_group_user_ids
 from api.dao.users_dao import *
 from api.models.models import Happiness
+from api.util import group_happiness_cache
 from config import TestConfig
 
 
+class InMemoryPipeline:
+    def __init__(self, redis):
+        self.redis = redis
+        self.commands = []
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: self.commands.append((name, args, kwargs))
+
+    def execute(self):
+        return [getattr(self.redis, name)(*args, **kwargs) for name, args, kwargs in self.commands]
+
+
+class InMemoryRedis:
+    """Implements the few Redis commands used by the group happiness cache and unread index."""
+
+    def __init__(self):
+        self.data = {}
+
+    def pipeline(self):
+        return InMemoryPipeline(self)
+
+    def exists(self, key):
+        return int(key in self.data)
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value, ex=None):
+        self.data[key] = str(value).encode()
+
+    def incr(self, key):
+        self.data[key] = str(int(self.data.get(key, 0)) + 1).encode()
+        return int(self.data[key])
+
+    def delete(self, *keys):
+        for key in keys:
+            self.data.pop(key, None)
+
+    def expire(self, key, ttl):
+        pass
+
+    def sadd(self, key, *members):
+        self.data.setdefault(key, set()).update(m.encode() for m in members)
+
+    def smembers(self, key):
+        return set(self.data.get(key, set()))
+
+    def srem(self, key, *members):
+        self.data.get(key, set()).difference_update(m.encode() for m in members)
+
+    def hincrby(self, key, field, amount):
+        hash_ = self.data.setdefault(key, {})
+        hash_[field.encode()] = hash_.get(field.encode(), 0) + amount
+
+    def hset(self, key, field, value):
+        self.data.setdefault(key, {})[field.encode()] = str(value).encode()
+
+    def hdel(self, key, *fields):
+        for field in fields:
+            self.data.get(key, {}).pop(field.encode(), None)
+
+    def hgetall(self, key):
+        return self.data.get(key, {})
+
+    def zadd(self, key, mapping):
+        self.data.setdefault(key, {}).update({m.encode(): score for m, score in mapping.items()})
+
+    def zrem(self, key, *members):
+        for member in members:
+            self.data.get(key, {}).pop(member.encode(), None)
+
+    def zremrangebyscore(self, key, low, high):
+        # only supports removing everything below an exclusive max
+        high = float(high.lstrip("("))
+        zset = self.data.get(key, {})
+        for member in [m for m, score in zset.items() if score < high]:
+            zset.pop(member)
+
+    def zrangebyscore(self, key, low, high):
+        zset = self.data.get(key, {})
+        return [m for m, score in sorted(zset.items(), key=lambda item: item[1]) if low <= score <= high]
+
+
 @pytest.fixture
 def init_client():
     app = create_app(TestConfig)
@@ -83,6 +169,65 @@ def test_edit_group_name(init_client):
     assert name_edit.json['name'] == get_group_by_id(1).name == 'successful'
 
 
+def test_batch_invite_and_remove_users(init_client):
+    client, tokens = init_client
+    client.post('/api/group/', json={'name': 'test'}, headers=auth_header(tokens[0]))
+    group = get_group_by_id(1)
+
+    user_queries = []
+
+    def count_user_queries(conn, cursor, statement, parameters, context, executemany):
+        if statement.startswith("SELECT") and "FROM user" in statement:
+            user_queries.append(statement)
+
+    event.listen(db.engine, "before_cursor_execute", count_user_queries)
+    try:
+        # case-insensitive and exact (no wildcards), skipping members, unknown users, and duplicates
+        group.invite_users(['USER2', 'user2', 'user1', 'nobody', 'user_'])
+        db.session.commit()
+    finally:
+        event.remove(db.engine, "before_cursor_execute", count_user_queries)
+    assert len(user_queries) == 1
+    assert [user.username for user in group.invited_users] == ['user2']
+    assert [invite.id for invite in get_user_by_id(2).invites] == [1]
+
+    group.invite_users(['User3', 'user2'])
+    group.add_users([get_user_by_username('user3')])
+    db.session.commit()
+    assert sorted(user.username for user in group.users) == ['user1', 'user3']
+    assert [user.username for user in group.invited_users] == ['user2']
+
+    group.remove_users(['USER3', 'user2', 'nobody'])
+    db.session.commit()
+    assert [user.username for user in group.users] == ['user1']
+    assert group.invited_users == []
+    assert get_user_by_id(2).invites == []
+    assert get_co_member_ids(1) == {1}
+
+    # users who are not invited are skipped
+    group.invite_users(['user2', 'user3'])
+    db.session.commit()
+    assert get_co_member_ids(2) == set()
+    users = [get_user_by_username(username) for username in ['user1', 'user2', 'user3']]
+    writes = []
+
+    def count_writes(conn, cursor, statement, parameters, context, executemany):
+        if statement.startswith(("INSERT", "DELETE")):
+            writes.append(statement.split()[0])
+
+    event.listen(db.engine, "before_cursor_execute", count_writes)
+    try:
+        group.add_users(users)
+        db.session.commit()
+    finally:
+        event.remove(db.engine, "before_cursor_execute", count_writes)
+    assert writes == ['DELETE', 'INSERT']
+    assert sorted(user.username for user in group.users) == ['user1', 'user2', 'user3']
+    assert group.invited_users == [] and get_user_by_id(3).invites == []
+    assert [g.id for g in get_user_by_id(3).groups] == [1]
+    assert get_co_member_ids(2) == {1, 2, 3}
+
+
 def test_edit_group_users(init_client):
     client, tokens = init_client
     client.post('/api/group/', json={'name': 'test'}, headers=auth_header(tokens[0]))
@@ -160,6 +305,32 @@ def test_mutual_groups(init_client):
     assert get_user_by_id(2).has_mutual_group(get_user_by_id(1))
 
 
+def test_co_members(init_client):
+    client, tokens = init_client
+    client.post('/api/group/', json={'name': 'group 1'}, headers=auth_header(tokens[0]))
+    client.post('/api/group/', json={'name': 'group 2'}, headers=auth_header(tokens[0]))
+    assert get_co_member_ids(1) == {1} and get_co_member_ids(2) == set()
+
+    get_group_by_id(1).invite_users(['user2'])
+    get_group_by_id(1).add_users([get_user_by_id(2)])
+    get_group_by_id(2).invite_users(['user3'])
+    get_group_by_id(2).add_users([get_user_by_id(3)])
+    db.session.commit()
+    assert get_co_member_ids(1) == {1, 2, 3}
+    assert get_co_member_ids(2) == {1, 2}
+    assert get_mutual_group_user_ids(3, [1, 2, 3]) == {1, 3}
+    g.pop('co_member_ids')
+    assert get_mutual_group_user_ids(2, [1, 3]) == {1}
+    assert get_mutual_group_user_ids(2, []) == set()
+
+    client.put('/api/group/1', json={'remove_users': ['user2']}, headers=auth_header(tokens[0]))
+    assert not get_user_by_id(1).has_mutual_group_id(2)
+    assert get_co_member_ids(1) == {1, 3} and get_co_member_ids(2) == set()
+
+    client.delete('/api/group/2', headers=auth_header(tokens[0]))
+    assert get_co_member_ids(1) == {1} and get_co_member_ids(3) == set()
+
+
 def test_group_delete(init_client):
     client, tokens = init_client
     client.post('/api/group/', json={'name': ':-)'}, headers=auth_header(tokens[0]))
@@ -206,3 +377,65 @@ def test_group_happiness(init_client):
         'start': '2023-02-01'
     }, headers=auth_header(tokens[0]))
     assert len(get_happiness_week.json) == 21
+
+
+def test_group_happiness_cache(init_client):
+    client, tokens = init_client
+    current_app.config['GROUP_HAPPINESS_CACHE_TTL'] = 300
+    current_app.redis = InMemoryRedis()
+
+    client.post('/api/group/', json={'name': 'group 1'}, headers=auth_header(tokens[0]))
+    get_group_by_id(1).invite_users(['user2'])
+    get_group_by_id(1).add_users([get_user_by_id(2)])
+    db.session.commit()
+    for token, value in [(tokens[0], 5), (tokens[1], 6)]:
+        client.post('/api/happiness/', json={'value': value, 'timestamp': '2023-06-05'},
+                    headers=auth_header(token))
+
+    def group_week(start='2023-06-01', end='2023-06-07'):
+        res = client.get('/api/group/1/happiness', query_string={'start': start, 'end': end},
+                         headers=auth_header(tokens[0]))
+        assert res.status_code == 200
+        return res.json
+
+    def stats():
+        return {k.decode(): v for k, v in current_app.redis.hgetall(group_happiness_cache.STATS_KEY).items()}
+
+    week = group_week()
+    assert [h['value'] for h in week] == [5, 6]
+    assert group_week() == week
+    assert stats() == {'misses': 1, 'hits': 1}
+
+    # only ranges containing the changed day are invalidated
+    group_week('2023-06-08', '2023-06-14')
+    client.put('/api/happiness/', query_string={'date': '2023-06-05'}, json={'value': 8},
+               headers=auth_header(tokens[1]))
+    assert [h['value'] for h in group_week()] == [5, 8]
+    group_week('2023-06-08', '2023-06-14')
+    assert stats() == {'misses': 3, 'hits': 2}
+
+    client.delete('/api/happiness/', query_string={'date': '2023-06-05'}, headers=auth_header(tokens[1]))
+    assert [h['value'] for h in group_week()] == [5]
+
+    # entries read before a change are not cached once it is committed
+    generation = group_happiness_cache.generation(1)
+    stale = group_week()
+    current_app.redis.delete('group_happiness:1:2023-06-01:2023-06-07')
+    client.post('/api/happiness/', json={'value': 7, 'timestamp': '2023-06-06'}, headers=auth_header(tokens[1]))
+    group_happiness_cache.put(1, date(2023, 6, 1), date(2023, 6, 7), stale, generation)
+    assert [h['value'] for h in group_week()] == [5, 7]
+    client.delete('/api/happiness/', query_string={'date': '2023-06-06'}, headers=auth_header(tokens[1]))
+
+    # membership changes invalidate all of the group's ranges
+    client.post('/api/happiness/', json={'value': 2, 'timestamp': '2023-06-10'},
+                headers=auth_header(tokens[2]))
+    group_week('2023-06-08', '2023-06-14')
+    get_group_by_id(1).invite_users(['user3'])
+    get_group_by_id(1).add_users([get_user_by_id(3)])
+    db.session.commit()
+    assert [h['value'] for h in group_week('2023-06-08', '2023-06-14')] == [2]
+
+    # so do changes to the authors embedded in the entries
+    assert group_week('2023-06-08', '2023-06-14')[0]['author']['username'] == 'user3'
+    client.put('/api/user/info/', json={'data_type': 'username', 'data': 'renamed'}, headers=auth_header(tokens[2]))
+    assert group_week('2023-06-08', '2023-06-14')[0]['author']['username'] == 'renamed'
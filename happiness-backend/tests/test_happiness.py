@@ -4,10 +4,11 @@ import json
 import pytest
 
 from api import create_app
+from api.dao import rollup_dao
 from api.dao.groups_dao import get_group_by_id
 from api.dao.happiness_dao import *
 from api.dao.users_dao import get_user_by_id, get_user_by_username
-from api.models.models import User
+from api.models.models import User, Setting, Journal
 from config import TestConfig
 
 
@@ -79,6 +80,41 @@ def test_overwrite_create_happiness_entry(init_client):
     assert happiness_list[0].get("value") == 8
 
 
+def test_upsert_happiness_entry(init_client):
+    client, tokens = init_client
+
+    happiness, created = upsert_happiness(1, datetime(2023, 1, 11), 4, 'great day')
+    assert created and happiness.id == 1
+    happiness, created = upsert_happiness(1, datetime(2023, 1, 11), 8, 'amazing day')
+    assert not created and happiness.id == 1
+    assert happiness.value == 8 and happiness.comment == 'amazing day'
+    happiness, created = upsert_happiness(2, datetime(2023, 1, 11), 5, None)
+    assert created and happiness.id == 2
+    # an insert into another table with the same row ID as the new entry
+    setting = Setting(key="test", enabled=True, user_id=1)
+    setting.id = 3
+    db.session.add(setting)
+    db.session.flush()
+    happiness, created = upsert_happiness(3, datetime(2023, 1, 11), 5, None)
+    assert created and happiness.id == 3
+    db.session.commit()
+
+    overwrite = client.post('/api/happiness/', json={
+        'value': 6,
+        'timestamp': '2023-01-11'
+    }, headers={"Authorization": f"Bearer {tokens[0]}"})
+    assert overwrite.status_code == 201
+    assert overwrite.json['id'] == 1 and overwrite.json['value'] == 6
+    assert len(get_all_happiness(1)) == 1
+
+    bad_overwrite = client.post('/api/happiness/', json={
+        'value': 6.3,
+        'timestamp': '2023-01-11'
+    }, headers={"Authorization": f"Bearer {tokens[0]}"})
+    assert bad_overwrite.status_code == 400
+    assert get_happiness_by_id(1).value == 6
+
+
 def test_edit_happiness(init_client):
     client, tokens = init_client
     happiness_create_response = client.post('/api/happiness/', json={
@@ -651,3 +687,279 @@ def test_discussion_comments_delete(init_client):
         'start': '2023-06-19'
     }, headers=auth_header(tokens[0]))
     assert get_comments.json[0]['text'] == 'call tonight?'
+
+
+def test_explain_queries_uses_indexes(init_client):
+    client, tokens = init_client
+    init_test_data(client, tokens)
+
+    result = client.application.test_cli_runner().invoke(args=['explain-queries', '--user-id', 1])
+    assert result.exit_code == 0
+    assert 'ix_happiness_user_id_timestamp' in result.output
+    assert '[SEQ SCAN]' not in result.output
+    assert '0 statement(s) with sequential scans' in result.output
+
+
+def test_discussion_comments_paginated(init_client):
+    client, tokens = init_client
+    client.post('/api/group/', json={'name': 'group 1'}, headers=auth_header(tokens[0]))
+    get_group_by_id(1).invite_users(['user2'])
+    get_group_by_id(1).add_users([get_user_by_username('user2')])
+    client.post('/api/happiness/', json={
+        'value': 4.5,
+        'comment': 'bad day',
+        'timestamp': '2023-06-19'
+    }, headers=auth_header(tokens[0]))
+    for text in ['first', 'second', 'third']:
+        client.post('/api/happiness/1/comment', json={'text': text}, headers=auth_header(tokens[1]))
+
+    page1 = client.get('/api/happiness/1/comments', query_string={'count': 2},
+                       headers=auth_header(tokens[0]))
+    assert page1.status_code == 200
+    assert [c['text'] for c in page1.json] == ['first', 'second']
+    assert page1.json[0]['author']['username'] == 'user2'
+    assert 'Next-Cursor' in page1.headers
+
+    page2 = client.get('/api/happiness/1/comments', query_string={
+        'count': 2, 'cursor': page1.headers['Next-Cursor']
+    }, headers=auth_header(tokens[0]))
+    assert page2.status_code == 200
+    assert [c['text'] for c in page2.json] == ['third']
+    assert 'Next-Cursor' not in page2.headers
+
+    page2_by_number = client.get('/api/happiness/1/comments', query_string={'count': 2, 'page': 2},
+                                 headers=auth_header(tokens[0]))
+    assert [c['text'] for c in page2_by_number.json] == ['third']
+
+    bad_cursor = client.get('/api/happiness/1/comments', query_string={'count': 2, 'cursor': 'bad'},
+                            headers=auth_header(tokens[0]))
+    assert bad_cursor.status_code == 400
+
+    for count in [0, -1]:
+        assert client.get('/api/happiness/1/comments', query_string={'count': count},
+                          headers=auth_header(tokens[0])).status_code == 400
+    assert get_visible_comments(1, 1, per_page=0) == ([], None)
+
+
+def test_happiness_cursor_pagination(init_client):
+    client, tokens = init_client
+    client.post('/api/group/', json={'name': 'group 1'}, headers=auth_header(tokens[0]))
+    get_group_by_id(1).invite_users(['user2'])
+    get_group_by_id(1).add_users([get_user_by_username('user2')])
+    for token in tokens[:2]:
+        for day in range(1, 4):
+            client.post('/api/happiness/', json={
+                'value': day,
+                'timestamp': f'2023-06-0{day}'
+            }, headers=auth_header(token))
+
+    page1 = client.get('/api/happiness/count', query_string={'count': 2},
+                       headers=auth_header(tokens[0]))
+    assert page1.status_code == 200
+    assert [h['timestamp'] for h in page1.json] == ['2023-06-03', '2023-06-02']
+    page2 = client.get('/api/happiness/count', query_string={
+        'count': 2, 'cursor': page1.headers['Next-Cursor']
+    }, headers=auth_header(tokens[0]))
+    assert [h['timestamp'] for h in page2.json] == ['2023-06-01']
+    assert 'Next-Cursor' not in page2.headers
+
+    # entries on the same day are ordered by user, and ties are not skipped or repeated across pages
+    seen, cursor = [], None
+    while True:
+        query = {'count': 4} | ({'cursor': cursor} if cursor else {})
+        page = client.get('/api/group/1/happiness/count', query_string=query,
+                          headers=auth_header(tokens[0]))
+        assert page.status_code == 200
+        seen += [(h['timestamp'], h['author']['id']) for h in page.json]
+        cursor = page.headers.get('Next-Cursor')
+        if cursor is None:
+            break
+    assert seen == [(f'2023-06-0{day}', user) for day in (3, 2, 1) for user in (1, 2)]
+
+    bad_cursor = client.get('/api/happiness/count', query_string={'cursor': 'bad'},
+                            headers=auth_header(tokens[0]))
+    assert bad_cursor.status_code == 400
+
+    for url in ['/api/happiness/count', '/api/group/1/happiness/count', '/api/reads/']:
+        for count in [0, -1]:
+            assert client.get(url, query_string={'count': count}, headers=auth_header(tokens[0])).status_code == 400
+    assert get_happiness_by_cursor([1], 0) == ([], None)
+
+
+def test_happiness_conditional_get(init_client):
+    client, tokens = init_client
+    client.post('/api/happiness/', json={'value': 4, 'timestamp': '2023-06-01'},
+                headers=auth_header(tokens[0]))
+    query = {'start': '2023-06-01', 'end': '2023-06-07'}
+
+    first = client.get('/api/happiness/', query_string=query, headers=auth_header(tokens[0]))
+    assert first.status_code == 200 and first.headers['ETag']
+    unchanged = client.get('/api/happiness/', query_string=query,
+                           headers=auth_header(tokens[0]) | {'If-None-Match': first.headers['ETag']})
+    assert unchanged.status_code == 304
+    assert unchanged.headers['ETag'] == first.headers['ETag']
+
+    # the ETag depends on the request, not just the data
+    other_range = client.get('/api/happiness/', query_string={'start': '2023-06-01', 'end': '2023-06-02'},
+                             headers=auth_header(tokens[0]) | {'If-None-Match': first.headers['ETag']})
+    assert other_range.status_code == 200
+
+    client.put('/api/happiness/', query_string={'date': '2023-06-01'}, json={'comment': 'edited'},
+               headers=auth_header(tokens[0]))
+    edited = client.get('/api/happiness/', query_string=query,
+                        headers=auth_header(tokens[0]) | {'If-None-Match': first.headers['ETag']})
+    assert edited.status_code == 200 and edited.json[0]['comment'] == 'edited'
+
+    client.post('/api/happiness/', json={'value': 6, 'timestamp': '2023-06-02'}, headers=auth_header(tokens[0]))
+    unchanged_count = client.get('/api/happiness/count', headers=auth_header(tokens[0]) | {
+        'If-None-Match': client.get('/api/happiness/count', headers=auth_header(tokens[0])).headers['ETag']
+    })
+    assert unchanged_count.status_code == 304
+
+    forbidden = client.get('/api/happiness/', query_string=query | {'id': 1},
+                           headers=auth_header(tokens[1]) | {'If-None-Match': first.headers['ETag']})
+    assert forbidden.status_code == 403
+
+
+def test_happiness_rollups(init_client):
+    client, tokens = init_client
+    # 2023-06-04 is a Sunday, so 06-05 starts a new week
+    for value, day in [(4, '2023-05-31'), (6, '2023-06-04'), (9, '2023-06-05')]:
+        client.post('/api/happiness/', json={'value': value, 'timestamp': day}, headers=auth_header(tokens[0]))
+
+    def stats(period):
+        res = client.get('/api/happiness/stats', query_string={
+            'period': period, 'start': '2023-05-01', 'end': '2023-06-30'
+        }, headers=auth_header(tokens[0]))
+        assert res.status_code == 200
+        return [(s['bucket'], s['count'], s['average'], s['min'], s['max']) for s in res.json]
+
+    assert stats('week') == [('2023-05-29', 2, 5, 4, 6), ('2023-06-05', 1, 9, 9, 9)]
+    assert stats('month') == [('2023-05-01', 1, 4, 4, 4), ('2023-06-01', 2, 7.5, 6, 9)]
+
+    client.put('/api/happiness/', query_string={'date': '2023-06-04'}, json={'value': 2},
+               headers=auth_header(tokens[0]))
+    client.delete('/api/happiness/', query_string={'date': '2023-05-31'}, headers=auth_header(tokens[0]))
+    assert stats('week') == [('2023-05-29', 1, 2, 2, 2), ('2023-06-05', 1, 9, 9, 9)]
+    assert stats('month') == [('2023-06-01', 2, 5.5, 2, 9)]
+    assert stats('day') == [('2023-06-04', 1, 2, 2, 2), ('2023-06-05', 1, 9, 9, 9)]
+
+    incremental = stats('day') + stats('week') + stats('month')
+    rollup_dao.rebuild_rollups()
+    assert stats('day') + stats('week') + stats('month') == incremental
+
+    profile = client.get('/api/user/count/', headers=auth_header(tokens[0]))
+    assert profile.json['entries'] == 2
+
+    assert client.get('/api/happiness/stats', query_string={'period': 'year', 'start': '2023-01-01'},
+                      headers=auth_header(tokens[0])).status_code == 400
+
+
+def test_happiness_wrapped(init_client, tmp_path):
+    client, tokens = init_client
+    assert client.get('/api/happiness/wrapped', headers=auth_header(tokens[0])).status_code == 400
+
+    source = tmp_path / 'wrapped_data.json'
+    source.write_text(json.dumps({'1': {'username': 'test', 'entries': 30}, '999': {'username': 'gone'}}))
+    runner = client.application.test_cli_runner()
+    result = runner.invoke(args=['ingest-wrapped', str(source), '--year', '2025'])
+    assert 'Loaded Wrapped data of 1 users for 2025' in result.output
+
+    res = client.get('/api/happiness/wrapped', headers=auth_header(tokens[0]))
+    assert res.status_code == 200
+    assert res.json == {'username': 'test', 'entries': 30}
+    assert client.get('/api/happiness/wrapped', headers=auth_header(tokens[1])).status_code == 400
+
+    # re-ingesting a year replaces its data
+    source.write_text(json.dumps({'2': {'username': 'test2'}}))
+    runner.invoke(args=['ingest-wrapped', str(source), '--year', '2025'])
+    assert client.get('/api/happiness/wrapped', headers=auth_header(tokens[0])).status_code == 400
+    assert client.get('/api/happiness/wrapped', headers=auth_header(tokens[1])).json == {'username': 'test2'}
+
+
+def test_happiness_import(init_client, tmp_path):
+    client, tokens = init_client
+    client.post('/api/happiness/', json={'value': 1, 'timestamp': '2023-01-02'}, headers=auth_header(tokens[0]))
+
+    lines = [
+        {'timestamp': '2023-01-01', 'value': 4, 'comment': 'a "quoted", comment'},
+        {'timestamp': '2023-01-02', 'value': 7.5},
+        {'timestamp': '2023-01-03', 'value': 7.3},
+        {'timestamp': '2023-13-01', 'value': 5},
+        {'timestamp': '2023-01-04', 'value': 5, 'user_id': 2},
+        {'timestamp': '2023-01-07', 'value': 5, 'comment': {'a': 1}},
+        {'timestamp': '2023-01-08', 'value': 5, 'comment': 123},
+    ]
+    body = '\n'.join(json.dumps(line) for line in lines) + '\nnot json\n'
+    res = client.post('/api/happiness/import', data=body, content_type='application/x-ndjson',
+                      headers=auth_header(tokens[0]))
+    assert res.status_code == 200
+    assert res.json['imported'] == 2
+    assert [(e['line'], e['error']) for e in res.json['errors']] == [
+        (3, 'Invalid happiness value.'), (4, 'Invalid timestamp.'), (5, 'Not Allowed.'), (6, 'Invalid comment.'),
+        (7, 'Invalid comment.'), (8, 'Malformed JSON.')
+    ]
+
+    entries = client.get('/api/happiness/', query_string={'start': '2023-01-01', 'end': '2023-01-31'},
+                         headers=auth_header(tokens[0])).json
+    assert [(e['timestamp'], e['value'], e['comment']) for e in entries] == [
+        ('2023-01-01', 4, 'a "quoted", comment'), ('2023-01-02', 7.5, None)
+    ]
+    assert client.get('/api/user/count/', headers=auth_header(tokens[0])).json['entries'] == 2
+
+    csv_body = 'timestamp,value,comment\n2023-01-05,9,"multi\nline"\n2023-01-06,,\n'
+    res = client.post('/api/happiness/import', data=csv_body, content_type='text/csv',
+                      headers=auth_header(tokens[1]))
+    assert res.json['imported'] == 1
+    assert res.json['errors'] == [{'line': 4, 'error': 'Invalid happiness value.'}]
+
+    # the CLI imports rows for any user, in batches
+    source = tmp_path / 'import.jsonl'
+    source.write_text('\n'.join(json.dumps({'user_id': 3, 'timestamp': f'2023-02-{day:02}', 'value': 5})
+                                for day in range(1, 11)) + '\n{"user_id": 99, "timestamp": "2023-02-01", "value": 5}')
+    result = client.application.test_cli_runner().invoke(
+        args=['import-happiness', str(source), '--batch-size', '3'])
+    assert 'Imported 10 entries (1 errors)' in result.output
+    assert client.get('/api/user/count/', headers=auth_header(tokens[2])).json['entries'] == 10
+
+
+def test_happiness_export_download(init_client):
+    client, tokens = init_client
+    client.post('/api/happiness/', json={'value': 4, 'timestamp': '2023-01-02', 'comment': 'hi, "there"'},
+                headers=auth_header(tokens[0]))
+    client.post('/api/happiness/', json={'value': 6.5, 'timestamp': '2023-01-01'}, headers=auth_header(tokens[0]))
+    client.post('/api/group/', json={'name': 'group 1'}, headers=auth_header(tokens[0]))
+    client.post('/api/happiness/1/comment', json={'text': 'nice'}, headers=auth_header(tokens[0]))
+
+    res = client.get('/api/happiness/export/download', headers=auth_header(tokens[0]))
+    assert res.status_code == 200
+    assert res.mimetype == 'text/csv'
+    assert 'attachment' in res.headers['Content-Disposition']
+    assert res.get_data(as_text=True).splitlines() == [
+        'value,comment,timestamp', '6.5,,2023-01-01 00:00:00', '4.0,"hi, ""there""",2023-01-02 00:00:00'
+    ]
+
+    db.session.add(Journal(user_id=1, encrypted_data=b'token', timestamp=datetime(2023, 1, 3)))
+    db.session.commit()
+    assert client.post('/api/reads/', json={'happiness_id': 2}, headers=auth_header(tokens[0])).status_code == 201
+
+    # every timestamp is in ISO 8601 when extra data is included
+    res = client.get('/api/happiness/export/download',
+                     query_string={'format': 'ndjson', 'include': ['comments', 'reads', 'journals']},
+                     headers=auth_header(tokens[0]))
+    rows = [json.loads(line) for line in res.get_data(as_text=True).splitlines()]
+    assert [(r['type'], r['timestamp'], r.get('value')) for r in rows[:2]] == [
+        ('happiness', '2023-01-01T00:00:00', 6.5), ('happiness', '2023-01-02T00:00:00', 4)
+    ]
+    assert rows[2]['type'] == 'comment' and rows[2]['comment'] == 'nice' and rows[2]['author'] == 'user1'
+    assert rows[2]['entry_date'] == '2023-01-02'
+    assert [row['type'] for row in rows[3:]] == ['read', 'journal']
+    assert rows[3]['entry_date'] == '2023-01-01'
+    assert rows[4] == {'type': 'journal', 'timestamp': '2023-01-03T00:00:00', 'data': 'token'}
+    for row in rows[2:4]:
+        assert datetime.fromisoformat(row['timestamp']).isoformat() == row['timestamp']
+        assert ' ' not in row['timestamp']
+
+    for fmt in ['xml', 'parquet']:
+        assert client.get('/api/happiness/export/download', query_string={'format': fmt},
+                          headers=auth_header(tokens[0])).status_code == 400
@@ -1,10 +1,13 @@
 import pytest
 from cryptography.fernet import InvalidToken
+from flask import g
 
 from api import create_app
 from api.dao.users_dao import *
 from api.models.models import Journal
+from api.util import kdf
 from config import TestConfig
+from tests.test_groups import InMemoryRedis
 
 
 @pytest.fixture
@@ -154,6 +157,31 @@ def test_get_journals_by_date_range(init_client):
     assert get_all.json[1]['data'] == 'secret2'
 
 
+def test_journal_key_unwrapped_once(init_client, monkeypatch):
+    client, token, user = init_client
+    key_token = user.generate_password_key_token('test')
+    for day in range(1, 13):
+        client.post('/api/journal/', json={'data': f'secret {day}', 'timestamp': f'2023-10-{day:02}'},
+                    headers=auth_key_header(token, key_token))
+
+    unwraps = []
+    decrypt_user_key = User.decrypt_user_key
+    monkeypatch.setattr(User, 'decrypt_user_key', lambda self, key: unwraps.append(key) or decrypt_user_key(self, key))
+    # decrypt in parallel
+    client.application.config.update(JOURNAL_DECRYPT_WORKERS=4, JOURNAL_DECRYPT_PARALLEL_MIN=10)
+    # requests share the fixture's app context (and g) in tests
+    g.pop('journal_cipher', None)
+
+    get_all = client.get('/api/journal/dates/', query_string={'start': '2023-10-01', 'end': '2023-10-30'},
+                         headers=auth_key_header(token, key_token))
+    assert [entry['data'] for entry in get_all.json] == [f'secret {day}' for day in range(1, 13)]
+    assert len(unwraps) == 1
+
+    bad_key_token = user.generate_password_key_token('wrong')
+    bad_key = client.get('/api/journal/', headers=auth_key_header(token, bad_key_token))
+    assert bad_key.status_code == 400
+
+
 def test_get_num_journals_by_date_range(init_client):
     client, token, user = init_client
     key_token = user.generate_password_key_token('test'),
@@ -281,5 +309,24 @@ def test_delete(init_client):
     assert get.json[0]['data'] == 'secret3'
 
 
+def test_kdf_pool(init_client):
+    client, token, user = init_client
+    inline_key = user.derive_password_key('test')
+
+    client.application.config['KDF_WORKERS'] = 2
+    client.application.redis = InMemoryRedis()
+    assert user.derive_password_key('test') == inline_key
+    assert kdf.queue_depth() == 0
+    # idle processes are removed from the queue depths
+    assert client.application.redis.hgetall(kdf.DEPTH_KEY) == {}
+    assert client.application.redis.hgetall(kdf.STATS_KEY) == {b'submitted': 1}
+
+    key_token = client.post('/api/journal/key', json={'password': 'test'},
+                            headers=auth_key_header(token)).headers['Password-Key']
+    client.post('/api/journal/', json={'data': 'secret', 'timestamp': '2023-10-18'},
+                headers=auth_key_header(token, key_token))
+    assert client.get('/api/journal/', headers=auth_key_header(token, key_token)).json[0]['data'] == 'secret'
+
+
 def auth_header(token):
     return {'Authorization': f'Bearer {token}'}
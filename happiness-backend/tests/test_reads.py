@@ -1,13 +1,16 @@
 import json
 
 import pytest
+from flask import current_app
 
 from api import create_app
 from api.app import db
 from api.dao.happiness_dao import *
 from api.dao.users_dao import get_user_by_username
 from api.models.models import User, Group
+from api.util import unread_index
 from config import TestConfig
+from tests.test_groups import InMemoryRedis
 
 
 @pytest.fixture
@@ -203,6 +206,66 @@ def test_group_unread(init_client):
     assert list(map(lambda x: x['comment'], get_group.json)) == ['test2', 'test3']
 
 
+def test_unread_index(init_client):
+    client, tokens = init_client
+    current_app.config['UNREAD_INDEX_TTL'] = 3600
+    current_app.redis = InMemoryRedis()
+    add_group()
+
+    def unread(token=tokens[0]):
+        res = client.get(url + 'unread/', headers=auth_header(token))
+        assert res.status_code == 200
+        return [h['comment'] for h in res.json]
+
+    def indexed_ids(user_id=1):
+        return {int(m) for m in current_app.redis.data.get(f'unread:{user_id}', {})}
+
+    # built from the database on the first request
+    assert unread() == ['test2', 'test3']
+    assert indexed_ids() == {2, 3}
+
+    # new entries are fanned out to co-members
+    today = datetime.utcnow().strftime('%Y-%m-%d')
+    client.post('/api/happiness/', json={'value': 5, 'comment': 'new', 'timestamp': today},
+                headers=auth_header(tokens[1]))
+    assert indexed_ids() == {2, 3, 4}
+    assert unread() == ['test2', 'test3', 'new']
+
+    client.post(url, json={'happiness_id': 4}, headers=auth_header(tokens[0]))
+    assert unread() == ['test2', 'test3']
+    client.delete(url, json={'happiness_id': 4}, headers=auth_header(tokens[0]))
+    assert unread() == ['test2', 'test3', 'new']
+
+    client.delete('/api/happiness/', query_string={'id': 3}, headers=auth_header(tokens[2]))
+    assert indexed_ids() == {2, 4}
+    assert unread() == ['test2', 'new']
+    assert client.get('api/group/1/happiness/unread', headers=auth_header(tokens[0])).json[-1]['comment'] == 'new'
+
+    # entries older than a week are pruned
+    current_app.redis.data['unread:1'][b'2'] -= 8 * 24 * 60 * 60
+    assert unread() == ['new']
+    assert indexed_ids() == {4}
+
+    # membership changes drop the index, which is rebuilt from the database
+    group2 = Group(name="other group")
+    db.session.add(group2)
+    group2.invite_users(["user1"])
+    group2.add_users([get_user_by_username("user1")])
+    db.session.commit()
+    assert 'unread:1:built' not in current_app.redis.data
+    assert unread() == ['test2', 'new']
+
+    # a build is discarded if the index changed while its entries were queried
+    generation = unread_index.generation(1)
+    stale_entries = [(2, datetime.utcnow()), (4, datetime.utcnow())]
+    client.post(url, json={'happiness_id': 4}, headers=auth_header(tokens[0]))
+    unread_index.build(1, stale_entries, generation)
+    assert 'unread:1:built' not in current_app.redis.data
+    assert unread() == ['test2']
+    unread_index.build(1, stale_entries, unread_index.generation(1))
+    assert indexed_ids() == {2, 4}
+
+
 def add_group():
     group = Group(name="special test")
     db.session.add(group)
@@ -0,0 +1,121 @@
+from datetime import datetime, timedelta
+
+import pytest
+from flask import current_app
+
+from api import create_app
+from api.app import db
+from api.dao.groups_dao import get_group_by_id
+from api.dao.users_dao import get_user_by_id
+from api.models.models import User
+from config import TestConfig
+
+
+@pytest.fixture
+def init_client():
+    app = create_app(TestConfig)
+
+    client = app.test_client()
+    with app.app_context():
+        db.create_all()
+
+        user1 = User(email='test1@example.app', username='user1', password='test')
+        user2 = User(email='test2@example.app', username='user2', password='test')
+        user3 = User(email='test3@example.app', username='user3', password='test')
+        db.session.add_all([user1, user2, user3])
+        db.session.commit()
+        token_objs, tokens = zip(*[user1.create_token(), user2.create_token(), user3.create_token()])
+        db.session.add_all(token_objs)
+        db.session.commit()
+
+        # users 1 and 2 share a group, user 3 does not
+        client.post('/api/group/', json={'name': 'group 1'}, headers=auth_header(tokens[0]))
+        get_group_by_id(1).invite_users(['user2'])
+        get_group_by_id(1).add_users([get_user_by_id(2)])
+        db.session.commit()
+
+        yield client, tokens
+
+
+def auth_header(token):
+    return {'Authorization': f'Bearer {token}'}
+
+
+def sync(client, token, since=None):
+    res = client.get('/api/sync/', query_string={'since': since} if since else {},
+                     headers=auth_header(token))
+    assert res.status_code == 200
+    return res.json
+
+
+def test_full_sync(init_client):
+    client, tokens = init_client
+    for i, token in enumerate(tokens):
+        client.post('/api/happiness/', json={'value': i, 'timestamp': '2023-06-01'}, headers=auth_header(token))
+    client.post('/api/happiness/2/comment', json={'text': 'hi'}, headers=auth_header(tokens[0]))
+    client.post('/api/reads/', json={'happiness_id': 2}, headers=auth_header(tokens[0]))
+
+    data = sync(client, tokens[0])
+    assert data['user_ids'] == [1, 2]
+    assert [h['id'] for h in data['happiness']] == [1, 2]
+    assert [c['text'] for c in data['comments']] == ['hi']
+    assert data['reads'] == [2]
+    assert data['deleted'] == {'happiness': [], 'comments': [], 'reads': []}
+
+
+def test_delta_sync(init_client):
+    client, tokens = init_client
+    client.post('/api/happiness/', json={'value': 1, 'timestamp': '2023-06-01'}, headers=auth_header(tokens[0]))
+    client.post('/api/happiness/', json={'value': 2, 'timestamp': '2023-06-02'}, headers=auth_header(tokens[1]))
+    client.post('/api/happiness/2/comment', json={'text': 'first'}, headers=auth_header(tokens[0]))
+    client.post('/api/happiness/2/comment', json={'text': 'second'}, headers=auth_header(tokens[0]))
+    client.post('/api/reads/', json={'happiness_id': 2}, headers=auth_header(tokens[0]))
+    since = sync(client, tokens[0])['time']
+
+    empty = sync(client, tokens[0], since)
+    assert empty['happiness'] == [] and empty['comments'] == [] and empty['reads'] == []
+
+    client.put('/api/happiness/', query_string={'id': 2}, json={'value': 5}, headers=auth_header(tokens[1]))
+    client.put('/api/happiness/comments/1', json={'data': 'edited'}, headers=auth_header(tokens[0]))
+    client.delete('/api/happiness/comments/2', headers=auth_header(tokens[0]))
+    client.delete('/api/reads/', json={'happiness_id': 2}, headers=auth_header(tokens[0]))
+    client.delete('/api/happiness/', query_string={'id': 1}, headers=auth_header(tokens[0]))
+    client.post('/api/happiness/', json={'value': 3, 'timestamp': '2023-06-03'}, headers=auth_header(tokens[2]))
+
+    changes = sync(client, tokens[0], since)
+    assert [(h['id'], h['value']) for h in changes['happiness']] == [(2, 5)]
+    assert [c['text'] for c in changes['comments']] == ['edited']
+    assert changes['deleted'] == {'happiness': [1], 'comments': [2], 'reads': [2]}
+
+    # reads are private to the reader
+    assert sync(client, tokens[1], since)['deleted']['reads'] == []
+
+
+def test_sync_read_again(init_client):
+    client, tokens = init_client
+    client.post('/api/happiness/', json={'value': 2, 'timestamp': '2023-06-02'}, headers=auth_header(tokens[1]))
+    since = sync(client, tokens[0])['time']
+
+    client.post('/api/reads/', json={'happiness_id': 1}, headers=auth_header(tokens[0]))
+    client.delete('/api/reads/', json={'happiness_id': 1}, headers=auth_header(tokens[0]))
+    assert sync(client, tokens[0], since)['deleted']['reads'] == [1]
+    client.post('/api/reads/', json={'happiness_id': 1}, headers=auth_header(tokens[0]))
+    changes = sync(client, tokens[0], since)
+    assert changes['reads'] == [1] and changes['deleted']['reads'] == []
+
+
+def test_sync_overlap(init_client):
+    client, tokens = init_client
+    current_app.config['SYNC_OVERLAP_SECONDS'] = 60
+    client.post('/api/happiness/', json={'value': 1, 'timestamp': '2023-06-01'}, headers=auth_header(tokens[0]))
+
+    data = sync(client, tokens[0])
+    assert datetime.utcnow() - datetime.fromisoformat(data['time']) >= timedelta(seconds=60)
+    # changes made just before the last sync are returned again
+    assert [h['id'] for h in sync(client, tokens[0], data['time'])['happiness']] == [1]
+
+
+def test_sync_too_old(init_client):
+    client, tokens = init_client
+    res = client.get('/api/sync/', query_string={'since': '2000-01-01T00:00:00'}, headers=auth_header(tokens[0]))
+    assert res.status_code == 410
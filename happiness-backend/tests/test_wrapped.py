@@ -0,0 +1,182 @@
+import importlib
+import json
+import os
+import threading
+import time
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from wrapped.gemini_scheduler import GeminiScheduler, TokenBucket
+from wrapped.shards import completed_users, in_shard, merge_shards, parse_shard, write_shard
+
+
+class StubGemini(BaseHTTPRequestHandler):
+    """
+    Local stand-in for the Gemini generateContent API. Fails the first request of every prompt,
+    and rejects every request of prompts starting with 'invalid'.
+    """
+    requests = []
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        prompt = body['contents'][0]['parts'][0]['text']
+        StubGemini.requests.append(prompt)
+        if prompt.startswith('invalid'):
+            self.send_response(400)
+            self.end_headers()
+            return
+        if StubGemini.requests.count(prompt) == 1:
+            self.send_response(503)
+            self.end_headers()
+            return
+        reply = {'candidates': [{'content': {'role': 'model', 'parts': [
+            {'text': '```json\n' + json.dumps({'echo': prompt}) + '\n```'}
+        ]}}]}
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.end_headers()
+        self.wfile.write(json.dumps(reply).encode())
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def stub_server():
+    StubGemini.requests = []
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubGemini)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f'http://127.0.0.1:{server.server_port}'
+    server.shutdown()
+
+
+def test_gemini_scheduler(stub_server, tmp_path):
+    def scheduler():
+        return GeminiScheduler('key', str(tmp_path), concurrency=4, requests_per_minute=6000,
+                               backoff=0.01, base_url=stub_server)
+
+    first = scheduler()
+    futures = [first.submit(f'prompt {i}', f'prompt {i}') for i in range(4)]
+    assert [f.result() for f in futures] == [{'echo': f'prompt {i}'} for i in range(4)]
+    first.shutdown()
+    # every prompt failed once and was retried
+    assert len(StubGemini.requests) == 8
+
+    # re-runs are served from the cache
+    second = scheduler()
+    assert second.run_json('prompt 2', 'prompt 2') == {'echo': 'prompt 2'}
+    assert len(StubGemini.requests) == 8
+
+    no_retries = GeminiScheduler('key', str(tmp_path), max_retries=0, base_url=stub_server)
+    assert no_retries.run_json('new', 'new prompt')['error'] == 'gemini_call_failed'
+
+    # client errors are not retried
+    assert second.run_json('invalid', 'invalid prompt')['error'] == 'gemini_call_failed'
+    assert StubGemini.requests.count('invalid prompt') == 1
+
+
+def test_token_bucket():
+    bucket = TokenBucket(rate=50, capacity=2)
+    start = time.monotonic()
+    for _ in range(7):
+        bucket.acquire()
+    # 2 requests in the initial burst, then 50 per second
+    assert time.monotonic() - start >= 0.09
+
+
+def test_wrapped_shards(tmp_path):
+    assert parse_shard("1/3") == (1, 3)
+    with pytest.raises(ValueError):
+        parse_shard("3/3")
+    assert [user_id for user_id in range(1, 7) if in_shard(user_id, (1, 3))] == [1, 4]
+    assert [user_id for user_id in range(1, 7) if in_shard(user_id, (1, 3), {4, 5})] == [4]
+    assert in_shard(5, None)
+
+    out_a, out_b = str(tmp_path / "a"), str(tmp_path / "b")
+    assert completed_users(out_a) == set()
+    write_shard(out_a, 1, {"username": "user1"})
+    write_shard(out_a, 2, {"username": "user2"})
+    write_shard(out_b, 3, {"username": "user3"})
+
+    # a partially written manifest line or a missing shard does not count as completed
+    with open(tmp_path / "a" / "manifest.jsonl", "a") as f:
+        f.write('{"user_id": 4, "comp')
+    (tmp_path / "a" / "shards" / "2.json").unlink()
+    assert completed_users(out_a) == {1}
+
+    output = tmp_path / "wrapped_data.json"
+    assert merge_shards([out_a, out_b], str(output)) == 2
+    assert json.loads(output.read_text()) == {"1": {"username": "user1"}, "3": {"username": "user3"}}
+
+
+@pytest.fixture
+def create_wrapped(monkeypatch):
+    # the script imports its siblings as top level modules
+    monkeypatch.syspath_prepend(os.path.join(os.path.dirname(__file__), os.pardir, "wrapped"))
+    return importlib.import_module("create_wrapped")
+
+
+def entries(*days):
+    return [(datetime(2023, month, day), value, f"{month}/{day}") for month, day, value in days]
+
+
+def test_wrapped_stats(create_wrapped):
+    results, texts = create_wrapped.compute_stats(entries(
+        (1, 2, 5), (1, 3, 6), (1, 4, 7),  # monday week of Jan 2
+        (1, 9, 2), (1, 10, 9), (1, 11, 2),  # monday week of Jan 9
+        (2, 1, 9), (2, 2, 2),  # monday week of Jan 30
+    ))
+    assert results['average_score'] == 42 / 8
+    assert results['mode_score'] == {'score': 2, 'count': 3}
+
+    # the first of the longest streaks
+    assert results['longest_streak'] == {'start': '2023-01-02T00:00:00', 'end': '2023-01-04T00:00:00', 'days': 2}
+
+    # earliest of the lowest scores, latest of the highest scores
+    assert results['min_score'] == {'score': 2, 'date': '2023-01-09T00:00:00'}
+    assert results['max_score'] == {'score': 9, 'date': '2023-02-01T00:00:00'}
+    assert (texts['min_score_comment'], texts['max_score_comment']) == ('1/9', '2/1')
+
+    # the first of the largest swings, increases before decreases
+    assert results['largest_diff'] == {'start_date': '2023-01-09T00:00:00', 'end_date': '2023-01-10T00:00:00',
+                                       'score_difference': '+7'}
+    assert texts['largest_diff_comment'] == "Score Difference: 7\nStart Day: 1/9\nEnd Day: 1/10"
+
+    assert results['month_highest'] == {'month': 2, 'avg_score': 5.5}
+    assert results['month_lowest'] == {'month': 1, 'avg_score': 31 / 6}
+    assert texts['highest_month_entries'] == "2/1\n\n2/2"
+
+    assert results['week_highest'] == {'week_start': '2023-01-02T00:00:00', 'avg_score': 6}
+    assert results['week_lowest'] == {'week_start': '2023-01-09T00:00:00', 'avg_score': 13 / 3}
+    assert texts['lowest_week_entries'] == "1/9\n\n1/10\n\n1/11"
+
+    assert texts['entries_0_4'] == "1/9\n\n1/11\n\n2/2"
+    assert texts['entries_8_10'] == "1/10\n\n2/1"
+
+    # decreases are not prefixed
+    results, _ = create_wrapped.compute_stats(entries((3, 1, 8), (3, 2, 3), (3, 3, 3)))
+    assert results['largest_diff']['score_difference'] == -5
+    assert results['longest_streak']['days'] == 2
+
+
+def test_wrapped_ranking(create_wrapped, monkeypatch):
+    def stream_year_entries(conn, year):
+        yield 1, entries((1, 1, 5), (1, 2, 5), (1, 3, 5))
+        yield 2, entries(*[(1, day, 5) for day in range(1, 6)])
+        yield 3, entries((1, 1, 5))
+        yield 4, entries((1, 1, 5), (1, 2, 5), (1, 3, 5))
+
+    monkeypatch.setattr(create_wrapped, "stream_year_entries", stream_year_entries)
+    monkeypatch.setattr(create_wrapped, "MIN_ENTRIES", 2)
+    users = {user_id: f"user{user_id}" for user_id in range(1, 5)}
+
+    records = create_wrapped.compute_all_stats(None, users, 2023)
+    # inactive users are counted in the ranking, but their stats are not computed
+    assert [(r['user_id'], r['results']['entries'], r['results']['top_pct']) for r in records] == \
+           [(1, 3, 0.5), (2, 5, 0.25), (4, 3, 0.75)]
+    assert records[0]['results']['username'] == "user1"
+
+    records = create_wrapped.compute_all_stats(None, users, 2023, selected=lambda user_id: user_id != 2)
+    assert [(r['user_id'], r['results']['top_pct']) for r in records] == [(1, 0.5), (4, 0.75)]
@@ -22,17 +22,28 @@ highest and lowest week with short summary
 craziest entry summary
 overthinking entry summary
 most down bad entry summary
-"""
 
-import json
-import re
-import psycopg2
-from datetime import date, datetime, timedelta
+The numeric stats of all users are computed in one batch stage (a single streamed query)
+before the Gemini stage runs. They are not saved on their own: a resumed run recomputes them,
+which is cheap next to the Gemini calls.
 
-from wrapped_db import db_config, gemini_api_key
+Each user's results are written to their own shard as soon as they are done, so an interrupted run
+resumes after the last completed user. Users whose Gemini analysis failed are not written, so they are
+retried by the next run. Users can be split across runs with --users or --shard i/n,
+and the shards are combined into wrapped_data_{year}.json with --merge (see shards.py).
+"""
 
-from google import genai
+import argparse
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta
+from itertools import groupby
+from operator import itemgetter
+from typing import Optional
+
+import psycopg2
 
+from gemini_scheduler import GeminiScheduler
+from shards import completed_users, in_shard, merge_shards, parse_shard, write_shard
 from gemini_prompts import (
     build_day_summaries_prompt,
     build_largest_swing_prompt,
@@ -43,328 +54,249 @@ from gemini_prompts import (
 )
 
 current_year = datetime.now().year
-all_results = {}
-
-
-def _next_month_start(d: date) -> date:
-    if d.month == 12:
-        return date(d.year + 1, 1, 1)
-    return date(d.year, d.month + 1, 1)
-
-
-def _fetch_entries_in_range(
-    cursor: psycopg2._psycopg.cursor,
-    user_id: int,
-    start_date,
-    end_date,
-) -> str:
-    cursor.execute(
-        """
-        SELECT timestamp, comment
-        FROM happiness
-        WHERE user_id = (%s) AND timestamp >= %s AND timestamp < %s
-        ORDER BY timestamp ASC;
-        """,
-        (user_id, start_date, end_date),
-    )
+MIN_ENTRIES = 20
+
 
-    return "\n\n".join([entry[1] for entry in cursor.fetchall()])
+def _join_comments(entries) -> str:
+    return "\n\n".join([comment or "" for _, _, comment in entries])
 
 
-def _extract_first_json_object(text: str) -> dict:
+def stream_year_entries(conn, year: int):
     """
-    Best-effort extraction of the first JSON object in a response.
-    Gemini can occasionally wrap JSON in prose or code fences.
+    Streams every entry of the year in a single query (through a server-side cursor, so the whole
+    table is never held in memory), yielding (user_id, [(timestamp, value, comment), ...]) per user.
+    """
+    with conn.cursor(name="wrapped_entries") as cursor:
+        cursor.itersize = 10000
+        cursor.execute('''
+            SELECT user_id, timestamp, value, comment
+            FROM happiness
+            WHERE timestamp >= %s
+            ORDER BY user_id, timestamp ASC;
+        ''', (f'{year}-01-01',))
+        for user_id, rows in groupby(cursor, key=itemgetter(0)):
+            yield user_id, [row[1:] for row in rows]
+
+
+def _bucket_extremes(entries, bucket_start) -> tuple:
+    """Returns the (start, average, entries) of the buckets with the highest and lowest average score."""
+    buckets = defaultdict(list)
+    for entry in entries:
+        buckets[bucket_start(entry[0])].append(entry)
+    averages = sorted(((start, sum(e[1] for e in bucket) / len(bucket), bucket)
+                       for start, bucket in buckets.items()), key=itemgetter(1), reverse=True)
+    return averages[0], averages[-1]
+
+
+def _longest_streak(entries) -> tuple[datetime, datetime]:
+    """Returns the first and last day of the longest run of entries on consecutive days."""
+    best = current = (entries[0][0], entries[0][0])
+    for (prev, _, _), (cur, _, _) in zip(entries, entries[1:]):
+        current = (current[0], cur) if (cur - prev).days == 1 else (cur, cur)
+        if (current[1] - current[0]) > (best[1] - best[0]):
+            best = current
+    return best
+
+
+def compute_stats(entries) -> tuple[dict, dict]:
+    """
+    Computes all the numeric Wrapped stats of a user from their entries for the year
+    (sorted by timestamp), in a single pass over them.
+    Returns the stats and the entry texts the Gemini prompts are built from.
     """
-    text = text.strip()
-    # Strip code fences if present.
-    if text.startswith("```"):
-        text = re.sub(r"^```[a-zA-Z0-9_-]*\s*", "", text)
-        text = re.sub(r"\s*```$", "", text)
-        text = text.strip()
-
-    # Fast path.
-    if text.startswith("{") and text.endswith("}"):
-        return json.loads(text)
-
-    # Best-effort: find first {...} block.
-    match = re.search(r"\{[\s\S]*\}", text)
-    if not match:
-        raise ValueError("No JSON object found in Gemini response.")
-    return json.loads(match.group(0))
-
-
-def run_gemini_json(name: str, prompt: str) -> dict:
-    print(
-        f'executing Gemini analysis for {name} at {datetime.now().strftime("%Y-%m-%d %H:%M:%S")}...')
-    try:
-        client = genai.Client(api_key=gemini_api_key)
-        response = client.models.generate_content(
-            model="gemini-3-flash-preview",
-            contents=prompt,
-        )
-        # save response to file
-        with open('gemini_response.txt', 'a') as f:
-            f.write(response.text)
-            f.write("\n")
-        return _extract_first_json_object(response.text)
-    except Exception as e:
-        return {"error": "gemini_call_failed", "details": str(e)}
-
-
-def execute_queries(cursor: psycopg2._psycopg.cursor, user_id, entry_count, pct, username):
-
     results = {}
-    results['username'] = username
-    results['entries'] = entry_count
-    results['top_pct'] = pct
+    values = [value for _, value, _ in entries]
+    results['average_score'] = sum(values) / len(values)
 
-    print('executing database queries...')
+    score, count = Counter(values).most_common(1)[0]
+    results['mode_score'] = {'score': score, 'count': count}
 
-    # get average score value
-    cursor.execute('''
-        SELECT AVG(value)
-        FROM happiness
-        WHERE user_id = (%s) AND timestamp >= %s;
-    ''', (user_id, f'{current_year}-01-01'))
-    results['average_score'] = cursor.fetchone()[0]
-
-    # get mode score value
-    cursor.execute('''
-        SELECT value, COUNT(*)
-        FROM happiness
-        WHERE user_id = (%s) AND timestamp >= %s
-        GROUP BY value
-        ORDER BY COUNT(*) DESC;
-    ''', (user_id, f'{current_year}-01-01'))
-    value_counts = cursor.fetchone()
-    results['mode_score'] = {
-        'score': value_counts[0],
-        'count': value_counts[1]
-    }
-
-    # get longest streak of consecutive days with entries
-    cursor.execute('''
-        SELECT DISTINCT ON (user_id) user_id, min(timestamp), max(timestamp)
-        FROM (SELECT happiness.*,
-                     row_number() OVER (PARTITION BY user_id ORDER BY timestamp) AS seqnum
-              FROM happiness
-              WHERE user_id = (%s) AND timestamp >= %s
-             ) happiness
-        GROUP BY user_id, timestamp - seqnum * interval '1 day'
-        ORDER BY user_id, count(*) DESC;
-    ''', (user_id, f'{current_year}-01-01'))
-    streak = cursor.fetchone()
+    streak_start, streak_end = _longest_streak(entries)
     results['longest_streak'] = {
-        'start': datetime.isoformat(streak[1]),
-        'end': datetime.isoformat(streak[2]),
-        'days': (streak[2] - streak[1]).days
+        'start': datetime.isoformat(streak_start),
+        'end': datetime.isoformat(streak_end),
+        'days': (streak_end - streak_start).days
     }
 
-    # get min and max score value
-    cursor.execute('''
-        SELECT value, timestamp, comment
-        FROM happiness
-        WHERE user_id = (%s) AND timestamp >= %s
-        ORDER BY value ASC, timestamp ASC
-    ''', (user_id, f'{current_year}-01-01'))
-    entries_sorted = cursor.fetchall()
-    results['min_score'] = {
-        'score': entries_sorted[0][0],
-        'date': datetime.isoformat(entries_sorted[0][1])
-    }
-    results['max_score'] = {
-        'score': entries_sorted[-1][0],
-        'date': datetime.isoformat(entries_sorted[-1][1]),
-    }
-    min_score_comment = entries_sorted[0][2]
-    max_score_comment = entries_sorted[-1][2]
-
-    # get all entries with scores 0-4
-    cursor.execute('''
-        SELECT comment FROM happiness
-        WHERE user_id = (%s) AND timestamp >= %s AND value >= 0 AND value <= 4
-        ORDER BY timestamp ASC
-    ''', (user_id, f'{current_year}-01-01'))
-    entries_0_4 = "\n\n".join([entry[0] for entry in cursor.fetchall()])
-
-    # get all entries with scores 8-10
-    cursor.execute('''
-        SELECT comment FROM happiness
-        WHERE user_id = (%s) AND timestamp >= %s AND value >= 8 AND value <= 10
-        ORDER BY timestamp ASC
-    ''', (user_id, f'{current_year}-01-01'))
-    entries_8_10 = "\n\n".join([entry[0] for entry in cursor.fetchall()])
-
-    # get largest score difference between 2 consecutive days
-    cursor.execute('''
-        WITH daily_scores AS (
-            SELECT timestamp AS entry_date,
-                   AVG(value) AS scores,
-                   (array_agg(comment ORDER BY timestamp))[1] AS comment
-            FROM happiness
-            WHERE user_id = (%s) AND timestamp >= %s
-            GROUP BY timestamp
-        ),
-             score_differences AS (
-                 SELECT entry_date,
-                        LEAD(entry_date) OVER (ORDER BY entry_date) AS next_date,
-                        scores,
-                        LEAD(scores) OVER (ORDER BY entry_date) - scores AS score_diff,
-                        ABS(LEAD(scores) OVER (ORDER BY entry_date) - scores) AS abs_score_diff,
-                        comment AS start_comment,
-                        LEAD(comment) OVER (ORDER BY entry_date) AS end_comment
-                 FROM daily_scores
-             )
-        SELECT entry_date AS start_date,
-               next_date AS end_date,
-               score_diff AS score_difference,
-               start_comment,
-               end_comment
-        FROM score_differences
-        ORDER BY abs_score_diff DESC, score_diff DESC
-        LIMIT 2;
-     ''', (user_id, f'{current_year}-01-01'))
-    score_diff = cursor.fetchall()[1]
+    # lowest score (earliest day on ties) and highest score (latest day on ties)
+    min_entry = min(entries, key=lambda e: (e[1], e[0]))
+    max_entry = max(entries, key=lambda e: (e[1], e[0]))
+    results['min_score'] = {'score': min_entry[1], 'date': datetime.isoformat(min_entry[0])}
+    results['max_score'] = {'score': max_entry[1], 'date': datetime.isoformat(max_entry[0])}
+
+    # largest score difference between 2 consecutive entries
+    start, end = max(zip(entries, entries[1:]), key=lambda p: (abs(p[1][1] - p[0][1]), p[1][1] - p[0][1]))
+    score_difference = end[1] - start[1]
     results['largest_diff'] = {
-        'start_date': datetime.isoformat(score_diff[0]),
-        'end_date': datetime.isoformat(score_diff[1]),
-        'score_difference': score_diff[2] if score_diff[2] < 0 else '+' + str(score_diff[2]),
+        'start_date': datetime.isoformat(start[0]),
+        'end_date': datetime.isoformat(end[0]),
+        'score_difference': score_difference if score_difference < 0 else '+' + str(score_difference),
     }
-    largest_diff_comment = f"Score Difference: {str(score_diff[2])}\nStart Day: {score_diff[3]}\nEnd Day: {score_diff[4]}"
 
-    # get months with the highest and lowest average score value
-    cursor.execute('''
-        WITH monthly_scores AS (
-            SELECT DATE_TRUNC('month', timestamp) AS month, AVG(value) AS avg_score
-            FROM happiness
-            WHERE user_id = (%s) AND timestamp >= %s
-            GROUP BY DATE_TRUNC('month', timestamp)
-        )
-        SELECT month, avg_score
-        FROM monthly_scores
-        ORDER BY avg_score DESC;
-    ''', (user_id, f'{current_year}-01-01'))
-    month_data = cursor.fetchall()
-    results['month_highest'] = {
-        'month': month_data[0][0].month,
-        'avg_score': month_data[0][1]
-    }
-    results['month_lowest'] = {
-        'month': month_data[-1][0].month,
-        'avg_score': month_data[-1][1]
+    month_high, month_low = _bucket_extremes(entries, lambda ts: datetime(ts.year, ts.month, 1))
+    results['month_highest'] = {'month': month_high[0].month, 'avg_score': month_high[1]}
+    results['month_lowest'] = {'month': month_low[0].month, 'avg_score': month_low[1]}
+
+    week_high, week_low = _bucket_extremes(
+        entries, lambda ts: datetime(ts.year, ts.month, ts.day) - timedelta(days=ts.weekday()))
+    results['week_highest'] = {'week_start': datetime.isoformat(week_high[0]), 'avg_score': week_high[1]}  # mondays only
+    results['week_lowest'] = {'week_start': datetime.isoformat(week_low[0]), 'avg_score': week_low[1]}
+
+    results['total_words'] = len(" ".join([comment or "" for _, _, comment in entries]).split(" "))
+
+    texts = {
+        'all_entries': "\n\n".join(
+            [f"{datetime.strftime(ts, '%Y-%m-%d')}: {comment}" for ts, _, comment in entries]),
+        'entries_0_4': _join_comments([e for e in entries if 0 <= e[1] <= 4]),
+        'entries_8_10': _join_comments([e for e in entries if 8 <= e[1] <= 10]),
+        'min_score_comment': min_entry[2],
+        'max_score_comment': max_entry[2],
+        'largest_diff_comment': f"Score Difference: {str(score_difference)}\nStart Day: {start[2]}\nEnd Day: {end[2]}",
+        'highest_month_entries': _join_comments(month_high[2]),
+        'lowest_month_entries': _join_comments(month_low[2]),
+        'highest_week_entries': _join_comments(week_high[2]),
+        'lowest_week_entries': _join_comments(week_low[2]),
     }
+    return results, texts
 
-    highest_month_start = month_data[0][0].date()
-    lowest_month_start = month_data[-1][0].date()
-    highest_month_entries = _fetch_entries_in_range(
-        cursor, user_id, highest_month_start, _next_month_start(
-            highest_month_start)
-    )
-    lowest_month_entries = _fetch_entries_in_range(
-        cursor, user_id, lowest_month_start, _next_month_start(
-            lowest_month_start)
-    )
 
-    # get weeks with the highest and lowest average score value
-    cursor.execute('''
-        WITH weekly_scores AS (
-            SELECT DATE_TRUNC('week', timestamp) AS week, AVG(value) AS avg_score
-            FROM happiness
-            WHERE user_id = (%s) AND timestamp >= %s
-            GROUP BY DATE_TRUNC('week', timestamp)
-        )
-        SELECT week, avg_score
-        FROM weekly_scores
-        ORDER BY avg_score DESC;
-    ''', (user_id, f'{current_year}-01-01'))
-    week_data = cursor.fetchall()
-    results['week_highest'] = {
-        'week_start': datetime.isoformat(week_data[0][0]),  # mondays only
-        'avg_score': week_data[0][1]
-    }
-    results['week_lowest'] = {
-        'week_start': datetime.isoformat(week_data[-1][0]),
-        'avg_score': week_data[-1][1]
+def compute_all_stats(conn, users_dict: dict, year: int, selected=None) -> list[dict]:
+    """
+    Batch stage: computes the numeric stats (and the prompt texts) of every active user, or only the
+    users for which selected(user_id) is true, from a single streamed query.
+    All users are still counted for the ranking.
+    """
+    print('executing database queries...')
+    entry_counts = {}
+    records = []
+    for user_id, entries in stream_year_entries(conn, year):
+        entry_counts[user_id] = len(entries)
+        if len(entries) > MIN_ENTRIES and (selected is None or selected(user_id)):
+            results, texts = compute_stats(entries)
+            records.append({'user_id': user_id, 'results': results, 'texts': texts})
+
+    # rank users by number of entries
+    ranking = sorted(entry_counts, key=entry_counts.get, reverse=True)
+    for record in records:
+        user_id = record['user_id']
+        record['results'] = {
+            'username': users_dict[user_id],
+            'entries': entry_counts[user_id],
+            'top_pct': (ranking.index(user_id) + 1) / len(ranking),
+            **record['results']
+        }
+
+    return records
+
+
+def submit_gemini_analysis(scheduler: GeminiScheduler, texts: dict) -> dict:
+    """Gemini stage: queues the prompts for a user's AI summaries (they run concurrently)."""
+    return {
+        'yearly': scheduler.submit('yearly', build_yearly_prompt(texts['all_entries'])),
+        'score_bands': scheduler.submit('score_bands', build_score_bands_prompt(
+            texts['entries_0_4'], texts['entries_8_10'])),
+        'day_summaries': scheduler.submit('day_summaries', build_day_summaries_prompt(
+            texts['max_score_comment'], texts['min_score_comment'])),
+        'week_summaries': scheduler.submit('week_summaries', build_week_summaries_prompt(
+            texts['highest_week_entries'], texts['lowest_week_entries'])),
+        'month_summaries': scheduler.submit('month_summaries', build_month_summaries_prompt(
+            texts['highest_month_entries'], texts['lowest_month_entries'])),
+        'largest_swing_summary': scheduler.submit('largest_swing_summary', build_largest_swing_prompt(
+            texts['largest_diff_comment'])),
     }
 
-    highest_week_start = week_data[0][0].date()
-    lowest_week_start = week_data[-1][0].date()
-    highest_week_entries = _fetch_entries_in_range(
-        cursor, user_id, highest_week_start, highest_week_start +
-        timedelta(days=7)
-    )
-    lowest_week_entries = _fetch_entries_in_range(
-        cursor, user_id, lowest_week_start, lowest_week_start +
-        timedelta(days=7)
-    )
 
-    # get all entries for the year
-    cursor.execute('''
-        SELECT timestamp, comment FROM happiness
-        WHERE user_id = (%s) AND timestamp >= %s
-        ORDER BY timestamp ASC
-    ''', (user_id, f'{current_year}-01-01'))
-    all_entries_data = cursor.fetchall()
-    all_entries = "\n\n".join(
-        [f"{datetime.strftime(entry[0], '%Y-%m-%d')}: {entry[1]}" for entry in all_entries_data])
-
-    results['total_words'] = len(
-        " ".join([entry[1] for entry in all_entries_data]).split(" "))
-
-    # AI analysis (Gemini)
-    print('executing Gemini analysis...')
-
-    results.update({
-        "yearly": run_gemini_json('yearly', build_yearly_prompt(all_entries)),
-        "score_bands": run_gemini_json('score_bands', build_score_bands_prompt(entries_0_4, entries_8_10))
-    })
-
-    day_summaries = run_gemini_json(
-        'day_summaries', build_day_summaries_prompt(max_score_comment, min_score_comment))
-    results['min_score']['ai_summary'] = day_summaries['lowest_day_summary']
-    results['max_score']['ai_summary'] = day_summaries['highest_day_summary']
-
-    week_summaries = run_gemini_json('week_summaries', build_week_summaries_prompt(
-        highest_week_entries, lowest_week_entries))
-    results['week_highest']['ai_summary'] = week_summaries['highest_week_summary']
-    results['week_lowest']['ai_summary'] = week_summaries['lowest_week_summary']
-
-    month_summaries = run_gemini_json('month_summaries', build_month_summaries_prompt(
-        highest_month_entries, lowest_month_entries))
-    results['month_highest']['ai_summary'] = month_summaries['highest_month_summary']
-    results['month_lowest']['ai_summary'] = month_summaries['lowest_month_summary']
-
-    results['largest_diff']['ai_summary'] = run_gemini_json(
-        'largest_swing_summary', build_largest_swing_prompt(largest_diff_comment))['largest_swing_summary']
-
-    all_results[user_id] = results
-
-
-# db_config is a dictionary with the keys: dbname, user, password, host, and port
-conn = psycopg2.connect(**db_config)
-cursor = conn.cursor()
-
-cursor.execute('''SELECT id, "user".username FROM "user"''')
-users_dict = dict(cursor.fetchall())
-
-cursor.execute('''
-    SELECT user_id, COUNT(*) AS entry_count
-    FROM happiness
-    WHERE timestamp >= %s
-    GROUP BY user_id
-    ORDER BY entry_count DESC;
-''', (f'{current_year}-01-01',))
-active_users = cursor.fetchall()
-
-for i, (user_id, entry_count) in enumerate(active_users):
-    if entry_count > 20:
-        print('processing ' + users_dict[user_id])
-        execute_queries(cursor, user_id, entry_count, (i+1) /
-                        len(active_users), users_dict[user_id])
-
-with open(f'wrapped_data_{current_year}.json', 'w') as f:
-    json.dump(all_results, f)
-
-cursor.close()
-conn.close()
+def add_gemini_analysis(results: dict, futures: dict) -> Optional[str]:
+    """
+    Waits for a user's AI summaries and adds them to their stats.
+    Returns the error if a prompt failed or its response is missing a summary (the stats are then incomplete).
+    """
+    responses = {name: future.result() for name, future in futures.items()}
+    for name, response in responses.items():
+        if 'error' in response:
+            return f"{name}: {response.get('details', response['error'])}"
+
+    try:
+        results.update({
+            "yearly": responses['yearly'],
+            "score_bands": responses['score_bands']
+        })
+
+        day_summaries = responses['day_summaries']
+        results['min_score']['ai_summary'] = day_summaries['lowest_day_summary']
+        results['max_score']['ai_summary'] = day_summaries['highest_day_summary']
+
+        week_summaries = responses['week_summaries']
+        results['week_highest']['ai_summary'] = week_summaries['highest_week_summary']
+        results['week_lowest']['ai_summary'] = week_summaries['lowest_week_summary']
+
+        month_summaries = responses['month_summaries']
+        results['month_highest']['ai_summary'] = month_summaries['highest_month_summary']
+        results['month_lowest']['ai_summary'] = month_summaries['lowest_month_summary']
+
+        results['largest_diff']['ai_summary'] = responses['largest_swing_summary']['largest_swing_summary']
+    except KeyError as e:
+        return f"response is missing {e}"
+    return None
+
+
+if __name__ == "__main__":
+    from wrapped_db import db_config, gemini_api_key
+
+    parser = argparse.ArgumentParser(description="Generate Happiness App Wrapped data.")
+    parser.add_argument("--concurrency", type=int, default=8, help="Maximum concurrent Gemini requests.")
+    parser.add_argument("--rpm", type=float, default=60, help="Maximum Gemini requests per minute.")
+    parser.add_argument("--cache-dir", default="gemini_cache", help="Directory of cached Gemini responses.")
+    parser.add_argument("--base-url", help="Gemini API base URL (e.g. a local stub server).")
+    parser.add_argument("--out-dir", default=f"wrapped_{current_year}", help="Directory of per-user shards.")
+    parser.add_argument("--users", help="Comma separated IDs of the users to generate.")
+    parser.add_argument("--shard", type=parse_shard, help="Only generate users whose ID %% n == i (i/n).")
+    parser.add_argument("--merge", nargs="*", metavar="OUT_DIR",
+                        help="Merge the shards of the given directories (default: --out-dir) and exit.")
+    args = parser.parse_args()
+
+    if args.merge is not None:
+        count = merge_shards(args.merge or [args.out_dir], f'wrapped_data_{current_year}.json')
+        print(f'merged {count} users into wrapped_data_{current_year}.json')
+        raise SystemExit
+
+    users = {int(user_id) for user_id in args.users.split(",")} if args.users else None
+    completed = completed_users(args.out_dir)
+    print(f'{len(completed)} users already completed')
+
+    # db_config is a dictionary with the keys: dbname, user, password, host, and port
+    conn = psycopg2.connect(**db_config)
+    cursor = conn.cursor()
+
+    cursor.execute('''SELECT id, "user".username FROM "user"''')
+    users_dict = dict(cursor.fetchall())
+    cursor.close()
+
+    records = compute_all_stats(
+        conn, users_dict, current_year,
+        selected=lambda user_id: user_id not in completed and in_shard(user_id, args.shard, users)
+    )
+    conn.close()
+
+    scheduler = GeminiScheduler(gemini_api_key, args.cache_dir, concurrency=args.concurrency,
+                                requests_per_minute=args.rpm, base_url=args.base_url)
+    print(f'executing Gemini analysis for {len(records)} users...')
+    pending = [(record, submit_gemini_analysis(scheduler, record['texts'])) for record in records]
+    failed = 0
+    for record, futures in pending:
+        print('processing ' + record['results']['username'])
+        error = add_gemini_analysis(record['results'], futures)
+        if error:
+            # not written to a shard, so the next run retries the user
+            print(f"warning: skipping {record['results']['username']} ({record['user_id']}), "
+                  f"Gemini analysis failed: {error}")
+            failed += 1
+            continue
+        write_shard(args.out_dir, record['user_id'], record['results'])
+    scheduler.shutdown()
+
+    if failed:
+        print(f'warning: {failed} users failed, re-run to retry them (wrapped data not merged)')
+    elif args.users is None and args.shard is None:
+        count = merge_shards([args.out_dir], f'wrapped_data_{current_year}.json')
+        print(f'merged {count} users into wrapped_data_{current_year}.json')
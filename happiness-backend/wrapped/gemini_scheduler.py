@@ -0,0 +1,158 @@
+"""
+Concurrent, rate-limited Gemini requests for Wrapped generation.
+
+Requests run on a thread pool sharing a single client, are rate limited with a token bucket,
+and are retried with exponential backoff when rate limited (429), on server errors (5xx), and on
+timeouts; other errors (e.g. an invalid request or a malformed response) fail at once. Successful responses are cached on disk by a hash of the
+model and prompt, so re-running the generation (e.g. after a crash) does not re-bill any prompt
+that already succeeded.
+
+The client can be pointed at a local stub server (base_url) for testing.
+"""
+import hashlib
+import json
+import os
+import random
+import re
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime
+from typing import Optional
+
+import httpx
+from google import genai
+from google.genai import errors, types
+
+DEFAULT_MODEL = "gemini-3-flash-preview"
+
+
+def is_retryable(error: Exception) -> bool:
+    """Returns whether a failed request may succeed if retried."""
+    if isinstance(error, errors.APIError):
+        return error.code == 429 or error.code >= 500
+    return isinstance(error, httpx.TimeoutException)
+
+
+class TokenBucket:
+    """Allows up to rate requests per second on average, with bursts of up to capacity requests."""
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Blocks until a request is allowed."""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+def extract_first_json_object(text: str) -> dict:
+    """
+    Best-effort extraction of the first JSON object in a response.
+    Gemini can occasionally wrap JSON in prose or code fences.
+    """
+    text = text.strip()
+    # Strip code fences if present.
+    if text.startswith("```"):
+        text = re.sub(r"^```[a-zA-Z0-9_-]*\s*", "", text)
+        text = re.sub(r"\s*```$", "", text)
+        text = text.strip()
+
+    # Fast path.
+    if text.startswith("{") and text.endswith("}"):
+        return json.loads(text)
+
+    # Best-effort: find first {...} block.
+    match = re.search(r"\{[\s\S]*\}", text)
+    if not match:
+        raise ValueError("No JSON object found in Gemini response.")
+    return json.loads(match.group(0))
+
+
+class GeminiScheduler:
+    """
+    Runs Gemini prompts that return JSON objects.
+    submit() returns a Future of the parsed object (or an error object if every attempt failed).
+    """
+
+    def __init__(
+        self,
+        api_key: str,
+        cache_dir: str,
+        model: str = DEFAULT_MODEL,
+        concurrency: int = 8,
+        requests_per_minute: float = 60,
+        max_retries: int = 5,
+        backoff: float = 2.0,
+        base_url: Optional[str] = None,
+    ):
+        http_options = types.HttpOptions(base_url=base_url) if base_url else None
+        self.client = genai.Client(api_key=api_key, http_options=http_options)
+        self.model = model
+        self.cache_dir = cache_dir
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.bucket = TokenBucket(requests_per_minute / 60, capacity=concurrency)
+        self.executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="gemini")
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _cache_path(self, prompt: str) -> str:
+        key = hashlib.sha256(f"{self.model}\0{prompt}".encode()).hexdigest()
+        return os.path.join(self.cache_dir, key + ".json")
+
+    def _read_cache(self, prompt: str) -> Optional[dict]:
+        try:
+            with open(self._cache_path(prompt)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _write_cache(self, prompt: str, result: dict):
+        # write to a temporary file first so a crash never leaves a partial cache entry
+        path = self._cache_path(prompt)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(result, f)
+        os.replace(tmp_path, path)
+
+    def run_json(self, name: str, prompt: str) -> dict:
+        """Runs a prompt (or returns its cached result), retrying rate limited, server error, and timed out requests."""
+        cached = self._read_cache(prompt)
+        if cached is not None:
+            return cached
+
+        error = None
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                time.sleep(self.backoff * 2 ** (attempt - 1) * (1 + random.random()))
+            self.bucket.acquire()
+            print(f'executing Gemini analysis for {name} at {datetime.now().strftime("%Y-%m-%d %H:%M:%S")}...')
+            try:
+                response = self.client.models.generate_content(model=self.model, contents=prompt)
+                result = extract_first_json_object(response.text)
+            except Exception as e:
+                error = e
+                if is_retryable(e):
+                    continue
+                break
+            self._write_cache(prompt, result)
+            return result
+        return {"error": "gemini_call_failed", "details": str(error)}
+
+    def submit(self, name: str, prompt: str) -> Future:
+        return self.executor.submit(self.run_json, name, prompt)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
@@ -0,0 +1,77 @@
+"""
+Per-user output shards for resumable Wrapped generation.
+
+Each user's finished results are written atomically to `<out_dir>/shards/<user_id>.json` and
+recorded in an append-only `<out_dir>/manifest.jsonl`, so an interrupted run can resume after the
+last completed user. Runs can be split across processes or machines (see in_shard) and their
+shards combined into the final artifact with merge_shards.
+"""
+import json
+import os
+from datetime import datetime
+from typing import Optional
+
+
+def _atomic_write_json(path: str, data):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(data, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def parse_shard(shard: str) -> tuple[int, int]:
+    """Parses a shard in the "i/n" format (0 <= i < n)."""
+    i, n = (int(part) for part in shard.split("/"))
+    if not 0 <= i < n:
+        raise ValueError(f"Invalid shard {shard}, expected i/n with 0 <= i < n")
+    return i, n
+
+
+def in_shard(user_id: int, shard: Optional[tuple[int, int]], users: Optional[set[int]] = None) -> bool:
+    """Returns whether a user should be generated by this run (all users by default)."""
+    if users is not None and user_id not in users:
+        return False
+    return shard is None or user_id % shard[1] == shard[0]
+
+
+def completed_users(out_dir: str) -> set[int]:
+    """Returns the IDs of the users whose shards were completed by earlier runs."""
+    completed = set()
+    try:
+        with open(os.path.join(out_dir, "manifest.jsonl")) as f:
+            for line in f:
+                try:
+                    completed.add(json.loads(line)["user_id"])
+                except (ValueError, KeyError):
+                    pass  # ignore a partially written last line
+    except FileNotFoundError:
+        pass
+    # only trust entries whose shard actually exists
+    return {user_id for user_id in completed
+            if os.path.exists(os.path.join(out_dir, "shards", f"{user_id}.json"))}
+
+
+def write_shard(out_dir: str, user_id: int, results: dict):
+    """Atomically writes a user's results and records them as completed in the manifest."""
+    os.makedirs(os.path.join(out_dir, "shards"), exist_ok=True)
+    _atomic_write_json(os.path.join(out_dir, "shards", f"{user_id}.json"), results)
+    with open(os.path.join(out_dir, "manifest.jsonl"), "a") as f:
+        f.write(json.dumps({"user_id": user_id, "completed": datetime.now().isoformat()}) + "\n")
+
+
+def merge_shards(out_dirs: list[str], output_path: str) -> int:
+    """
+    Combines the user shards of one or more output directories into the final Wrapped artifact
+    (a JSON object of user ID -> results). Returns the number of users merged.
+    """
+    merged = {}
+    for out_dir in out_dirs:
+        shard_dir = os.path.join(out_dir, "shards")
+        for name in sorted(os.listdir(shard_dir)):
+            if name.endswith(".json"):
+                with open(os.path.join(shard_dir, name)) as f:
+                    merged[name.removesuffix(".json")] = json.load(f)
+    _atomic_write_json(output_path, merged)
+    return len(merged)